@@ -0,0 +1,1003 @@
+"""Benchmarks for the audit pipeline.
+
+Usage:
+    python bench.py render [--iterations 2000]
+    python bench.py preprocess [screenshot.jpg ...] [--grade] [--repeats 3]
+    python bench.py load [--rates 1,2,4] [--duration 30] [--workers 1] [--anthropic 6:0.3] ...
+    python bench.py capture [--backends browser] [--concurrency 1,4,8] [--captures 40] [--urls ...]
+"""
+import argparse
+import base64
+import gzip
+import io
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+import requests
+from stubs import (SAMPLE_AUDIT, STUB_PORTS, create_pages_stub, parse_faults, serve, stub_environment,
+                   synthetic_screenshot)
+from PIL import Image
+
+
+def legacy_generate_html_template(audit_data, website_url, business_name, assessment_date):
+    """The original f-string renderer, kept verbatim as the baseline for the render benchmark"""
+    
+    score = audit_data.get('overall_score', 0)
+    grade = audit_data.get('grade', 'N/A')
+    summary = audit_data.get('summary', '')
+    bottom_line = audit_data.get('bottom_line', '')
+    competitive_insight = audit_data.get('competitive_insight', '')
+    
+    categories = audit_data.get('categories', {})
+    cred = categories.get('credibility_trust', {})
+    exp = categories.get('client_experience', {})
+    diff = categories.get('differentiation', {})
+    conv = categories.get('conversion_path', {})
+    
+    recommendations = audit_data.get('recommendations', [])
+    
+    score_color1, score_color2 = main.get_score_color(score)
+    
+    # Build recommendations HTML
+    recs_html = ""
+    for rec in recommendations[:3]:
+        priority = rec.get('priority', 'MEDIUM').upper()
+        priority_class = "high" if priority == "HIGH" else "medium"
+        badge_bg = "#FEE2E2" if priority == "HIGH" else "#FEF3C7"
+        badge_color = "#DC2626" if priority == "HIGH" else "#D97706"
+        border_color = "#EF4444" if priority == "HIGH" else "#F59E0B"
+        
+        recs_html += f'''
+            <div class="recommendation" style="border-left-color: {border_color};">
+                <span class="priority-badge" style="background: {badge_bg}; color: {badge_color};">{priority} Priority</span>
+                <h3>{rec.get('issue', '')}</h3>
+                <p><strong>Impact:</strong> {rec.get('impact', '')}</p>
+                <p class="action">→ {rec.get('recommendation', '')}</p>
+            </div>
+        '''
+    
+    html = f'''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Digital Presence Assessment - {business_name}</title>
+    <style>
+        * {{
+            margin: 0;
+            padding: 0;
+            box-sizing: border-box;
+        }}
+        body {{
+            font-family: system-ui, -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
+            background: #F8FAFC;
+            color: #0A1628;
+            line-height: 1.6;
+        }}
+        .container {{
+            max-width: 800px;
+            margin: 0 auto;
+            background: white;
+            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.05);
+        }}
+        
+        /* Header */
+        .header {{
+            background: linear-gradient(135deg, #0A1628 0%, #1a2942 100%);
+            color: white;
+            padding: 40px;
+            text-align: center;
+        }}
+        .header a {{
+            text-decoration: none;
+        }}
+        .logo {{
+            margin-bottom: 20px;
+            display: inline-block;
+        }}
+        .header h1 {{
+            font-size: 28px;
+            font-weight: 300;
+            margin-bottom: 8px;
+            color: white;
+        }}
+        .header .subtitle {{
+            font-size: 18px;
+            opacity: 0.9;
+        }}
+        .header .meta {{
+            margin-top: 16px;
+            font-size: 14px;
+            opacity: 0.7;
+        }}
+        
+        /* Executive Summary */
+        .executive-summary {{
+            padding: 40px;
+            display: flex;
+            gap: 40px;
+            align-items: center;
+            border-bottom: 1px solid #E2E8F0;
+        }}
+        .score-circle {{
+            width: 140px;
+            height: 140px;
+            border-radius: 50%;
+            background: linear-gradient(135deg, {score_color1} 0%, {score_color2} 100%);
+            display: flex;
+            flex-direction: column;
+            align-items: center;
+            justify-content: center;
+            color: white;
+            flex-shrink: 0;
+        }}
+        .score-circle .score {{
+            font-size: 48px;
+            font-weight: 700;
+            line-height: 1;
+        }}
+        .score-circle .grade {{
+            font-size: 24px;
+            font-weight: 600;
+            opacity: 0.9;
+        }}
+        .summary-text h2 {{
+            font-size: 14px;
+            text-transform: uppercase;
+            letter-spacing: 1px;
+            color: #64748B;
+            margin-bottom: 12px;
+        }}
+        .summary-text .summary {{
+            font-size: 18px;
+            font-weight: 600;
+            color: #0A1628;
+            margin-bottom: 16px;
+        }}
+        .summary-text .bottom-line {{
+            font-size: 15px;
+            color: #475569;
+        }}
+        
+        /* Assessment Breakdown */
+        .breakdown {{
+            padding: 40px;
+            background: #F8FAFC;
+        }}
+        .breakdown h2 {{
+            font-size: 20px;
+            font-weight: 700;
+            margin-bottom: 24px;
+            color: #0A1628;
+        }}
+        .category-grid {{
+            display: grid;
+            grid-template-columns: 1fr 1fr;
+            gap: 20px;
+        }}
+        .category-card {{
+            background: white;
+            border-radius: 12px;
+            padding: 24px;
+            box-shadow: 0 2px 4px rgba(0, 0, 0, 0.05);
+        }}
+        .category-card h3 {{
+            font-size: 16px;
+            font-weight: 600;
+            color: #0A1628;
+            margin-bottom: 12px;
+        }}
+        .score-bar {{
+            height: 8px;
+            background: #E2E8F0;
+            border-radius: 4px;
+            margin-bottom: 8px;
+            overflow: hidden;
+        }}
+        .score-bar-fill {{
+            height: 100%;
+            border-radius: 4px;
+            background: linear-gradient(90deg, #2563EB, #06B6D4);
+        }}
+        .score-label {{
+            font-size: 14px;
+            font-weight: 600;
+            color: #2563EB;
+            margin-bottom: 12px;
+        }}
+        .category-card h4 {{
+            font-size: 12px;
+            text-transform: uppercase;
+            letter-spacing: 0.5px;
+            color: #64748B;
+            margin-bottom: 4px;
+        }}
+        .category-card p {{
+            font-size: 14px;
+            color: #475569;
+            margin-bottom: 12px;
+        }}
+        
+        /* Recommendations */
+        .recommendations {{
+            padding: 40px;
+            border-bottom: 1px solid #E2E8F0;
+        }}
+        .recommendations h2 {{
+            font-size: 20px;
+            font-weight: 700;
+            margin-bottom: 24px;
+            color: #0A1628;
+        }}
+        .recommendation {{
+            background: #F8FAFC;
+            border-radius: 12px;
+            padding: 20px;
+            margin-bottom: 16px;
+            border-left: 4px solid #2563EB;
+        }}
+        .priority-badge {{
+            display: inline-block;
+            padding: 4px 12px;
+            border-radius: 20px;
+            font-size: 11px;
+            font-weight: 700;
+            text-transform: uppercase;
+            letter-spacing: 0.5px;
+            margin-bottom: 12px;
+        }}
+        .recommendation h3 {{
+            font-size: 16px;
+            font-weight: 600;
+            color: #0A1628;
+            margin-bottom: 8px;
+        }}
+        .recommendation p {{
+            font-size: 14px;
+            color: #475569;
+            margin-bottom: 8px;
+        }}
+        .recommendation .action {{
+            font-size: 14px;
+            color: #2563EB;
+            font-weight: 500;
+        }}
+        
+        /* Competitive Insight */
+        .competitive-insight {{
+            padding: 40px;
+            background: #EFF6FF;
+            border-left: 4px solid #2563EB;
+            margin: 0 40px 40px 40px;
+            border-radius: 0 12px 12px 0;
+        }}
+        .competitive-insight h2 {{
+            font-size: 16px;
+            font-weight: 700;
+            color: #1E40AF;
+            margin-bottom: 12px;
+        }}
+        .competitive-insight p {{
+            font-size: 15px;
+            color: #1E3A8A;
+            font-style: italic;
+        }}
+        
+        /* CTA Section */
+        .cta-section {{
+            background: #EFF6FF;
+            padding: 60px 40px;
+            text-align: center;
+        }}
+        .cta-section .logo {{
+            margin-bottom: 24px;
+        }}
+        .cta-section h2 {{
+            font-size: 28px;
+            font-weight: 700;
+            color: #0A1628;
+            margin-bottom: 12px;
+        }}
+        .cta-section .subtext {{
+            font-size: 16px;
+            color: #475569;
+            margin-bottom: 24px;
+            max-width: 500px;
+            margin-left: auto;
+            margin-right: auto;
+        }}
+        .cta-button {{
+            display: inline-block;
+            background: linear-gradient(135deg, #2563EB 0%, #06B6D4 100%);
+            color: white;
+            padding: 16px 32px;
+            border-radius: 8px;
+            text-decoration: none;
+            font-weight: 600;
+            font-size: 18px;
+            margin: 20px 0;
+        }}
+        .cta-meta {{
+            font-size: 14px;
+            color: #64748B;
+            margin-top: 16px;
+        }}
+        
+        /* Footer */
+        .footer {{
+            background: #0A1628;
+            color: white;
+            padding: 40px;
+            text-align: center;
+        }}
+        .footer a {{
+            text-decoration: none;
+        }}
+        .footer .logo {{
+            margin-bottom: 16px;
+        }}
+        .footer p {{
+            font-size: 14px;
+            opacity: 0.8;
+            margin-bottom: 8px;
+        }}
+        .footer .disclaimer {{
+            font-size: 12px;
+            opacity: 0.5;
+            margin-top: 20px;
+        }}
+        
+        @media (max-width: 600px) {{
+            .category-grid {{
+                grid-template-columns: 1fr;
+            }}
+            .executive-summary {{
+                flex-direction: column;
+                text-align: center;
+            }}
+        }}
+        
+        @media print {{
+            .container {{
+                box-shadow: none;
+            }}
+            .cta-button {{
+                background: #2563EB !important;
+                -webkit-print-color-adjust: exact;
+                print-color-adjust: exact;
+            }}
+        }}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <!-- Header -->
+        <header class="header">
+            <a href="https://www.nexli.net/#book" target="_blank" class="logo">
+                <svg viewBox="0 0 140 48" width="140" fill="none" xmlns="http://www.w3.org/2000/svg">
+                    <defs>
+                        <linearGradient id="logoGrad" x1="0%" y1="100%" x2="100%" y2="0%">
+                            <stop offset="0%" style="stop-color:#2563EB"/>
+                            <stop offset="100%" style="stop-color:#06B6D4"/>
+                        </linearGradient>
+                    </defs>
+                    <path d="M4 36L20 24L4 12L4 20L12 24L4 28L4 36Z" fill="#2563EB"/>
+                    <path d="M12 36L28 24L12 12L12 18L18 24L12 30L12 36Z" fill="url(#logoGrad)"/>
+                    <path d="M20 36L44 24L20 12L20 18L32 24L20 30L20 36Z" fill="#06B6D4"/>
+                    <text x="52" y="32" font-family="system-ui, -apple-system, sans-serif" font-size="24" font-weight="800" letter-spacing="-1" fill="white">Nexli</text>
+                </svg>
+            </a>
+            <h1>Digital Presence Assessment</h1>
+            <p class="subtitle">Prepared for <strong>{business_name}</strong></p>
+            <p class="meta"><strong>Website:</strong> {website_url} &nbsp;|&nbsp; <strong>Assessment Date:</strong> {assessment_date}</p>
+        </header>
+        
+        <!-- Executive Summary -->
+        <section class="executive-summary">
+            <div class="score-circle">
+                <span class="score">{score}</span>
+                <span class="grade">{grade}</span>
+            </div>
+            <div class="summary-text">
+                <h2>Executive Summary</h2>
+                <p class="summary">{summary}</p>
+                <p class="bottom-line">{bottom_line}</p>
+            </div>
+        </section>
+        
+        <!-- First Impression Notice -->
+        <div style="background: #FEF3C7; border-left: 4px solid #F59E0B; padding: 16px 24px; margin: 0 40px 0 40px;">
+            <p style="margin: 0; font-size: 14px; color: #92400E;"><strong>Why "Above the Fold" Matters:</strong> This assessment evaluates what visitors see in the first 3 seconds—before scrolling. Research shows most users decide to stay or leave within this window. If key trust signals, value propositions, or calls-to-action are buried below the fold, visitors may never see them. The best-performing websites put their most important content front and center.</p>
+        </div>
+        
+        <!-- Assessment Breakdown -->
+        <section class="breakdown">
+            <h2>Assessment Breakdown</h2>
+            <div class="category-grid">
+                <div class="category-card">
+                    <h3>Credibility & Trust</h3>
+                    <div class="score-bar"><div class="score-bar-fill" style="width: {cred.get('score', 0) * 4}%;"></div></div>
+                    <p class="score-label">{cred.get('score', 0)}/25</p>
+                    <h4>Current State</h4>
+                    <p>{cred.get('findings', '')}</p>
+                    <h4>Opportunity</h4>
+                    <p>{cred.get('opportunity', '')}</p>
+                </div>
+                <div class="category-card">
+                    <h3>Client Experience</h3>
+                    <div class="score-bar"><div class="score-bar-fill" style="width: {exp.get('score', 0) * 4}%;"></div></div>
+                    <p class="score-label">{exp.get('score', 0)}/25</p>
+                    <h4>Current State</h4>
+                    <p>{exp.get('findings', '')}</p>
+                    <h4>Opportunity</h4>
+                    <p>{exp.get('opportunity', '')}</p>
+                </div>
+                <div class="category-card">
+                    <h3>Differentiation</h3>
+                    <div class="score-bar"><div class="score-bar-fill" style="width: {diff.get('score', 0) * 4}%;"></div></div>
+                    <p class="score-label">{diff.get('score', 0)}/25</p>
+                    <h4>Current State</h4>
+                    <p>{diff.get('findings', '')}</p>
+                    <h4>Opportunity</h4>
+                    <p>{diff.get('opportunity', '')}</p>
+                </div>
+                <div class="category-card">
+                    <h3>Conversion Path</h3>
+                    <div class="score-bar"><div class="score-bar-fill" style="width: {conv.get('score', 0) * 4}%;"></div></div>
+                    <p class="score-label">{conv.get('score', 0)}/25</p>
+                    <h4>Current State</h4>
+                    <p>{conv.get('findings', '')}</p>
+                    <h4>Opportunity</h4>
+                    <p>{conv.get('opportunity', '')}</p>
+                </div>
+            </div>
+        </section>
+        
+        <!-- Strategic Recommendations -->
+        <section class="recommendations">
+            <h2>Strategic Recommendations</h2>
+            {recs_html}
+        </section>
+        
+        <!-- Competitive Insight -->
+        <div class="competitive-insight">
+            <h2>Competitive Insight</h2>
+            <p>{competitive_insight}</p>
+        </div>
+        
+        <!-- CTA Section -->
+        <section class="cta-section">
+            <a href="https://www.nexli.net/#book" target="_blank" class="logo">
+                <svg viewBox="0 0 140 48" width="140" fill="none" xmlns="http://www.w3.org/2000/svg">
+                    <defs>
+                        <linearGradient id="logoGrad2" x1="0%" y1="100%" x2="100%" y2="0%">
+                            <stop offset="0%" style="stop-color:#2563EB"/>
+                            <stop offset="100%" style="stop-color:#06B6D4"/>
+                        </linearGradient>
+                    </defs>
+                    <path d="M4 36L20 24L4 12L4 20L12 24L4 28L4 36Z" fill="#2563EB"/>
+                    <path d="M12 36L28 24L12 12L12 18L18 24L12 30L12 36Z" fill="url(#logoGrad2)"/>
+                    <path d="M20 36L44 24L20 12L20 18L32 24L20 30L20 36Z" fill="#06B6D4"/>
+                    <text x="52" y="32" font-family="system-ui, -apple-system, sans-serif" font-size="24" font-weight="800" letter-spacing="-1" fill="#0A1628">Nexli</text>
+                </svg>
+            </a>
+            <h2>Ready to Elevate Your Digital Presence?</h2>
+            <p class="subtext">Schedule a complimentary strategy session to discuss how these insights apply to your firm's growth goals.</p>
+            <a href="https://www.nexli.net/#book" target="_blank" class="cta-button">Book Your Strategy Call</a>
+            <p class="cta-meta">No obligation • 30-minute consultation • Tailored recommendations</p>
+        </section>
+        
+        <!-- Footer -->
+        <footer class="footer">
+            <a href="https://www.nexli.net/#book" target="_blank" class="logo">
+                <svg viewBox="0 0 48 48" width="48" fill="none" xmlns="http://www.w3.org/2000/svg">
+                    <path d="M4 36L20 24L4 12L4 20L12 24L4 28L4 36Z" fill="rgba(255,255,255,0.5)"/>
+                    <path d="M12 36L28 24L12 12L12 18L18 24L12 30L12 36Z" fill="rgba(255,255,255,0.75)"/>
+                    <path d="M20 36L44 24L20 12L20 18L32 24L20 30L20 36Z" fill="white"/>
+                </svg>
+            </a>
+            <p>Assessment powered by Nexli</p>
+            <p>Helping financial advisors attract and convert high-value clients</p>
+            <p class="disclaimer">This assessment is based on automated analysis and publicly visible website elements.</p>
+        </footer>
+    </div>
+</body>
+</html>'''
+    
+    return html
+
+
+def time_renderer(render, iterations):
+    """Mean render time in microseconds and the size of the last report (raw and gzipped)"""
+    args = (SAMPLE_AUDIT, "https://example-advisors.com", "Example Advisors", "January 01, 2026")
+    report = render(*args)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        report = render(*args)
+    elapsed = time.perf_counter() - started
+    raw = report.encode('utf-8')
+    return elapsed / iterations * 1_000_000, len(raw), len(gzip.compress(raw, compresslevel=9))
+
+
+def bench_render(iterations):
+    """Compare the original f-string renderer with the precompiled one, inline and with shared assets"""
+    results = [('legacy f-string', time_renderer(legacy_generate_html_template, iterations))]
+    
+    inline_shell = main._report_shell
+    results.append(('precompiled, inline assets', time_renderer(main.generate_html_template, iterations)))
+    
+    main.REPORT_SHARED_ASSETS = True
+    main._report_shell = main.compile_template(main.REPORT_SHELL, **main.report_static_slots())
+    try:
+        results.append(('precompiled, shared assets', time_renderer(main.generate_html_template, iterations)))
+    finally:
+        main.REPORT_SHARED_ASSETS = False
+        main._report_shell = inline_shell
+    
+    shared_bytes = sum(len(content.encode('utf-8')) for content, _ in main.REPORT_ASSETS.values())
+    print(f"{'renderer':<30} {'us/report':>10} {'bytes':>8} {'gzip':>7}")
+    for name, (micros, raw, gzipped) in results:
+        print(f"{name:<30} {micros:>10.1f} {raw:>8} {gzipped:>7}")
+    print(f"shared assets (fetched once per browser, cached): {shared_bytes} bytes")
+
+
+# (label, pixel budget, JPEG quality) - None keeps the capture as it came from ScreenshotOne
+PREPROCESS_SETTINGS = [
+    ('original', None, None),
+    ('1.15MP q85', 1150000, 85),
+    ('1.15MP q75', 1150000, 75),
+    ('1.15MP q60', 1150000, 60),
+    ('0.8MP q75', 800000, 75),
+    ('0.5MP q75', 500000, 75),
+    ('0.5MP q60', 500000, 60)
+]
+
+
+def peak_body_bytes(build):
+    """Peak memory allocated while building a request body"""
+    tracemalloc.start()
+    body = build()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del body
+    return peak
+
+
+def legacy_request_body(screenshot):
+    """How the request body was built before: base64 string, JSON string, then encoded bytes"""
+    screenshot_base64 = base64.b64encode(screenshot).decode('utf-8')
+    return json.dumps(main.build_analysis_request({'desktop': screenshot_base64})).encode('utf-8')
+
+
+def grade(screenshot, repeats):
+    """Overall scores and grades from grading a screenshot `repeats` times"""
+    results = []
+    for _ in range(repeats):
+        text, _ = main.analyze_with_claude({'desktop': screenshot})
+        audit, _ = main.finalize_audit(text)
+        results.append((audit.get('overall_score'), audit.get('grade')))
+    return results
+
+
+def bench_preprocess(paths, grade_images, repeats):
+    """Bytes, image tokens and encode time per preprocessing setting, optionally with score stability"""
+    if paths:
+        screenshots = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                screenshots.append(f.read())
+    else:
+        print("No screenshots given, using a synthetic 1920x1200 capture")
+        screenshots = [synthetic_screenshot()]
+    
+    rows = []
+    baselines = [grade(screenshot, repeats) for screenshot in screenshots] if grade_images else None
+    for label, max_pixels, quality in PREPROCESS_SETTINGS:
+        sizes, tokens, times, score_deltas, grade_matches = [], [], [], [], []
+        for index, screenshot in enumerate(screenshots):
+            started = time.perf_counter()
+            if max_pixels is None:
+                output = screenshot
+                with Image.open(io.BytesIO(screenshot)) as image:
+                    width, height = image.size
+            else:
+                output, details = main.preprocess_screenshot(screenshot, max_pixels, 10 ** 9, quality, quality)
+                width, height = details['width'], details['height']
+            times.append((time.perf_counter() - started) * 1000)
+            sizes.append(len(output))
+            tokens.append(main.estimate_image_tokens(width, height))
+            if grade_images:
+                baseline_scores = [score for score, _ in baselines[index]]
+                baseline_grade = statistics.mode(letter for _, letter in baselines[index])
+                graded = baselines[index] if max_pixels is None else grade(output, repeats)
+                score_deltas.append(abs(statistics.mean(score for score, _ in graded) - statistics.mean(baseline_scores)))
+                grade_matches.extend(letter == baseline_grade for _, letter in graded)
+        rows.append((label, statistics.mean(sizes), statistics.mean(tokens), statistics.mean(times),
+                     statistics.mean(score_deltas) if grade_images else None,
+                     sum(grade_matches) / len(grade_matches) if grade_images else None))
+    
+    print(f"{'setting':<12} {'bytes':>9} {'img tokens':>11} {'ms':>7} {'|d score|':>10} {'grade match':>12}")
+    for label, size, token_count, ms, delta, match in rows:
+        stability = f"{delta:>10.1f} {match:>12.0%}" if grade_images else f"{'-':>10} {'-':>12}"
+        print(f"{label:<12} {size:>9.0f} {token_count:>11.0f} {ms:>7.1f} {stability}")
+    if grade_images:
+        noise = statistics.mean(statistics.pstdev(score for score, _ in runs) for runs in baselines)
+        print(f"score noise of the original (stdev over {repeats} runs): {noise:.1f}")
+    
+    screenshot = screenshots[0]
+    images = {'desktop': screenshot}
+    legacy_peak = peak_body_bytes(lambda: legacy_request_body(screenshot))
+    new_peak = peak_body_bytes(lambda: b''.join(
+        main.json_with_screenshots(main.build_analysis_request(main.screenshot_placeholders(images)), images)
+    ))
+    print(f"request body build, peak allocation for a {len(screenshot)} byte capture: "
+          f"legacy {legacy_peak} bytes, now {new_peak} bytes")
+
+
+def process_tree_rss(root_pid):
+    """Resident memory of a process and all its descendants, in bytes (Linux /proc)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name can contain spaces, so split after its closing parenthesis
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    total = 0
+    pids = [root_pid]
+    while pids:
+        pid = pids.pop()
+        pids.extend(children.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler:
+    """Tracks the peak resident memory of the service (gunicorn master plus workers) in the background"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.supported = os.path.isdir('/proc')
+        threading.Thread(target=self.run, name='rss-sampler', daemon=True).start()
+
+    def run(self):
+        while self.supported:
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            time.sleep(self.interval)
+
+    def reset(self):
+        peak, self.peak = self.peak, 0
+        return peak if self.supported else None
+
+
+def percentile(values, q):
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def wait_until_up(url, process, timeout=30):
+    """Poll a URL until it answers, failing early if the process serving it exits"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args)} exited with status {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_load_services(args, workdir):
+    """Start the upstream stubs, the app (under gunicorn, as in the Procfile) and any queue workers as child processes"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    stubs_process = subprocess.Popen(
+        [sys.executable, 'stubs.py', 'all', '--batch-seconds', '5', '--anthropic', args.anthropic,
+         '--screenshotone', args.screenshotone, '--r2', args.r2, '--ghl', args.ghl],
+        cwd=here, stdout=subprocess.DEVNULL
+    )
+    wait_until_up(f"http://127.0.0.1:{STUB_PORTS['ghl']}/callbacks", stubs_process)
+    
+    # Tuning variables set in our environment (rate limits, concurrency...) pass through to the app
+    env = dict(os.environ, **stub_environment(),
+               JOB_DB_PATH=os.path.join(workdir, 'load.db'),
+               SCREENSHOT_CACHE_DIR=os.path.join(workdir, 'screenshots'),
+               ANALYSIS_CACHE_DIR=os.path.join(workdir, 'analysis'),
+               PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, 'metrics'),
+               PROFILE_DIR=os.path.join(workdir, 'profiles'))
+    if os.environ.get('REDIS_URL'):
+        # A fresh stream per run, so audits left over from an earlier run aren't picked up
+        env['QUEUE_PREFIX'] = f"bench{int(time.time())}"
+    log_path = os.path.join(workdir, 'service.log')
+    service_process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'main:app', '--bind', f'127.0.0.1:{args.port}',
+         '--workers', str(args.workers), '--worker-class', 'gthread', '--threads', '8'],
+        cwd=here, env=env, stdout=open(log_path, 'w'), stderr=subprocess.STDOUT
+    )
+    wait_until_up(f"http://127.0.0.1:{args.port}/health", service_process, timeout=60)
+    print(f"Service log: {log_path}")
+    
+    # Standalone workers, each with its own job store as if on another host
+    worker_processes = []
+    for index in range(args.queue_workers):
+        worker_env = dict(env, JOB_DB_PATH=os.path.join(workdir, f'worker{index}.db'),
+                          SCREENSHOT_CACHE_DIR=os.path.join(workdir, f'worker{index}-screenshots'),
+                          ANALYSIS_CACHE_DIR=os.path.join(workdir, f'worker{index}-analysis'))
+        worker_processes.append(subprocess.Popen(
+            [sys.executable, 'main.py', 'worker'], cwd=here, env=worker_env,
+            stdout=open(os.path.join(workdir, f'worker{index}.log'), 'w'), stderr=subprocess.STDOUT
+        ))
+    return stubs_process, service_process, worker_processes
+
+
+def drive_audits(service_url, rate, duration, label):
+    """Post audits open-loop at `rate` per second for `duration` seconds.
+
+    Returns {contact_id: time sent} for accepted audits and the count of responses per status.
+    """
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=64))
+    accepted = {}
+    statuses = {}
+    lock = threading.Lock()
+    
+    def post(index):
+        contact_id = f"{label}-{index}"
+        sent = time.time()
+        try:
+            response = session.post(f"{service_url}/audit", json={
+                'contact_id': contact_id,
+                'email': f"{contact_id}@example.com",
+                'website': f"https://{contact_id}.example.com"
+            }, timeout=30)
+            status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                accepted[contact_id] = sent
+    
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        for index in range(max(1, int(rate * duration))):
+            # Open loop: requests go out on schedule whether or not earlier ones have answered
+            delay = started + index / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(post, index)
+    return started, accepted, statuses
+
+
+def collect_callbacks(ghl_url, cursor, accepted, timeout):
+    """Read GHL callbacks until every accepted audit has reported back or the timeout passes.
+
+    Returns the first delivered callback per contact and the new read position.
+    """
+    results = {}
+    deadline = time.time() + timeout
+    while len(results) < len(accepted) and time.time() < deadline:
+        page = requests.get(f"{ghl_url}/callbacks", params={'since': cursor}, timeout=10).json()
+        cursor += len(page['callbacks'])
+        for callback in page['callbacks']:
+            # Deliveries the stub failed on purpose are retried by the app's callback sender
+            if callback['contact_id'] in accepted and callback['status'] == 200:
+                results.setdefault(callback['contact_id'], callback)
+        time.sleep(0.5)
+    return results, cursor
+
+
+def bench_load(args):
+    """Drive /audit at each target rate against local stubs: throughput, end-to-end latency and peak RSS"""
+    rates = [float(rate) for rate in args.rates.split(',')]
+    workdir = tempfile.mkdtemp(prefix='audit-load-')
+    if args.queue_workers and not os.environ.get('REDIS_URL'):
+        sys.exit("--queue-workers needs REDIS_URL set")
+    stubs_process, service_process, worker_processes = start_load_services(args, workdir)
+    service_url = f"http://127.0.0.1:{args.port}"
+    ghl_url = f"http://127.0.0.1:{STUB_PORTS['ghl']}"
+    sampler = RssSampler(service_process.pid)
+    cursor = 0
+    rows = []
+    try:
+        for rate in rates:
+            sampler.reset()
+            print(f"Driving {rate:g} audits/s for {args.duration}s...")
+            label = f"load{int(time.time())}-{rate:g}".replace('.', '_')
+            started, accepted, statuses = drive_audits(service_url, rate, args.duration, label)
+            results, cursor = collect_callbacks(ghl_url, cursor, accepted, args.drain_timeout)
+            succeeded = [callback for callback in results.values() if callback['success']]
+            latencies = [callback['received'] - accepted[callback['contact_id']] for callback in succeeded]
+            finished = max((callback['received'] for callback in succeeded), default=started)
+            rows.append({
+                'rate': rate,
+                'sent': sum(statuses.values()),
+                'accepted': len(accepted),
+                'rejected': sum(count for status, count in statuses.items() if status != 200),
+                'complete': len(succeeded),
+                'failed': len(results) - len(succeeded),
+                'lost': len(accepted) - len(results),
+                'jobs_per_sec': len(succeeded) / (finished - started) if succeeded else 0,
+                'latencies': latencies,
+                'peak_rss': sampler.reset()
+            })
+    finally:
+        for process in [service_process, *worker_processes]:
+            process.terminate()
+            process.wait()
+        stubs_process.terminate()
+        stubs_process.wait()
+    
+    print(f"{'rate/s':>7} {'sent':>6} {'accepted':>9} {'rejected':>9} {'complete':>9} {'failed':>7} {'lost':>5} "
+          f"{'jobs/s':>7} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'peak RSS MB':>12}")
+    for row in rows:
+        latencies = row['latencies']
+        quantiles = [f"{percentile(latencies, q):>7.1f}" if latencies else f"{'-':>7}" for q in (50, 95, 99)]
+        rss = f"{row['peak_rss'] / 1024 / 1024:>12.0f}" if row['peak_rss'] else f"{'-':>12}"
+        print(f"{row['rate']:>7g} {row['sent']:>6} {row['accepted']:>9} {row['rejected']:>9} {row['complete']:>9} "
+              f"{row['failed']:>7} {row['lost']:>5} {row['jobs_per_sec']:>7.2f} {' '.join(quantiles)} {rss}")
+
+
+def capture_params(viewport):
+    """What take_screenshot() passes a backend for a viewport"""
+    return {**main.VIEWPORTS[viewport]['params'], **main.SCREENSHOT_PARAMS}
+
+
+def bench_capture(args):
+    """Capture latency, throughput and memory per screenshot backend and concurrency level.
+
+    Captures go straight to the backends (no screenshot cache), cycling through the URLs and viewports.
+    """
+    urls = args.urls
+    server = None
+    if not urls:
+        server = serve(create_pages_stub(parse_faults(args.pages)), STUB_PORTS['pages'])
+        urls = [f"http://127.0.0.1:{STUB_PORTS['pages']}/page/{index}" for index in range(10)]
+    viewports = args.viewports.split(',')
+    concurrency_levels = [int(level) for level in args.concurrency.split(',')]
+    sampler = RssSampler(os.getpid())
+    rows = []
+    backend_stats = []
+    try:
+        for name in args.backends.split(','):
+            if name == 'screenshotone' and not args.urls:
+                print("Note: the hosted ScreenshotOne API can't reach the local test pages - pass public --urls")
+            try:
+                backend = main.SCREENSHOT_BACKENDS[name]()
+            except ImportError as e:
+                print(f"Skipping {name}: {e}")
+                continue
+            try:
+                # The first capture pays for launching the browser or opening the connection
+                started = time.perf_counter()
+                try:
+                    backend.capture(urls[0], capture_params(viewports[0]))
+                except Exception as e:
+                    print(f"Skipping {name}: first capture failed - {e}")
+                    continue
+                cold = time.perf_counter() - started
+                for concurrency in concurrency_levels:
+                    sampler.reset()
+                    latencies = []
+                    errors = {}
+                    lock = threading.Lock()
+                    
+                    def capture(index):
+                        started = time.perf_counter()
+                        try:
+                            backend.capture(urls[index % len(urls)], capture_params(viewports[index % len(viewports)]))
+                        except Exception as e:
+                            with lock:
+                                status = main.error_status(e)
+                                errors[status] = errors.get(status, 0) + 1
+                            return
+                        with lock:
+                            latencies.append(time.perf_counter() - started)
+                    
+                    started = time.perf_counter()
+                    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                        list(executor.map(capture, range(args.captures)))
+                    rows.append({
+                        'backend': name,
+                        'concurrency': concurrency,
+                        'ok': len(latencies),
+                        'errors': errors,
+                        'cold': cold,
+                        'latencies': latencies,
+                        'per_sec': len(latencies) / (time.perf_counter() - started),
+                        'peak_rss': sampler.reset()
+                    })
+                backend_stats.append(backend.stats())
+            finally:
+                backend.close()
+    finally:
+        if server is not None:
+            server.shutdown()
+    
+    print(f"{'backend':<14} {'conc':>5} {'ok':>5} {'errors':>7} {'cold s':>7} {'p50 ms':>7} {'p95 ms':>7} "
+          f"{'captures/s':>11} {'peak RSS MB':>12}")
+    for row in rows:
+        latencies = row['latencies']
+        quantiles = [f"{percentile(latencies, q) * 1000:>7.0f}" if latencies else f"{'-':>7}" for q in (50, 95)]
+        rss = f"{row['peak_rss'] / 1024 / 1024:>12.0f}" if row['peak_rss'] else f"{'-':>12}"
+        print(f"{row['backend']:<14} {row['concurrency']:>5} {row['ok']:>5} {sum(row['errors'].values()):>7} "
+              f"{row['cold']:>7.2f} {' '.join(quantiles)} {row['per_sec']:>11.2f} {rss}")
+    for row in rows:
+        if row['errors']:
+            print(f"{row['backend']} at concurrency {row['concurrency']} errors: {row['errors']}")
+    for stats in backend_stats:
+        print(json.dumps(stats))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    render_parser = subparsers.add_parser('render', help='report render time and bytes per report')
+    render_parser.add_argument('--iterations', type=int, default=2000)
+    
+    preprocess_parser = subparsers.add_parser('preprocess', help='image bytes, tokens and score stability per setting')
+    preprocess_parser.add_argument('screenshots', nargs='*', help='JPEG/PNG captures (defaults to a synthetic one)')
+    preprocess_parser.add_argument('--grade', action='store_true',
+                                   help='also grade every variant through ANTHROPIC_API_URL and compare scores')
+    preprocess_parser.add_argument('--repeats', type=int, default=3, help='gradings per image and setting')
+    
+    load_parser = subparsers.add_parser('load', help='throughput, latency and memory under load, against local stubs')
+    load_parser.add_argument('--rates', default='1,2,4', help='comma-separated audits per second, run in turn')
+    load_parser.add_argument('--duration', type=float, default=30, help='seconds to send audits at each rate')
+    load_parser.add_argument('--drain-timeout', type=float, default=300,
+                             help='seconds to wait for callbacks after the last audit is sent')
+    load_parser.add_argument('--workers', type=int, default=1, help='gunicorn worker processes')
+    load_parser.add_argument('--queue-workers', type=int, default=0,
+                             help='standalone `main.py worker` processes on the shared queue (needs REDIS_URL)')
+    load_parser.add_argument('--port', type=int, default=8900)
+    for name, default in [('anthropic', '6:0.3'), ('screenshotone', '3:0.4'), ('r2', '0.08:0.5'), ('ghl', '0.15:0.5')]:
+        load_parser.add_argument(f'--{name}', default=default,
+                                 help=f'{name} stub latency[:jitter[:error_rate[:throttle_rate]]] (default {default})')
+    
+    capture_parser = subparsers.add_parser('capture', help='capture latency and throughput per screenshot backend')
+    capture_parser.add_argument('--backends', default='browser', help='comma-separated: browser, screenshotone')
+    capture_parser.add_argument('--concurrency', default='1,4,8', help='comma-separated captures in flight, run in turn')
+    capture_parser.add_argument('--captures', type=int, default=40, help='captures per concurrency level')
+    capture_parser.add_argument('--viewports', default=','.join(main.SCREENSHOT_VIEWPORTS))
+    capture_parser.add_argument('--urls', nargs='*', help='pages to capture (defaults to local test pages)')
+    capture_parser.add_argument('--pages', default='0.05:0.5',
+                                help='test page server latency[:jitter[:error_rate[:throttle_rate]]] (default 0.05:0.5)')
+    
+    args = parser.parse_args()
+    if args.command == 'render':
+        bench_render(args.iterations)
+    elif args.command == 'preprocess':
+        bench_preprocess(args.screenshots, args.grade, args.repeats)
+    elif args.command == 'load':
+        bench_load(args)
+    elif args.command == 'capture':
+        bench_capture(args)
+
+
+if __name__ == '__main__':
+    main_cli()
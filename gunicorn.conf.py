@@ -0,0 +1,25 @@
+"""Gunicorn settings, picked up automatically from the working directory"""
+import os
+import shutil
+
+# Every worker writes its Prometheus samples here so /metrics can add them up. This has to be
+# set before prometheus_client is imported anywhere, which is why it lives here.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/brand-audit-metrics')
+
+
+def on_starting(server):
+    # Samples left over from a previous run would be merged into this one
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def post_worker_init(worker):
+    # Importing main starts nothing, so start each worker's pipeline here - audits left unfinished
+    # by a previous process resume as soon as it boots, not on its first request
+    import main
+    main.start_workers()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
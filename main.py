@@ -1,13 +1,42 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 import requests
+from requests.adapters import HTTPAdapter
 import base64
 import os
+import sys
 import boto3
+import redis
 from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from PIL import Image
+from prometheus_client import (Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest,
+                               CONTENT_TYPE_LATEST, multiprocess)
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import json
+import sqlite3
+import socket
+import time
+import hashlib
+import gzip
+import html
+import string
+import textwrap
+import csv
+import io
+import argparse
+import contextlib
+import contextvars
+import random
+import functools
+import hmac
+import math
+import re
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 app = Flask(__name__)
 
@@ -21,74 +50,196 @@ R2_SECRET_ACCESS_KEY = os.environ.get('R2_SECRET_ACCESS_KEY')
 R2_ENDPOINT = os.environ.get('R2_ENDPOINT')
 R2_BUCKET_NAME = os.environ.get('R2_BUCKET_NAME')
 R2_PUBLIC_URL = os.environ.get('R2_PUBLIC_URL')
+# Report filenames are unique per job, so they can be cached for as long as the CDN likes
+R2_CACHE_CONTROL = os.environ.get('R2_CACHE_CONTROL', 'public, max-age=31536000, immutable')
+# Link reports to one shared, versioned stylesheet and logo set on R2 instead of inlining them
+REPORT_SHARED_ASSETS = os.environ.get('REPORT_SHARED_ASSETS', 'false').lower() == 'true'
 
 # GHL Webhook URL for sending results back
 GHL_WEBHOOK_URL = os.environ.get('GHL_WEBHOOK_URL')
 
+# GHL callback outbox - callbacks are written to the job store and delivered by a background sender,
+# so a slow or unreachable webhook never holds an audit worker and a failed delivery is retried
+GHL_CALLBACK_CONCURRENCY = int(os.environ.get('GHL_CALLBACK_CONCURRENCY', 4))
+GHL_CALLBACK_BATCH_SIZE = int(os.environ.get('GHL_CALLBACK_BATCH_SIZE', 1))
+GHL_CALLBACK_TIMEOUT = int(os.environ.get('GHL_CALLBACK_TIMEOUT', 30))
+GHL_CALLBACK_MAX_ATTEMPTS = int(os.environ.get('GHL_CALLBACK_MAX_ATTEMPTS', 10))
+GHL_CALLBACK_RETRY_BASE = float(os.environ.get('GHL_CALLBACK_RETRY_BASE', 5))
+GHL_CALLBACK_RETRY_MAX = float(os.environ.get('GHL_CALLBACK_RETRY_MAX', 900))
+GHL_OUTBOX_RETENTION = int(os.environ.get('GHL_OUTBOX_RETENTION', 7 * 24 * 60 * 60))
 
-def get_grading_prompt(firm_type=None):
-    """Get the appropriate grading prompt based on firm type"""
-    
-    base_prompt = """You are a brutally honest website and brand auditor for financial professionals. Analyze this website screenshot and score it out of 100 based on these four categories:
+# ScreenshotOne capture endpoint - point it at a local stub (python stubs.py screenshotone) to run offline
+SCREENSHOT_API_URL = os.environ.get('SCREENSHOT_API_URL', 'https://api.screenshotone.com/take')
 
-1. CREDIBILITY & TRUST (25 pts) - Does it look like a legitimate firm? Professional photos, credentials displayed, testimonials, trust badges, compliance disclosures
-2. CLIENT EXPERIENCE (25 pts) - Mobile responsiveness, page speed indicators, navigation clarity, readability, modern design
-3. DIFFERENTIATION (25 pts) - Clear value proposition, unique positioning, target client defined, what makes them different from 10,000 other advisors
-4. CONVERSION PATH (25 pts) - Clear CTAs, easy contact options, booking capability, lead capture forms, next steps obvious
+# Anthropic API base URL - point it at a local stub (python stubs.py anthropic) to run offline
+ANTHROPIC_API_URL = os.environ.get('ANTHROPIC_API_URL', 'https://api.anthropic.com').rstrip('/')
 
-SCORING GUIDELINES - BE HARSH:
-- 90-100: A (Exceptional - rare, truly outstanding)
-- 80-89: B (Good - above average, minor improvements needed)
-- 70-79: C (Average - meets basic standards but nothing special)
-- 60-69: D (Below Average - significant issues hurting conversions)
-- Below 60: F (Failing - major problems, site is hurting the business)
+# Message Batches - batch audits can grade screenshots through the Message Batches API instead,
+# trading latency (results can take hours) for throughput and half-price tokens
+BATCH_ANALYSIS_MODE = os.environ.get('BATCH_ANALYSIS_MODE', 'realtime')
+MESSAGE_BATCH_MAX_REQUESTS = int(os.environ.get('MESSAGE_BATCH_MAX_REQUESTS', 100))
+MESSAGE_BATCH_WINDOW = float(os.environ.get('MESSAGE_BATCH_WINDOW', 30))
+MESSAGE_BATCH_POLL_SECONDS = float(os.environ.get('MESSAGE_BATCH_POLL_SECONDS', 60))
 
-IMPORTANT: The letter grade MUST match the score:
-- Score 52 = Grade F
-- Score 67 = Grade D
-- Score 73 = Grade C
-- Score 85 = Grade B
-- Score 92 = Grade A
+# Streaming analysis - read Claude's answer as it is generated, give up early on output that isn't
+# the audit JSON, and carry on as soon as the JSON object is complete
+ANALYSIS_STREAMING = os.environ.get('ANALYSIS_STREAMING', 'true').lower() == 'true'
+ANALYSIS_FORMAT_RETRIES = int(os.environ.get('ANALYSIS_FORMAT_RETRIES', 1))
 
-Most financial advisor websites should score between 45-65. A score above 70 should be RARE."""
+# Audit repair - malformed model output is fixed without redoing the vision call: deterministic fixes
+# first, then (if needed) a cheap text-only call that gets the output and the list of problems
+ANALYSIS_REPAIR_CALLS = os.environ.get('ANALYSIS_REPAIR_CALLS', 'true').lower() == 'true'
+ANALYSIS_REPAIR_MODEL = os.environ.get('ANALYSIS_REPAIR_MODEL', 'claude-3-5-haiku-20241022')
 
-    if firm_type == "CPA Firm":
-        base_prompt += """
+# Audit pipeline - per-stage concurrency limits and the maximum number of jobs in flight
+AUDIT_WORKERS = int(os.environ.get('AUDIT_WORKERS', 4))
+AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 200))
+STAGE_CONCURRENCY = {
+    'screenshot': int(os.environ.get('SCREENSHOT_CONCURRENCY', AUDIT_WORKERS)),
+    'preprocess': int(os.environ.get('PREPROCESS_CONCURRENCY', 2)),
+    'analysis': int(os.environ.get('ANALYSIS_CONCURRENCY', AUDIT_WORKERS)),
+    'render': int(os.environ.get('RENDER_CONCURRENCY', 2)),
+    'upload': int(os.environ.get('UPLOAD_CONCURRENCY', AUDIT_WORKERS)),
+    'callback': int(os.environ.get('CALLBACK_CONCURRENCY', AUDIT_WORKERS))
+}
 
-IMPORTANT: This is a CPA FIRM website. Apply these industry-specific criteria:
-- Tax/accounting services should be clearly listed
-- Credentials (CPA, EA) should be prominently displayed
-- Client portal access is expected
-- Tax deadline reminders or resources add value
-- Trust signals like BBB, professional associations matter
-- Testimonials from business clients are valuable"""
+# Viewports - every audit captures these at once and sends all of them to Claude in one request.
+# FIRM_TYPE_VIEWPORTS overrides the set per firm type, as JSON: {"CPA Firm": ["desktop"]}
+VIEWPORTS = {
+    'desktop': {'label': 'Desktop', 'params': {"viewport_width": 1280, "viewport_height": 800, "device_scale_factor": 1}},
+    'mobile': {'label': 'Mobile', 'params': {"viewport_width": 390, "viewport_height": 844, "device_scale_factor": 1,
+                                             "viewport_mobile": True, "viewport_has_touch": True}}
+}
+SCREENSHOT_VIEWPORTS = tuple(name.strip() for name in os.environ.get('SCREENSHOT_VIEWPORTS', 'desktop,mobile').split(',')
+                             if name.strip() in VIEWPORTS)
+FIRM_TYPE_VIEWPORTS = {firm_type: tuple(name for name in names if name in VIEWPORTS)
+                       for firm_type, names in json.loads(os.environ.get('FIRM_TYPE_VIEWPORTS') or '{}').items()}
+MAX_VIEWPORTS = max(len(names) for names in [SCREENSHOT_VIEWPORTS, *FIRM_TYPE_VIEWPORTS.values()])
 
-    elif firm_type == "Wealth Management":
-        base_prompt += """
+# Screenshot backend - 'screenshotone' (hosted API) or 'browser', a local headless Chromium through
+# Playwright (pip install playwright && playwright install chromium). The browser backend keeps a warm
+# pool of browser contexts, each reused across jobs and closed after BROWSER_RECYCLE_PAGES pages.
+SCREENSHOT_BACKEND = os.environ.get('SCREENSHOT_BACKEND', 'screenshotone')
+BROWSER_POOL_SIZE = int(os.environ.get('BROWSER_POOL_SIZE', STAGE_CONCURRENCY['screenshot'] * MAX_VIEWPORTS))
+BROWSER_RECYCLE_PAGES = int(os.environ.get('BROWSER_RECYCLE_PAGES', 50))
+BROWSER_PAGE_TIMEOUT = float(os.environ.get('BROWSER_PAGE_TIMEOUT', 30))
+BROWSER_EXECUTABLE_PATH = os.environ.get('BROWSER_EXECUTABLE_PATH')  # a system Chromium instead of Playwright's own
 
-IMPORTANT: This is a WEALTH MANAGEMENT firm website. Apply these industry-specific criteria:
-- Investment philosophy should be clear
-- AUM or client minimums help qualify visitors
-- Fiduciary status should be prominently stated
-- SEC/FINRA disclosures must be present
-- Team credentials (CFP, CFA) should be visible
-- Client success stories or case studies add credibility"""
+# Admission control - /audit answers 429 with Retry-After instead of accepting work the pipeline
+# can't get through in time. The last ADMISSION_RESERVED_SLOTS of AUDIT_QUEUE_SIZE are kept for
+# priority contacts (a "priority" field in the webhook, or one of ADMISSION_PRIORITY_TAGS).
+ADMISSION_RESERVED_SLOTS = int(os.environ.get('ADMISSION_RESERVED_SLOTS', 10))
+ADMISSION_MAX_QUEUE_DEPTH = int(os.environ.get('ADMISSION_MAX_QUEUE_DEPTH', 150))
+ADMISSION_MAX_DRAIN_SECONDS = int(os.environ.get('ADMISSION_MAX_DRAIN_SECONDS', 600))
+ADMISSION_MAX_RETRY_AFTER = int(os.environ.get('ADMISSION_MAX_RETRY_AFTER', 300))
+ADMISSION_PRIORITY_TAGS = {tag.strip().lower() for tag in os.environ.get('ADMISSION_PRIORITY_TAGS', 'priority,vip').split(',')
+                           if tag.strip()}
 
-    elif firm_type == "Financial Advisor":
-        base_prompt += """
+# Shared queue - with REDIS_URL set (any Redis-protocol server), audits go onto a Redis stream that
+# worker processes on any host pull from: the web processes (unless QUEUE_CONSUME=false) and
+# `python main.py worker`. A worker's lease on a job is renewed every QUEUE_HEARTBEAT_SECONDS; a job
+# whose worker goes quiet for QUEUE_VISIBILITY_TIMEOUT is redelivered, and one delivered
+# QUEUE_MAX_DELIVERIES times without a result is dead-lettered and failed. AUDIT_QUEUE_SIZE then
+# bounds the shared queue rather than each process.
+REDIS_URL = os.environ.get('REDIS_URL')
+QUEUE_PREFIX = os.environ.get('QUEUE_PREFIX', 'audit')
+QUEUE_CONSUME = os.environ.get('QUEUE_CONSUME', 'true').lower() == 'true'
+QUEUE_PREFETCH = int(os.environ.get('QUEUE_PREFETCH', 2 * max(STAGE_CONCURRENCY.values())))
+QUEUE_VISIBILITY_TIMEOUT = int(os.environ.get('QUEUE_VISIBILITY_TIMEOUT', 120))
+QUEUE_HEARTBEAT_SECONDS = float(os.environ.get('QUEUE_HEARTBEAT_SECONDS', 20))
+QUEUE_MAX_DELIVERIES = int(os.environ.get('QUEUE_MAX_DELIVERIES', 5))
+QUEUE_STATE_TTL = int(os.environ.get('QUEUE_STATE_TTL', 7 * 24 * 60 * 60))
 
-IMPORTANT: This is a FINANCIAL ADVISOR website. Apply these industry-specific criteria:
-- Services offered should be clearly defined
-- Fee structure transparency is valuable
-- Credentials (CFP, ChFC) should be displayed
-- Target client type should be evident
-- Compliance disclosures are required
-- Personal brand/story helps build trust"""
+# Batch audits - bulk prospect lists fed into the worker pool a few at a time
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', AUDIT_WORKERS))
+BATCH_MAX_CONTACTS = int(os.environ.get('BATCH_MAX_CONTACTS', 10000))
+
+# HTTP connection pools - one keep-alive session per upstream, sized to the worker count
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', max(*STAGE_CONCURRENCY.values(),
+                                                                  STAGE_CONCURRENCY['screenshot'] * MAX_VIEWPORTS)))
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', 4))
+
+# Rate limits - requests per second allowed to each upstream; concurrency adapts to throttling.
+# With REDIS_URL set the rates hold across every process and host; without it, each process gets the full rate.
+SCREENSHOT_RATE_LIMIT = float(os.environ.get('SCREENSHOT_RATE_LIMIT', 5))
+ANTHROPIC_RATE_LIMIT = float(os.environ.get('ANTHROPIC_RATE_LIMIT', 2))
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get('RATE_LIMIT_MAX_RETRIES', 5))
+RATE_LIMIT_MAX_WAIT = int(os.environ.get('RATE_LIMIT_MAX_WAIT', 120))
 
-    base_prompt += """
+# Retries and circuit breakers - transient upstream errors are retried with jittered backoff;
+# a breaker per upstream fails fast while a provider is down and the job is parked for replay
+STAGE_MAX_RETRIES = int(os.environ.get('STAGE_MAX_RETRIES', 3))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 30))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_SECONDS = int(os.environ.get('BREAKER_RESET_SECONDS', 60))
+JOB_PARK_SECONDS = int(os.environ.get('JOB_PARK_SECONDS', 300))
+JOB_MAX_PARKS = int(os.environ.get('JOB_MAX_PARKS', 6))
 
-Return ONLY valid JSON in this exact format:
-{
+# Screenshot preprocessing - downscale and recompress captures before analysis to cut image tokens
+# and upload time. Claude shrinks anything over ~1.15 megapixels itself, so extra pixels buy nothing.
+PREPROCESS_SCREENSHOTS = os.environ.get('PREPROCESS_SCREENSHOTS', 'true').lower() == 'true'
+SCREENSHOT_MAX_PIXELS = int(os.environ.get('SCREENSHOT_MAX_PIXELS', 1150000))
+SCREENSHOT_MAX_BYTES = int(os.environ.get('SCREENSHOT_MAX_BYTES', 300000))
+SCREENSHOT_JPEG_QUALITY = int(os.environ.get('SCREENSHOT_JPEG_QUALITY', 75))
+SCREENSHOT_MIN_JPEG_QUALITY = int(os.environ.get('SCREENSHOT_MIN_JPEG_QUALITY', 40))
+
+# Job store - SQLite file holding every accepted audit and its per-stage progress
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', 'audit_jobs.db')
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 60))
+
+# Screenshot cache - reuse recent captures of the same URL instead of calling ScreenshotOne
+SCREENSHOT_CACHE_DIR = os.environ.get('SCREENSHOT_CACHE_DIR', 'cache/screenshots')
+SCREENSHOT_CACHE_TTL = int(os.environ.get('SCREENSHOT_CACHE_TTL', 6 * 60 * 60))
+SCREENSHOT_CACHE_MAX_MB = int(os.environ.get('SCREENSHOT_CACHE_MAX_MB', 500))
+
+# Analysis cache - reuse the parsed audit when the screenshot, firm type and prompt are unchanged
+ANALYSIS_CACHE_DIR = os.environ.get('ANALYSIS_CACHE_DIR', 'cache/analysis')
+ANALYSIS_CACHE_TTL = int(os.environ.get('ANALYSIS_CACHE_TTL', 30 * 24 * 60 * 60))
+ANALYSIS_CACHE_MAX_MB = int(os.environ.get('ANALYSIS_CACHE_MAX_MB', 50))
+
+# Tracing - every stage of a job logs one JSON span line (job ID, start/end time, sizes, upstream statuses)
+TRACE_LOGS = os.environ.get('TRACE_LOGS', 'true').lower() == 'true'
+
+# Profiling - a share of jobs is stack-sampled while its stages run and the samples are written as
+# folded stacks (flamegraph.pl / speedscope input), one file per job. The rate can be changed at
+# runtime with POST /debug/profiler, which is only enabled when DEBUG_TOKEN is set.
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+DEBUG_TOKEN = os.environ.get('DEBUG_TOKEN')
+SETTINGS_CACHE_SECONDS = int(os.environ.get('SETTINGS_CACHE_SECONDS', 5))
+
+
+# Prometheus metrics. Under gunicorn, PROMETHEUS_MULTIPROC_DIR (set in gunicorn.conf.py) makes every
+# worker process write its samples there, and /metrics aggregates them.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 300)
+STAGE_DURATION = Histogram('audit_stage_duration_seconds', 'Time spent running each pipeline stage',
+                           ['stage'], buckets=LATENCY_BUCKETS)
+JSON_PARSE_DURATION = Histogram('audit_json_parse_duration_seconds',
+                                'Time spent parsing, fixing and validating model output (part of analysis)',
+                                buckets=LATENCY_BUCKETS)
+GHL_CALLBACK_DURATION = Histogram('audit_ghl_callback_duration_seconds',
+                                  'Time for each GHL webhook POST, failed ones included (the callback stage '
+                                  'only writes the outbox)', buckets=LATENCY_BUCKETS)
+STAGE_ERRORS = Counter('audit_stage_errors_total', 'Stage runs that raised', ['stage'])
+UPSTREAM_ERRORS = Counter('upstream_errors_total', 'Failed or throttled upstream calls', ['upstream', 'status'])
+JOBS_IN_FLIGHT = Gauge('audit_jobs_in_flight', 'Audits in the pipeline, waiting or running',
+                       multiprocess_mode='livesum')
+QUEUE_DEPTH = Gauge('audit_queue_depth', 'Audits in the pipeline waiting for a stage slot',
+                    multiprocess_mode='livesum')
+STAGE_JOBS = Gauge('audit_stage_jobs', 'Audits waiting for or running in each stage', ['stage', 'state'],
+                   multiprocess_mode='livesum')
+JOBS_FINISHED = Counter('audit_jobs_finished_total', 'Audits that left the pipeline, by outcome', ['status'])
+GHL_CALLBACKS = Counter('ghl_callbacks_total', 'GHL callbacks by delivery outcome (sent, retried, dead)', ['outcome'])
+AUDIT_REJECTIONS = Counter('audit_admission_rejections_total', 'Audits turned away with a 429, by reason', ['reason'])
+QUEUE_EVENTS = Counter('audit_queue_events_total',
+                       'Shared queue events (published, pulled, redelivered, dead_lettered, lease_lost, applied)', ['event'])
+
+
+# The audit JSON the report template is filled from (also shown to the repair call)
+AUDIT_JSON_FORMAT = """{
     "overall_score": 52,
     "grade": "F",
     "categories": {
@@ -137,6 +288,95 @@ Return ONLY valid JSON in this exact format:
     "summary": "One sentence summary of the site's biggest weakness",
     "bottom_line": "2-3 sentences summarizing the site's current effectiveness at converting high-value prospects, framed as opportunity rather than criticism. End with a forward-looking statement."
 }"""
+
+
+def audit_json_format(viewports=('desktop',)):
+    """AUDIT_JSON_FORMAT, plus a "viewports" object when more than the desktop view is graded"""
+    if viewports == ('desktop',):
+        return AUDIT_JSON_FORMAT
+    entries = ',\n'.join(f"""        "{name}": {{
+            "findings": "What works and what doesn't in the {VIEWPORTS[name]['label'].lower()} view",
+            "opportunity": "Specific improvement for this view"
+        }}""" for name in viewports)
+    # Insert before the closing brace of the top-level object
+    return AUDIT_JSON_FORMAT[:-2] + ',\n    "viewports": {\n' + entries + '\n    }\n}'
+
+
+def viewports_for(firm_type):
+    """The viewports captured for a firm type"""
+    return FIRM_TYPE_VIEWPORTS.get(firm_type) or SCREENSHOT_VIEWPORTS
+
+
+@functools.lru_cache(maxsize=None)
+def get_grading_prompt(firm_type=None, viewports=('desktop',)):
+    """Get the appropriate grading prompt based on firm type and captured viewports (built once per combination)"""
+    
+    base_prompt = """You are a brutally honest website and brand auditor for financial professionals. Analyze this website screenshot and score it out of 100 based on these four categories:
+
+1. CREDIBILITY & TRUST (25 pts) - Does it look like a legitimate firm? Professional photos, credentials displayed, testimonials, trust badges, compliance disclosures
+2. CLIENT EXPERIENCE (25 pts) - Mobile responsiveness, page speed indicators, navigation clarity, readability, modern design
+3. DIFFERENTIATION (25 pts) - Clear value proposition, unique positioning, target client defined, what makes them different from 10,000 other advisors
+4. CONVERSION PATH (25 pts) - Clear CTAs, easy contact options, booking capability, lead capture forms, next steps obvious
+
+SCORING GUIDELINES - BE HARSH:
+- 90-100: A (Exceptional - rare, truly outstanding)
+- 80-89: B (Good - above average, minor improvements needed)
+- 70-79: C (Average - meets basic standards but nothing special)
+- 60-69: D (Below Average - significant issues hurting conversions)
+- Below 60: F (Failing - major problems, site is hurting the business)
+
+IMPORTANT: The letter grade MUST match the score:
+- Score 52 = Grade F
+- Score 67 = Grade D
+- Score 73 = Grade C
+- Score 85 = Grade B
+- Score 92 = Grade A
+
+Most financial advisor websites should score between 45-65. A score above 70 should be RARE."""
+
+    if firm_type == "CPA Firm":
+        base_prompt += """
+
+IMPORTANT: This is a CPA FIRM website. Apply these industry-specific criteria:
+- Tax/accounting services should be clearly listed
+- Credentials (CPA, EA) should be prominently displayed
+- Client portal access is expected
+- Tax deadline reminders or resources add value
+- Trust signals like BBB, professional associations matter
+- Testimonials from business clients are valuable"""
+
+    elif firm_type == "Wealth Management":
+        base_prompt += """
+
+IMPORTANT: This is a WEALTH MANAGEMENT firm website. Apply these industry-specific criteria:
+- Investment philosophy should be clear
+- AUM or client minimums help qualify visitors
+- Fiduciary status should be prominently stated
+- SEC/FINRA disclosures must be present
+- Team credentials (CFP, CFA) should be visible
+- Client success stories or case studies add credibility"""
+
+    elif firm_type == "Financial Advisor":
+        base_prompt += """
+
+IMPORTANT: This is a FINANCIAL ADVISOR website. Apply these industry-specific criteria:
+- Services offered should be clearly defined
+- Fee structure transparency is valuable
+- Credentials (CFP, ChFC) should be displayed
+- Target client type should be evident
+- Compliance disclosures are required
+- Personal brand/story helps build trust"""
+
+    if viewports != ('desktop',):
+        views = ', '.join(
+            f"{VIEWPORTS[name]['label']} ({VIEWPORTS[name]['params']['viewport_width']}x"
+            f"{VIEWPORTS[name]['params']['viewport_height']})" for name in viewports
+        )
+        base_prompt += f"""
+
+You get one screenshot per viewport: {views}. Score the four categories for the site as a whole, judging mobile responsiveness from the mobile screenshot itself rather than guessing from the desktop layout. In "viewports", say what each view gets right and wrong."""
+
+    base_prompt += "\n\nReturn ONLY valid JSON in this exact format:\n" + audit_json_format(viewports)
     
     return base_prompt
 
@@ -153,373 +393,359 @@ def get_score_color(score):
         return "#EF4444", "#DC2626"  # Red
 
 
-def generate_html_template(audit_data, website_url, business_name, assessment_date):
-    """Generate HTML report using hardcoded template with exact approved design"""
+# Static parts of the report, compiled once at import. Only the slots in braces change per report.
+REPORT_CSS = """    * {
+        margin: 0;
+        padding: 0;
+        box-sizing: border-box;
+    }
+    body {
+        font-family: system-ui, -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
+        background: #F8FAFC;
+        color: #0A1628;
+        line-height: 1.6;
+    }
+    .container {
+        max-width: 800px;
+        margin: 0 auto;
+        background: white;
+        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.05);
+    }
+    
+    /* Header */
+    .header {
+        background: linear-gradient(135deg, #0A1628 0%, #1a2942 100%);
+        color: white;
+        padding: 40px;
+        text-align: center;
+    }
+    .header a {
+        text-decoration: none;
+    }
+    .logo {
+        margin-bottom: 20px;
+        display: inline-block;
+    }
+    .header h1 {
+        font-size: 28px;
+        font-weight: 300;
+        margin-bottom: 8px;
+        color: white;
+    }
+    .header .subtitle {
+        font-size: 18px;
+        opacity: 0.9;
+    }
+    .header .meta {
+        margin-top: 16px;
+        font-size: 14px;
+        opacity: 0.7;
+    }
     
-    score = audit_data.get('overall_score', 0)
-    grade = audit_data.get('grade', 'N/A')
-    summary = audit_data.get('summary', '')
-    bottom_line = audit_data.get('bottom_line', '')
-    competitive_insight = audit_data.get('competitive_insight', '')
+    /* Executive Summary */
+    .executive-summary {
+        padding: 40px;
+        display: flex;
+        gap: 40px;
+        align-items: center;
+        border-bottom: 1px solid #E2E8F0;
+    }
+    .score-circle {
+        width: 140px;
+        height: 140px;
+        border-radius: 50%;
+        display: flex;
+        flex-direction: column;
+        align-items: center;
+        justify-content: center;
+        color: white;
+        flex-shrink: 0;
+    }
+    .score-circle .score {
+        font-size: 48px;
+        font-weight: 700;
+        line-height: 1;
+    }
+    .score-circle .grade {
+        font-size: 24px;
+        font-weight: 600;
+        opacity: 0.9;
+    }
+    .summary-text h2 {
+        font-size: 14px;
+        text-transform: uppercase;
+        letter-spacing: 1px;
+        color: #64748B;
+        margin-bottom: 12px;
+    }
+    .summary-text .summary {
+        font-size: 18px;
+        font-weight: 600;
+        color: #0A1628;
+        margin-bottom: 16px;
+    }
+    .summary-text .bottom-line {
+        font-size: 15px;
+        color: #475569;
+    }
     
-    categories = audit_data.get('categories', {})
-    cred = categories.get('credibility_trust', {})
-    exp = categories.get('client_experience', {})
-    diff = categories.get('differentiation', {})
-    conv = categories.get('conversion_path', {})
+    /* Assessment Breakdown */
+    .breakdown {
+        padding: 40px;
+        background: #F8FAFC;
+    }
+    .breakdown h2 {
+        font-size: 20px;
+        font-weight: 700;
+        margin-bottom: 24px;
+        color: #0A1628;
+    }
+    .category-grid {
+        display: grid;
+        grid-template-columns: 1fr 1fr;
+        gap: 20px;
+    }
+    .category-card {
+        background: white;
+        border-radius: 12px;
+        padding: 24px;
+        box-shadow: 0 2px 4px rgba(0, 0, 0, 0.05);
+    }
+    .category-card h3 {
+        font-size: 16px;
+        font-weight: 600;
+        color: #0A1628;
+        margin-bottom: 12px;
+    }
+    .score-bar {
+        height: 8px;
+        background: #E2E8F0;
+        border-radius: 4px;
+        margin-bottom: 8px;
+        overflow: hidden;
+    }
+    .score-bar-fill {
+        height: 100%;
+        border-radius: 4px;
+        background: linear-gradient(90deg, #2563EB, #06B6D4);
+    }
+    .score-label {
+        font-size: 14px;
+        font-weight: 600;
+        color: #2563EB;
+        margin-bottom: 12px;
+    }
+    .category-card h4 {
+        font-size: 12px;
+        text-transform: uppercase;
+        letter-spacing: 0.5px;
+        color: #64748B;
+        margin-bottom: 4px;
+    }
+    .category-card p {
+        font-size: 14px;
+        color: #475569;
+        margin-bottom: 12px;
+    }
     
-    recommendations = audit_data.get('recommendations', [])
+    /* Recommendations */
+    .recommendations {
+        padding: 40px;
+        border-bottom: 1px solid #E2E8F0;
+    }
+    .recommendations h2 {
+        font-size: 20px;
+        font-weight: 700;
+        margin-bottom: 24px;
+        color: #0A1628;
+    }
+    .recommendation {
+        background: #F8FAFC;
+        border-radius: 12px;
+        padding: 20px;
+        margin-bottom: 16px;
+        border-left: 4px solid #2563EB;
+    }
+    .priority-badge {
+        display: inline-block;
+        padding: 4px 12px;
+        border-radius: 20px;
+        font-size: 11px;
+        font-weight: 700;
+        text-transform: uppercase;
+        letter-spacing: 0.5px;
+        margin-bottom: 12px;
+    }
+    .recommendation h3 {
+        font-size: 16px;
+        font-weight: 600;
+        color: #0A1628;
+        margin-bottom: 8px;
+    }
+    .recommendation p {
+        font-size: 14px;
+        color: #475569;
+        margin-bottom: 8px;
+    }
+    .recommendation .action {
+        font-size: 14px;
+        color: #2563EB;
+        font-weight: 500;
+    }
     
-    score_color1, score_color2 = get_score_color(score)
+    /* Competitive Insight */
+    .competitive-insight {
+        padding: 40px;
+        background: #EFF6FF;
+        border-left: 4px solid #2563EB;
+        margin: 0 40px 40px 40px;
+        border-radius: 0 12px 12px 0;
+    }
+    .competitive-insight h2 {
+        font-size: 16px;
+        font-weight: 700;
+        color: #1E40AF;
+        margin-bottom: 12px;
+    }
+    .competitive-insight p {
+        font-size: 15px;
+        color: #1E3A8A;
+        font-style: italic;
+    }
     
-    # Build recommendations HTML
-    recs_html = ""
-    for rec in recommendations[:3]:
-        priority = rec.get('priority', 'MEDIUM').upper()
-        priority_class = "high" if priority == "HIGH" else "medium"
-        badge_bg = "#FEE2E2" if priority == "HIGH" else "#FEF3C7"
-        badge_color = "#DC2626" if priority == "HIGH" else "#D97706"
-        border_color = "#EF4444" if priority == "HIGH" else "#F59E0B"
-        
-        recs_html += f'''
-            <div class="recommendation" style="border-left-color: {border_color};">
-                <span class="priority-badge" style="background: {badge_bg}; color: {badge_color};">{priority} Priority</span>
-                <h3>{rec.get('issue', '')}</h3>
-                <p><strong>Impact:</strong> {rec.get('impact', '')}</p>
-                <p class="action">→ {rec.get('recommendation', '')}</p>
-            </div>
-        '''
+    /* CTA Section */
+    .cta-section {
+        background: #EFF6FF;
+        padding: 60px 40px;
+        text-align: center;
+    }
+    .cta-section .logo {
+        margin-bottom: 24px;
+    }
+    .cta-section h2 {
+        font-size: 28px;
+        font-weight: 700;
+        color: #0A1628;
+        margin-bottom: 12px;
+    }
+    .cta-section .subtext {
+        font-size: 16px;
+        color: #475569;
+        margin-bottom: 24px;
+        max-width: 500px;
+        margin-left: auto;
+        margin-right: auto;
+    }
+    .cta-button {
+        display: inline-block;
+        background: linear-gradient(135deg, #2563EB 0%, #06B6D4 100%);
+        color: white;
+        padding: 16px 32px;
+        border-radius: 8px;
+        text-decoration: none;
+        font-weight: 600;
+        font-size: 18px;
+        margin: 20px 0;
+    }
+    .cta-meta {
+        font-size: 14px;
+        color: #64748B;
+        margin-top: 16px;
+    }
+    
+    /* Footer */
+    .footer {
+        background: #0A1628;
+        color: white;
+        padding: 40px;
+        text-align: center;
+    }
+    .footer a {
+        text-decoration: none;
+    }
+    .footer .logo {
+        margin-bottom: 16px;
+    }
+    .footer p {
+        font-size: 14px;
+        opacity: 0.8;
+        margin-bottom: 8px;
+    }
+    .footer .disclaimer {
+        font-size: 12px;
+        opacity: 0.5;
+        margin-top: 20px;
+    }
+    
+    @media (max-width: 600px) {
+        .category-grid {
+            grid-template-columns: 1fr;
+        }
+        .executive-summary {
+            flex-direction: column;
+            text-align: center;
+        }
+    }
     
-    html = f'''<!DOCTYPE html>
+    @media print {
+        .container {
+            box-shadow: none;
+        }
+        .cta-button {
+            background: #2563EB !important;
+            -webkit-print-color-adjust: exact;
+            print-color-adjust: exact;
+        }
+    }
+"""
+
+REPORT_LOGOS = {
+    'header': """<svg viewBox="0 0 140 48" width="140" fill="none" xmlns="http://www.w3.org/2000/svg">
+    <defs>
+        <linearGradient id="logoGrad" x1="0%" y1="100%" x2="100%" y2="0%">
+            <stop offset="0%" style="stop-color:#2563EB"/>
+            <stop offset="100%" style="stop-color:#06B6D4"/>
+        </linearGradient>
+    </defs>
+    <path d="M4 36L20 24L4 12L4 20L12 24L4 28L4 36Z" fill="#2563EB"/>
+    <path d="M12 36L28 24L12 12L12 18L18 24L12 30L12 36Z" fill="url(#logoGrad)"/>
+    <path d="M20 36L44 24L20 12L20 18L32 24L20 30L20 36Z" fill="#06B6D4"/>
+    <text x="52" y="32" font-family="system-ui, -apple-system, sans-serif" font-size="24" font-weight="800" letter-spacing="-1" fill="white">Nexli</text>
+</svg>""",
+    'cta': """<svg viewBox="0 0 140 48" width="140" fill="none" xmlns="http://www.w3.org/2000/svg">
+    <defs>
+        <linearGradient id="logoGrad2" x1="0%" y1="100%" x2="100%" y2="0%">
+            <stop offset="0%" style="stop-color:#2563EB"/>
+            <stop offset="100%" style="stop-color:#06B6D4"/>
+        </linearGradient>
+    </defs>
+    <path d="M4 36L20 24L4 12L4 20L12 24L4 28L4 36Z" fill="#2563EB"/>
+    <path d="M12 36L28 24L12 12L12 18L18 24L12 30L12 36Z" fill="url(#logoGrad2)"/>
+    <path d="M20 36L44 24L20 12L20 18L32 24L20 30L20 36Z" fill="#06B6D4"/>
+    <text x="52" y="32" font-family="system-ui, -apple-system, sans-serif" font-size="24" font-weight="800" letter-spacing="-1" fill="#0A1628">Nexli</text>
+</svg>""",
+    'footer': """<svg viewBox="0 0 48 48" width="48" fill="none" xmlns="http://www.w3.org/2000/svg">
+    <path d="M4 36L20 24L4 12L4 20L12 24L4 28L4 36Z" fill="rgba(255,255,255,0.5)"/>
+    <path d="M12 36L28 24L12 12L12 18L18 24L12 30L12 36Z" fill="rgba(255,255,255,0.75)"/>
+    <path d="M20 36L44 24L20 12L20 18L32 24L20 30L20 36Z" fill="white"/>
+</svg>"""
+}
+REPORT_LOGO_WIDTHS = {'header': 140, 'cta': 140, 'footer': 48}
+
+REPORT_SHELL = """<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Digital Presence Assessment - {business_name}</title>
-    <style>
-        * {{
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }}
-        body {{
-            font-family: system-ui, -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
-            background: #F8FAFC;
-            color: #0A1628;
-            line-height: 1.6;
-        }}
-        .container {{
-            max-width: 800px;
-            margin: 0 auto;
-            background: white;
-            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.05);
-        }}
-        
-        /* Header */
-        .header {{
-            background: linear-gradient(135deg, #0A1628 0%, #1a2942 100%);
-            color: white;
-            padding: 40px;
-            text-align: center;
-        }}
-        .header a {{
-            text-decoration: none;
-        }}
-        .logo {{
-            margin-bottom: 20px;
-            display: inline-block;
-        }}
-        .header h1 {{
-            font-size: 28px;
-            font-weight: 300;
-            margin-bottom: 8px;
-            color: white;
-        }}
-        .header .subtitle {{
-            font-size: 18px;
-            opacity: 0.9;
-        }}
-        .header .meta {{
-            margin-top: 16px;
-            font-size: 14px;
-            opacity: 0.7;
-        }}
-        
-        /* Executive Summary */
-        .executive-summary {{
-            padding: 40px;
-            display: flex;
-            gap: 40px;
-            align-items: center;
-            border-bottom: 1px solid #E2E8F0;
-        }}
-        .score-circle {{
-            width: 140px;
-            height: 140px;
-            border-radius: 50%;
-            background: linear-gradient(135deg, {score_color1} 0%, {score_color2} 100%);
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            justify-content: center;
-            color: white;
-            flex-shrink: 0;
-        }}
-        .score-circle .score {{
-            font-size: 48px;
-            font-weight: 700;
-            line-height: 1;
-        }}
-        .score-circle .grade {{
-            font-size: 24px;
-            font-weight: 600;
-            opacity: 0.9;
-        }}
-        .summary-text h2 {{
-            font-size: 14px;
-            text-transform: uppercase;
-            letter-spacing: 1px;
-            color: #64748B;
-            margin-bottom: 12px;
-        }}
-        .summary-text .summary {{
-            font-size: 18px;
-            font-weight: 600;
-            color: #0A1628;
-            margin-bottom: 16px;
-        }}
-        .summary-text .bottom-line {{
-            font-size: 15px;
-            color: #475569;
-        }}
-        
-        /* Assessment Breakdown */
-        .breakdown {{
-            padding: 40px;
-            background: #F8FAFC;
-        }}
-        .breakdown h2 {{
-            font-size: 20px;
-            font-weight: 700;
-            margin-bottom: 24px;
-            color: #0A1628;
-        }}
-        .category-grid {{
-            display: grid;
-            grid-template-columns: 1fr 1fr;
-            gap: 20px;
-        }}
-        .category-card {{
-            background: white;
-            border-radius: 12px;
-            padding: 24px;
-            box-shadow: 0 2px 4px rgba(0, 0, 0, 0.05);
-        }}
-        .category-card h3 {{
-            font-size: 16px;
-            font-weight: 600;
-            color: #0A1628;
-            margin-bottom: 12px;
-        }}
-        .score-bar {{
-            height: 8px;
-            background: #E2E8F0;
-            border-radius: 4px;
-            margin-bottom: 8px;
-            overflow: hidden;
-        }}
-        .score-bar-fill {{
-            height: 100%;
-            border-radius: 4px;
-            background: linear-gradient(90deg, #2563EB, #06B6D4);
-        }}
-        .score-label {{
-            font-size: 14px;
-            font-weight: 600;
-            color: #2563EB;
-            margin-bottom: 12px;
-        }}
-        .category-card h4 {{
-            font-size: 12px;
-            text-transform: uppercase;
-            letter-spacing: 0.5px;
-            color: #64748B;
-            margin-bottom: 4px;
-        }}
-        .category-card p {{
-            font-size: 14px;
-            color: #475569;
-            margin-bottom: 12px;
-        }}
-        
-        /* Recommendations */
-        .recommendations {{
-            padding: 40px;
-            border-bottom: 1px solid #E2E8F0;
-        }}
-        .recommendations h2 {{
-            font-size: 20px;
-            font-weight: 700;
-            margin-bottom: 24px;
-            color: #0A1628;
-        }}
-        .recommendation {{
-            background: #F8FAFC;
-            border-radius: 12px;
-            padding: 20px;
-            margin-bottom: 16px;
-            border-left: 4px solid #2563EB;
-        }}
-        .priority-badge {{
-            display: inline-block;
-            padding: 4px 12px;
-            border-radius: 20px;
-            font-size: 11px;
-            font-weight: 700;
-            text-transform: uppercase;
-            letter-spacing: 0.5px;
-            margin-bottom: 12px;
-        }}
-        .recommendation h3 {{
-            font-size: 16px;
-            font-weight: 600;
-            color: #0A1628;
-            margin-bottom: 8px;
-        }}
-        .recommendation p {{
-            font-size: 14px;
-            color: #475569;
-            margin-bottom: 8px;
-        }}
-        .recommendation .action {{
-            font-size: 14px;
-            color: #2563EB;
-            font-weight: 500;
-        }}
-        
-        /* Competitive Insight */
-        .competitive-insight {{
-            padding: 40px;
-            background: #EFF6FF;
-            border-left: 4px solid #2563EB;
-            margin: 0 40px 40px 40px;
-            border-radius: 0 12px 12px 0;
-        }}
-        .competitive-insight h2 {{
-            font-size: 16px;
-            font-weight: 700;
-            color: #1E40AF;
-            margin-bottom: 12px;
-        }}
-        .competitive-insight p {{
-            font-size: 15px;
-            color: #1E3A8A;
-            font-style: italic;
-        }}
-        
-        /* CTA Section */
-        .cta-section {{
-            background: #EFF6FF;
-            padding: 60px 40px;
-            text-align: center;
-        }}
-        .cta-section .logo {{
-            margin-bottom: 24px;
-        }}
-        .cta-section h2 {{
-            font-size: 28px;
-            font-weight: 700;
-            color: #0A1628;
-            margin-bottom: 12px;
-        }}
-        .cta-section .subtext {{
-            font-size: 16px;
-            color: #475569;
-            margin-bottom: 24px;
-            max-width: 500px;
-            margin-left: auto;
-            margin-right: auto;
-        }}
-        .cta-button {{
-            display: inline-block;
-            background: linear-gradient(135deg, #2563EB 0%, #06B6D4 100%);
-            color: white;
-            padding: 16px 32px;
-            border-radius: 8px;
-            text-decoration: none;
-            font-weight: 600;
-            font-size: 18px;
-            margin: 20px 0;
-        }}
-        .cta-meta {{
-            font-size: 14px;
-            color: #64748B;
-            margin-top: 16px;
-        }}
-        
-        /* Footer */
-        .footer {{
-            background: #0A1628;
-            color: white;
-            padding: 40px;
-            text-align: center;
-        }}
-        .footer a {{
-            text-decoration: none;
-        }}
-        .footer .logo {{
-            margin-bottom: 16px;
-        }}
-        .footer p {{
-            font-size: 14px;
-            opacity: 0.8;
-            margin-bottom: 8px;
-        }}
-        .footer .disclaimer {{
-            font-size: 12px;
-            opacity: 0.5;
-            margin-top: 20px;
-        }}
-        
-        @media (max-width: 600px) {{
-            .category-grid {{
-                grid-template-columns: 1fr;
-            }}
-            .executive-summary {{
-                flex-direction: column;
-                text-align: center;
-            }}
-        }}
-        
-        @media print {{
-            .container {{
-                box-shadow: none;
-            }}
-            .cta-button {{
-                background: #2563EB !important;
-                -webkit-print-color-adjust: exact;
-                print-color-adjust: exact;
-            }}
-        }}
-    </style>
+    {head_assets}
 </head>
 <body>
     <div class="container">
         <!-- Header -->
         <header class="header">
             <a href="https://www.nexli.net/#book" target="_blank" class="logo">
-                <svg viewBox="0 0 140 48" width="140" fill="none" xmlns="http://www.w3.org/2000/svg">
-                    <defs>
-                        <linearGradient id="logoGrad" x1="0%" y1="100%" x2="100%" y2="0%">
-                            <stop offset="0%" style="stop-color:#2563EB"/>
-                            <stop offset="100%" style="stop-color:#06B6D4"/>
-                        </linearGradient>
-                    </defs>
-                    <path d="M4 36L20 24L4 12L4 20L12 24L4 28L4 36Z" fill="#2563EB"/>
-                    <path d="M12 36L28 24L12 12L12 18L18 24L12 30L12 36Z" fill="url(#logoGrad)"/>
-                    <path d="M20 36L44 24L20 12L20 18L32 24L20 30L20 36Z" fill="#06B6D4"/>
-                    <text x="52" y="32" font-family="system-ui, -apple-system, sans-serif" font-size="24" font-weight="800" letter-spacing="-1" fill="white">Nexli</text>
-                </svg>
+                {logo_header}
             </a>
             <h1>Digital Presence Assessment</h1>
             <p class="subtitle">Prepared for <strong>{business_name}</strong></p>
@@ -528,7 +754,7 @@ def generate_html_template(audit_data, website_url, business_name, assessment_da
         
         <!-- Executive Summary -->
         <section class="executive-summary">
-            <div class="score-circle">
+            <div class="score-circle" style="background: linear-gradient(135deg, {score_color1} 0%, {score_color2} 100%);">
                 <span class="score">{score}</span>
                 <span class="grade">{grade}</span>
             </div>
@@ -550,47 +776,47 @@ def generate_html_template(audit_data, website_url, business_name, assessment_da
             <div class="category-grid">
                 <div class="category-card">
                     <h3>Credibility & Trust</h3>
-                    <div class="score-bar"><div class="score-bar-fill" style="width: {cred.get('score', 0) * 4}%;"></div></div>
-                    <p class="score-label">{cred.get('score', 0)}/25</p>
+                    <div class="score-bar"><div class="score-bar-fill" style="width: {cred_width}%;"></div></div>
+                    <p class="score-label">{cred_score}/25</p>
                     <h4>Current State</h4>
-                    <p>{cred.get('findings', '')}</p>
+                    <p>{cred_findings}</p>
                     <h4>Opportunity</h4>
-                    <p>{cred.get('opportunity', '')}</p>
+                    <p>{cred_opportunity}</p>
                 </div>
                 <div class="category-card">
                     <h3>Client Experience</h3>
-                    <div class="score-bar"><div class="score-bar-fill" style="width: {exp.get('score', 0) * 4}%;"></div></div>
-                    <p class="score-label">{exp.get('score', 0)}/25</p>
+                    <div class="score-bar"><div class="score-bar-fill" style="width: {exp_width}%;"></div></div>
+                    <p class="score-label">{exp_score}/25</p>
                     <h4>Current State</h4>
-                    <p>{exp.get('findings', '')}</p>
+                    <p>{exp_findings}</p>
                     <h4>Opportunity</h4>
-                    <p>{exp.get('opportunity', '')}</p>
+                    <p>{exp_opportunity}</p>
                 </div>
                 <div class="category-card">
                     <h3>Differentiation</h3>
-                    <div class="score-bar"><div class="score-bar-fill" style="width: {diff.get('score', 0) * 4}%;"></div></div>
-                    <p class="score-label">{diff.get('score', 0)}/25</p>
+                    <div class="score-bar"><div class="score-bar-fill" style="width: {diff_width}%;"></div></div>
+                    <p class="score-label">{diff_score}/25</p>
                     <h4>Current State</h4>
-                    <p>{diff.get('findings', '')}</p>
+                    <p>{diff_findings}</p>
                     <h4>Opportunity</h4>
-                    <p>{diff.get('opportunity', '')}</p>
+                    <p>{diff_opportunity}</p>
                 </div>
                 <div class="category-card">
                     <h3>Conversion Path</h3>
-                    <div class="score-bar"><div class="score-bar-fill" style="width: {conv.get('score', 0) * 4}%;"></div></div>
-                    <p class="score-label">{conv.get('score', 0)}/25</p>
+                    <div class="score-bar"><div class="score-bar-fill" style="width: {conv_width}%;"></div></div>
+                    <p class="score-label">{conv_score}/25</p>
                     <h4>Current State</h4>
-                    <p>{conv.get('findings', '')}</p>
+                    <p>{conv_findings}</p>
                     <h4>Opportunity</h4>
-                    <p>{conv.get('opportunity', '')}</p>
+                    <p>{conv_opportunity}</p>
                 </div>
             </div>
         </section>
         
-        <!-- Strategic Recommendations -->
+{viewport_section}        <!-- Strategic Recommendations -->
         <section class="recommendations">
             <h2>Strategic Recommendations</h2>
-            {recs_html}
+            {recommendations}
         </section>
         
         <!-- Competitive Insight -->
@@ -602,18 +828,7 @@ def generate_html_template(audit_data, website_url, business_name, assessment_da
         <!-- CTA Section -->
         <section class="cta-section">
             <a href="https://www.nexli.net/#book" target="_blank" class="logo">
-                <svg viewBox="0 0 140 48" width="140" fill="none" xmlns="http://www.w3.org/2000/svg">
-                    <defs>
-                        <linearGradient id="logoGrad2" x1="0%" y1="100%" x2="100%" y2="0%">
-                            <stop offset="0%" style="stop-color:#2563EB"/>
-                            <stop offset="100%" style="stop-color:#06B6D4"/>
-                        </linearGradient>
-                    </defs>
-                    <path d="M4 36L20 24L4 12L4 20L12 24L4 28L4 36Z" fill="#2563EB"/>
-                    <path d="M12 36L28 24L12 12L12 18L18 24L12 30L12 36Z" fill="url(#logoGrad2)"/>
-                    <path d="M20 36L44 24L20 12L20 18L32 24L20 30L20 36Z" fill="#06B6D4"/>
-                    <text x="52" y="32" font-family="system-ui, -apple-system, sans-serif" font-size="24" font-weight="800" letter-spacing="-1" fill="#0A1628">Nexli</text>
-                </svg>
+                {logo_cta}
             </a>
             <h2>Ready to Elevate Your Digital Presence?</h2>
             <p class="subtext">Schedule a complimentary strategy session to discuss how these insights apply to your firm's growth goals.</p>
@@ -624,11 +839,7 @@ def generate_html_template(audit_data, website_url, business_name, assessment_da
         <!-- Footer -->
         <footer class="footer">
             <a href="https://www.nexli.net/#book" target="_blank" class="logo">
-                <svg viewBox="0 0 48 48" width="48" fill="none" xmlns="http://www.w3.org/2000/svg">
-                    <path d="M4 36L20 24L4 12L4 20L12 24L4 28L4 36Z" fill="rgba(255,255,255,0.5)"/>
-                    <path d="M12 36L28 24L12 12L12 18L18 24L12 30L12 36Z" fill="rgba(255,255,255,0.75)"/>
-                    <path d="M20 36L44 24L20 12L20 18L32 24L20 30L20 36Z" fill="white"/>
-                </svg>
+                {logo_footer}
             </a>
             <p>Assessment powered by Nexli</p>
             <p>Helping financial advisors attract and convert high-value clients</p>
@@ -636,192 +847,3698 @@ def generate_html_template(audit_data, website_url, business_name, assessment_da
         </footer>
     </div>
 </body>
-</html>'''
-    
-    return html
+</html>"""
 
+REPORT_RECOMMENDATION = """            <div class="recommendation" style="border-left-color: {border_color};">
+                <span class="priority-badge" style="background: {badge_bg}; color: {badge_color};">{priority} Priority</span>
+                <h3>{issue}</h3>
+                <p><strong>Impact:</strong> {impact}</p>
+                <p class="action">→ {action}</p>
+            </div>
+"""
 
-def take_screenshot(url):
-    """Take a screenshot using ScreenshotOne API"""
-    api_url = "https://api.screenshotone.com/take"
-    
-    params = {
-        "access_key": SCREENSHOT_API_KEY,
-        "url": url,
-        "viewport_width": 1280,
-        "viewport_height": 800,
-        "device_scale_factor": 1,
-        "format": "jpg",
-        "image_quality": 80,
-        "block_ads": True,
-        "block_cookie_banners": True,
-        "full_page": False
-    }
-    
-    response = requests.get(api_url, params=params, timeout=60)
+REPORT_VIEWPORTS = """        <!-- Viewports -->
+        <section class="breakdown">
+            <h2>Desktop &amp; Mobile</h2>
+            <div class="category-grid">
+{cards}            </div>
+        </section>
+        
+"""
+
+REPORT_VIEWPORT_CARD = """                <div class="category-card">
+                    <h3>{label}</h3>
+                    <h4>Current State</h4>
+                    <p>{findings}</p>
+                    <h4>Opportunity</h4>
+                    <p>{opportunity}</p>
+                </div>
+"""
+
+
+def asset_filename(name, content, extension):
+    """Versioned R2 key for a shared report asset - the version changes whenever the content does"""
+    version = hashlib.sha256(content.encode('utf-8')).hexdigest()[:10]
+    return f"assets/{name}-{version}.{extension}"
+
+
+REPORT_ASSETS = {
+    asset_filename('report', REPORT_CSS, 'css'): (REPORT_CSS, 'text/css; charset=utf-8'),
+    **{asset_filename(f'logo-{name}', svg, 'svg'): (svg, 'image/svg+xml') for name, svg in REPORT_LOGOS.items()}
+}
+
+
+def compile_template(template, **static):
+    """Split a template into literal text and slot names once, folding in slots whose value never changes.
+
+    Returns (literals, fields) where literals has one more entry than fields.
+    """
+    literals = []
+    fields = []
+    text = ''
+    for literal, field, _, _ in string.Formatter().parse(template):
+        text += literal
+        if field is None:
+            continue
+        if field in static:
+            text += static[field]
+        else:
+            literals.append(text)
+            fields.append(field)
+            text = ''
+    literals.append(text)
+    return tuple(literals), tuple(fields)
+
+
+def fill_template(compiled, values):
+    """Render a compiled template - one join, no re-parsing of the static text"""
+    literals, fields = compiled
+    parts = [None] * (len(literals) + len(fields))
+    parts[::2] = literals
+    parts[1::2] = [values[field] for field in fields]
+    return ''.join(parts)
+
+
+def report_static_slots():
+    """Stylesheet and logos, either inlined or linked to the shared versioned copies on R2"""
+    if REPORT_SHARED_ASSETS:
+        css_file = asset_filename('report', REPORT_CSS, 'css')
+        slots = {'head_assets': f'<link rel="stylesheet" href="{R2_PUBLIC_URL}/{css_file}">'}
+        for name, svg in REPORT_LOGOS.items():
+            logo_file = asset_filename(f'logo-{name}', svg, 'svg')
+            slots[f'logo_{name}'] = f'<img src="{R2_PUBLIC_URL}/{logo_file}" width="{REPORT_LOGO_WIDTHS[name]}" alt="Nexli">'
+        return slots
     
-    if response.status_code == 200:
-        return base64.b64encode(response.content).decode('utf-8')
-    else:
-        raise Exception(f"Screenshot failed: {response.status_code} - {response.text}")
+    slots = {'head_assets': '<style>\n' + textwrap.indent(REPORT_CSS, ' ' * 4) + '    </style>'}
+    for name, svg in REPORT_LOGOS.items():
+        slots[f'logo_{name}'] = textwrap.indent(svg, ' ' * 16).lstrip()
+    return slots
+
+
+_report_shell = compile_template(REPORT_SHELL, **report_static_slots())
+_report_recommendation = compile_template(REPORT_RECOMMENDATION)
+_report_viewports = compile_template(REPORT_VIEWPORTS)
+_report_viewport_card = compile_template(REPORT_VIEWPORT_CARD)
 
 
-def analyze_with_claude(screenshot_base64, firm_type=None):
-    """Analyze screenshot with Claude Vision API"""
-    url = "https://api.anthropic.com/v1/messages"
+def _as_score(value):
+    """Model output scores can arrive as strings or floats - render them as whole numbers"""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def generate_html_template(audit_data, website_url, business_name, assessment_date):
+    """Generate HTML report from the precompiled template with exact approved design"""
+    esc = lambda value: html.escape(str(value))
     
-    headers = {
-        "Content-Type": "application/json",
-        "x-api-key": CLAUDE_API_KEY,
-        "anthropic-version": "2023-06-01"
-    }
+    score = _as_score(audit_data.get('overall_score', 0))
+    score_color1, score_color2 = get_score_color(score)
     
-    payload = {
-        "model": "claude-sonnet-4-20250514",
-        "max_tokens": 2048,
-        "messages": [{
-            "role": "user",
-            "content": [
-                {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": screenshot_base64
-                    }
-                },
-                {
-                    "type": "text",
-                    "text": get_grading_prompt(firm_type)
-                }
-            ]
-        }]
+    values = {
+        'business_name': esc(business_name),
+        'website_url': esc(website_url),
+        'assessment_date': esc(assessment_date),
+        'score': str(score),
+        'grade': esc(audit_data.get('grade', 'N/A')),
+        'score_color1': score_color1,
+        'score_color2': score_color2,
+        'summary': esc(audit_data.get('summary', '')),
+        'bottom_line': esc(audit_data.get('bottom_line', '')),
+        'competitive_insight': esc(audit_data.get('competitive_insight', ''))
     }
     
-    response = requests.post(url, json=payload, headers=headers, timeout=90)
+    categories = audit_data.get('categories', {})
+    for prefix, key in [('cred', 'credibility_trust'), ('exp', 'client_experience'),
+                        ('diff', 'differentiation'), ('conv', 'conversion_path')]:
+        category = categories.get(key, {})
+        category_score = _as_score(category.get('score', 0))
+        values[f'{prefix}_score'] = str(category_score)
+        values[f'{prefix}_width'] = str(category_score * 4)
+        values[f'{prefix}_findings'] = esc(category.get('findings', ''))
+        values[f'{prefix}_opportunity'] = esc(category.get('opportunity', ''))
+    
+    # Build recommendations HTML
+    recs_html = []
+    for rec in audit_data.get('recommendations', [])[:3]:
+        priority = str(rec.get('priority', 'MEDIUM')).upper()
+        high = priority == "HIGH"
+        recs_html.append(fill_template(_report_recommendation, {
+            'priority': esc(priority),
+            'badge_bg': "#FEE2E2" if high else "#FEF3C7",
+            'badge_color': "#DC2626" if high else "#D97706",
+            'border_color': "#EF4444" if high else "#F59E0B",
+            'issue': esc(rec.get('issue', '')),
+            'impact': esc(rec.get('impact', '')),
+            'action': esc(rec.get('recommendation', ''))
+        }))
+    values['recommendations'] = ''.join(recs_html)
     
-    if response.status_code != 200:
-        raise Exception(f"Claude failed: {response.status_code} - {response.text}")
+    # Per-viewport notes, only for audits graded on more than one viewport
+    cards = [fill_template(_report_viewport_card, {
+        'label': esc(VIEWPORTS.get(name, {}).get('label', name)),
+        'findings': esc(view.get('findings', '')),
+        'opportunity': esc(view.get('opportunity', ''))
+    }) for name, view in (audit_data.get('viewports') or {}).items()]
+    values['viewport_section'] = fill_template(_report_viewports, {'cards': ''.join(cards)}) if cards else ''
     
-    result = response.json()
-    return result['content'][0]['text']
+    return fill_template(_report_shell, values)
 
 
-def upload_to_r2(html_content, filename):
-    """Upload HTML report to Cloudflare R2"""
-    s3_client = boto3.client(
-        's3',
-        endpoint_url=R2_ENDPOINT,
-        aws_access_key_id=R2_ACCESS_KEY_ID,
-        aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-        config=Config(signature_version='s3v4')
-    )
-    
-    s3_client.put_object(
-        Bucket=R2_BUCKET_NAME,
-        Key=filename,
-        Body=html_content.encode('utf-8'),
-        ContentType='text/html'
-    )
+_report_assets_published = False
+_report_assets_lock = threading.Lock()
+
+
+def publish_report_assets():
+    """Upload the shared stylesheet and logos to R2 once per process (keys are content-versioned)"""
+    global _report_assets_published
+    with _report_assets_lock:
+        if _report_assets_published:
+            return
+        for filename, (content, content_type) in REPORT_ASSETS.items():
+            get_r2_client().put_object(
+                Bucket=R2_BUCKET_NAME,
+                Key=filename,
+                Body=gzip.compress(content.encode('utf-8'), compresslevel=9, mtime=0),
+                ContentType=content_type,
+                ContentEncoding='gzip',
+                CacheControl=R2_CACHE_CONTROL
+            )
+        _report_assets_published = True
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_sessions_pid = None
+
+
+def get_session(upstream):
+    """Shared keep-alive session for an upstream ('screenshotone', 'anthropic', 'ghl')"""
+    global _sessions_pid
+    with _sessions_lock:
+        # Pooled sockets must not be shared across a fork
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        session = _sessions.get(upstream)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[upstream] = session
+        return session
+
+
+def http_pool_stats():
+    """Per-host request and connection counts - requests well above connections means sockets are reused"""
+    stats = {}
+    with _sessions_lock:
+        sessions = dict(_sessions) if _sessions_pid == os.getpid() else {}
+    for upstream, session in sessions.items():
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                stats[f"{upstream}:{pool.host}"] = {
+                    'requests': pool.num_requests,
+                    'connections_opened': pool.num_connections
+                }
+    return stats
+
+
+class UpstreamError(Exception):
+    """An upstream API answered with an error status"""
+
+    def __init__(self, upstream, status_code, message):
+        super().__init__(message)
+        self.upstream = upstream
+        self.status_code = status_code
+
+
+class CircuitOpenError(Exception):
+    """The upstream's circuit breaker is open, so the call was not attempted"""
+
+
+def is_transient(error):
+    """Whether an error is worth retrying (timeouts, connection errors, 5xx and throttling)"""
+    if isinstance(error, UpstreamError):
+        return error.status_code >= 500 or error.status_code in (408, 429, 529)
+    if isinstance(error, ClientError):
+        return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500) >= 500
+    return isinstance(error, (requests.RequestException, BotoCoreError))
+
+
+def error_status(error):
+    """Metrics label for a failed call: the HTTP status, or the kind of failure"""
+    if isinstance(error, UpstreamError):
+        return str(error.status_code)
+    if isinstance(error, ClientError):
+        return str(error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 'error'))
+    if isinstance(error, CircuitOpenError):
+        return 'circuit_open'
+    if isinstance(error, requests.Timeout):
+        return 'timeout'
+    if isinstance(error, requests.ConnectionError):
+        return 'connection'
+    return type(error).__name__
+
+
+def count_upstream_error(upstream, error):
+    UPSTREAM_ERRORS.labels(upstream, error if isinstance(error, str) else error_status(error)).inc()
+
+
+class CircuitBreaker:
+    """Opens after consecutive transient failures, then lets one trial call through after a cool-off"""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError instead of calling a provider that is down"""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.time() - self.opened_at >= BREAKER_RESET_SECONDS:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            raise CircuitOpenError(f"{self.name} circuit breaker is open")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                print(f"{self.name} circuit breaker closed")
+            self.state = 'closed'
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == 'half_open' or self.failures >= BREAKER_FAILURE_THRESHOLD:
+                if self.state != 'open':
+                    print(f"{self.name} circuit breaker opened after {self.failures} failures")
+                    self.times_opened += 1
+                self.state = 'open'
+                self.opened_at = time.time()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'times_opened': self.times_opened,
+                'opened_at': datetime.fromtimestamp(self.opened_at).isoformat() if self.opened_at else None
+            }
+
+
+circuit_breakers = {name: CircuitBreaker(name) for name in ('screenshotone', 'browser', 'anthropic', 'r2')}
+
+
+@contextlib.contextmanager
+def upstream_call(upstream):
+    """Guard a call to an upstream with its circuit breaker"""
+    breaker = circuit_breakers[upstream]
+    try:
+        breaker.before_call()
+    except CircuitOpenError as e:
+        count_upstream_error(upstream, e)
+        raise
+    try:
+        yield
+    except Exception as e:
+        count_upstream_error(upstream, e)
+        if is_transient(e):
+            breaker.record_failure()
+        else:
+            # The provider answered, it's just not a retryable answer
+            breaker.record_success()
+        raise
+    breaker.record_success()
+
+
+# Token bucket shared by every process through Redis. Takes a token, or returns how long to wait
+# for one (or for a pause set after a throttled response) as a string - Lua numbers would be truncated.
+RATE_LIMIT_TAKE_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'at', 'paused_until')
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local paused = tonumber(state[3]) or 0
+if now < paused then
+    return tostring(paused - now)
+end
+local tokens = tonumber(state[1]) or burst
+local at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+if tokens < 1 then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+    return tostring((1 - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'at', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+return '0'
+"""
+
+# Pause every process's requests to an upstream until a time, unless a later pause is already set
+RATE_LIMIT_PAUSE_SCRIPT = """
+if tonumber(ARGV[1]) > (tonumber(redis.call('HGET', KEYS[1], 'paused_until')) or 0) then
+    redis.call('HSET', KEYS[1], 'paused_until', ARGV[1])
+    redis.call('EXPIRE', KEYS[1], 3600)
+end
+"""
+
+
+class AdaptiveLimiter:
+    """Token bucket plus an AIMD concurrency window for one upstream, shared by every thread in the process.
+
+    Each throttled response (429/529) halves the concurrency window and pauses new requests
+    until Retry-After has passed; each success grows the window again by about one slot
+    per window's worth of requests.
+
+    With REDIS_URL set, share() moves the token bucket and the pause into Redis, so the rate holds
+    across every process on every host and a 429 seen by one process pauses them all. The
+    concurrency window stays per process.
+    """
+
+    def __init__(self, name, rate, max_concurrency):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.tokens = self.burst
+        self.max_concurrency = max_concurrency
+        self.window = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.consecutive_throttles = 0
+        self.throttled = 0
+        self.requests = 0
+        self._refilled_at = time.monotonic()
+        self._cond = threading.Condition()
+        self._shared = None
+
+    def share(self, client):
+        """Take tokens from a bucket in Redis that every process shares, instead of this process's own"""
+        self._shared = (client.register_script(RATE_LIMIT_TAKE_SCRIPT), client.register_script(RATE_LIMIT_PAUSE_SCRIPT),
+                        f"{QUEUE_PREFIX}:ratelimit:{self.name}")
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        shared = self._shared is not None
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= int(self.window):
+                    wait = None
+                elif not shared and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    if not shared:
+                        self.tokens -= 1
+                    self.in_flight += 1
+                    self.requests += 1
+                    break
+                self._cond.wait(wait)
+        if shared:
+            self._take_shared_token()
+
+    def _take_shared_token(self):
+        """Wait for a token from the shared bucket (holding the concurrency slot already taken)"""
+        take, _, key = self._shared
+        while True:
+            try:
+                wait = float(take(keys=[key], args=[self.rate, self.burst, time.time()]))
+            except redis.RedisError as e:
+                # The concurrency window still bounds this process while Redis is unreachable
+                print(f"{self.name} shared rate limit unavailable, sending anyway: {str(e)}")
+                return
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def release(self, throttled=False, retry_after=None):
+        """Report the outcome of a request sent after acquire()"""
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.consecutive_throttles += 1
+                self.window = max(1.0, self.window / 2)
+                backoff = min(retry_after if retry_after is not None else min(2 ** self.consecutive_throttles, 30),
+                              RATE_LIMIT_MAX_WAIT)
+                self.paused_until = max(self.paused_until, time.monotonic() + backoff)
+                print(f"{self.name} throttled, concurrency window now {int(self.window)}, pausing {backoff:.1f}s")
+            else:
+                self.consecutive_throttles = 0
+                self.window = min(float(self.max_concurrency), self.window + 1 / self.window)
+            self._cond.notify_all()
+        if throttled and self._shared is not None:
+            _, pause, key = self._shared
+            try:
+                pause(keys=[key], args=[time.time() + backoff])
+            except redis.RedisError as e:
+                print(f"{self.name} shared pause not set: {str(e)}")
+
+    def stats(self):
+        with self._cond:
+            return {
+                'rate_per_second': self.rate,
+                'concurrency_window': int(self.window),
+                'max_concurrency': self.max_concurrency,
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'paused_for': round(max(0.0, self.paused_until - time.monotonic()), 1),
+                'shared': self._shared is not None
+            }
+
+
+rate_limiters = {
+    # Each screenshot stage slot captures all of a site's viewports at once
+    'screenshotone': AdaptiveLimiter('screenshotone', SCREENSHOT_RATE_LIMIT, STAGE_CONCURRENCY['screenshot'] * MAX_VIEWPORTS),
+    'anthropic': AdaptiveLimiter('anthropic', ANTHROPIC_RATE_LIMIT, STAGE_CONCURRENCY['analysis'])
+}
+
+
+def parse_retry_after(value):
+    """Retry-After header as seconds (it may be a number of seconds or an HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def send_rate_limited(upstream, send):
+    """Send a request through the upstream's limiter, waiting out and retrying throttled responses"""
+    limiter = rate_limiters[upstream]
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        limiter.acquire()
+        response = None
+        try:
+            response = send()
+        finally:
+            throttled = response is not None and response.status_code in (429, 529)
+            limiter.release(throttled, parse_retry_after(response.headers.get('retry-after')) if throttled else None)
+        annotate_span(**{f'{upstream}_status': response.status_code, f'{upstream}_attempts': attempt + 1})
+        if not throttled or attempt == RATE_LIMIT_MAX_RETRIES:
+            return response
+        count_upstream_error(upstream, str(response.status_code))
+        # Hand a streamed response's connection back to the pool before retrying
+        response.close()
+
+
+class DiskCache:
+    """Directory of cached blobs with a TTL and a total size limit (least recently used evicted first).
+
+    Entries are plain files, so every gunicorn worker on the host shares the same cache.
+    Write time is kept in the file's mtime (for the TTL) and last use in its atime (for LRU).
+    """
+
+    def __init__(self, directory, ttl, max_bytes):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """Return the cached bytes for key, or None on a miss or expired entry"""
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime > self.ttl:
+                os.remove(path)
+                with self._lock:
+                    if self._size is not None:
+                        self._size -= stat.st_size
+                raise FileNotFoundError(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def set(self, key, data):
+        """Store bytes under key, evicting the least recently used entries if over the size limit"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        # An overwritten entry's old bytes leave the cache
+        try:
+            replaced = os.stat(path).st_size
+        except FileNotFoundError:
+            replaced = 0
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(data) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry.path, stat.st_size, stat.st_atime))
+        return entries
+
+    def _evict(self):
+        # Rescan since other processes write to the same directory
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            self.evictions += 1
+
+    def stats(self):
+        """Hit/miss counters for tuning the TTL and size limit"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'bytes': self._size
+            }
+
+
+screenshot_cache = DiskCache(SCREENSHOT_CACHE_DIR, SCREENSHOT_CACHE_TTL, SCREENSHOT_CACHE_MAX_MB * 1024 * 1024)
+analysis_cache = DiskCache(ANALYSIS_CACHE_DIR, ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_MAX_MB * 1024 * 1024)
+
+# Capture settings sent to ScreenshotOne for every viewport (with the viewport's own, part of the cache key)
+SCREENSHOT_PARAMS = {
+    "format": "jpg",
+    "image_quality": 80,
+    "block_ads": True,
+    "block_cookie_banners": True,
+    "full_page": False
+}
+
+
+def normalize_url(url):
+    """Normalize a website URL so trivial variations share a cache entry"""
+    url = url.strip()
+    if '://' not in url:
+        url = f"https://{url}"
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and not (scheme == 'http' and parts.port == 80) and not (scheme == 'https' and parts.port == 443):
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip('/') or '/'
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, path, query, ''))
+
+
+class ScreenshotOneBackend:
+    """Captures through the hosted ScreenshotOne API"""
+
+    name = 'screenshotone'
+
+    def capture(self, url, params):
+        """JPEG bytes of one viewport of a page (params as in SCREENSHOT_PARAMS plus the viewport's)"""
+        request_params = {
+            "access_key": SCREENSHOT_API_KEY,
+            "url": url,
+            **params
+        }
+        with upstream_call('screenshotone'):
+            response = send_rate_limited(
+                'screenshotone',
+                lambda: get_session('screenshotone').get(SCREENSHOT_API_URL, params=request_params, timeout=60)
+            )
+            if response.status_code != 200:
+                raise UpstreamError('screenshotone', response.status_code,
+                                    f"Screenshot failed: {response.status_code} - {response.text}")
+        return response.content
+
+    def stats(self):
+        return {'backend': self.name}
+
+    def close(self):
+        pass
+
+
+# Requests the browser backend drops, standing in for ScreenshotOne's block_ads and block_cookie_banners
+BROWSER_AD_HOSTS = ('doubleclick.net', 'googlesyndication.com', 'googleadservices.com', 'adservice.google.com',
+                    'amazon-adsystem.com', 'adnxs.com', 'criteo.com', 'criteo.net', 'taboola.com', 'outbrain.com',
+                    'pubmatic.com', 'rubiconproject.com', 'openx.net', 'moatads.com', 'adsrvr.org')
+BROWSER_CONSENT_HOSTS = ('cookielaw.org', 'onetrust.com', 'cookiebot.com', 'consensu.org', 'cookieyes.com',
+                         'termly.io', 'iubenda.com', 'osano.com', 'usercentrics.eu', 'trustarc.com')
+# Self-hosted cookie banners (WordPress plugins and the like) are hidden instead
+BROWSER_COOKIE_BANNER_SELECTORS = ('#onetrust-consent-sdk', '#CybotCookiebotDialog', '.cc-window', '.cc-banner',
+                                   '#cookie-notice', '#cookie-law-info-bar', '#cookie-law-info-again',
+                                   '.cky-consent-container', '#moove_gdpr_cookie_info_bar', '#cmplz-cookiebanner-container',
+                                   '.cookie-banner', '#cookie-banner', '.cookie-consent', '#cookie-consent')
+BROWSER_COOKIE_BANNER_SCRIPT = """(() => {
+    const style = document.createElement('style');
+    style.textContent = '%s { display: none !important; }';
+    const add = () => (document.head || document.documentElement).appendChild(style);
+    if (document.documentElement) add(); else document.addEventListener('DOMContentLoaded', add);
+})();""" % ', '.join(BROWSER_COOKIE_BANNER_SELECTORS)
+
+
+def blocked_hosts_pattern(hosts):
+    """URL pattern matching any of the hosts or their subdomains"""
+    return re.compile(r'^[a-z]+://([^/]*\.)?(' + '|'.join(re.escape(host) for host in hosts) + r')(:\d+)?/', re.I)
+
+
+class BrowserBackend:
+    """Captures with a local headless Chromium through Playwright, keeping a warm pool of browser contexts.
+
+    A context is set up per viewport shape and reused across jobs (cookies cleared in between), then
+    closed after recycle_pages pages so memory and site state don't pile up. Playwright objects
+    belong to the event loop that made them, so all browser work runs on the backend's own loop.
+    """
+
+    name = 'browser'
+
+    def __init__(self, pool_size=None, recycle_pages=None):
+        # Only this backend needs Playwright, so it isn't a hard dependency
+        from playwright.async_api import async_playwright, Error, TimeoutError as PlaywrightTimeoutError
+        self._async_playwright = async_playwright
+        self._error = Error
+        self._timeout_error = PlaywrightTimeoutError
+        self.pool_size = pool_size or BROWSER_POOL_SIZE
+        self.recycle_pages = recycle_pages or BROWSER_RECYCLE_PAGES
+        self._playwright = None
+        self._browser = None
+        self._idle = {}
+        self._slots = None
+        self._launch_lock = None
+        self.counts = {'pages': 0, 'contexts_created': 0, 'contexts_recycled': 0, 'browser_launches': 0}
+        self._ad_pattern = blocked_hosts_pattern(BROWSER_AD_HOSTS)
+        self._consent_pattern = blocked_hosts_pattern(BROWSER_CONSENT_HOSTS)
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="browser-pool", daemon=True).start()
+
+    def capture(self, url, params):
+        """JPEG bytes of one viewport of a page (params as in SCREENSHOT_PARAMS plus the viewport's)"""
+        with upstream_call('browser'):
+            future = asyncio.run_coroutine_threadsafe(self._capture(url, params), self._loop)
+            screenshot, pages = future.result()
+        annotate_span(browser_context_pages=pages)
+        return screenshot
+
+    async def _capture(self, url, params):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool_size)
+            self._launch_lock = asyncio.Lock()
+        async with self._slots:
+            key = json.dumps(params, sort_keys=True)
+            context = None
+            healthy = False
+            try:
+                context, pages = await self._checkout(key, params)
+                page = await context.new_page()
+                try:
+                    screenshot = await self._shoot(page, url, params)
+                finally:
+                    with contextlib.suppress(self._error):
+                        await page.close()
+                healthy = True
+            except self._error as e:
+                # Launching the browser or opening a context or page failed - not the site's fault
+                raise UpstreamError('browser', 503, f"Screenshot failed: browser unavailable - {e}")
+            finally:
+                if context is not None:
+                    await self._checkin(key, context, pages + 1, healthy)
+            self.counts['pages'] += 1
+            return screenshot, pages + 1
+
+    async def _shoot(self, page, url, params):
+        try:
+            await page.goto(url, wait_until='load', timeout=BROWSER_PAGE_TIMEOUT * 1000)
+            return await page.screenshot(type='jpeg', quality=params.get('image_quality', 80),
+                                         full_page=params.get('full_page', False))
+        except self._timeout_error as e:
+            # A site that doesn't load in time is the site's fault, like a net:: error - not retried,
+            # and not held against the browser's circuit breaker
+            raise UpstreamError('browser', 400, f"Screenshot failed: {url} did not load within "
+                                                f"{BROWSER_PAGE_TIMEOUT:g}s - {e}")
+        except self._error as e:
+            # net:: errors are the site's (DNS, refused, TLS) - anything else means the browser is in trouble
+            status = 400 if 'net::ERR_' in str(e) else 503
+            raise UpstreamError('browser', status, f"Screenshot failed: {e}")
+
+    async def _launch(self):
+        """Start (or restart, after a crash) the browser - contexts of the old one are dropped"""
+        async with self._launch_lock:
+            if self._browser is not None and self._browser.is_connected():
+                return
+            if self._playwright is None:
+                self._playwright = await self._async_playwright().start()
+            self._idle = {}
+            self._browser = await self._playwright.chromium.launch(executable_path=BROWSER_EXECUTABLE_PATH,
+                                                                   args=['--disable-dev-shm-usage'])
+            self.counts['browser_launches'] += 1
+            print(f"Browser launched (pool of {self.pool_size} contexts, recycled after {self.recycle_pages} pages)")
+
+    async def _checkout(self, key, params):
+        """An idle context for this viewport, or a new one. Returns (context, pages served so far)."""
+        if self._browser is None or not self._browser.is_connected():
+            await self._launch()
+        idle = self._idle.setdefault(key, [])
+        if idle:
+            return idle.pop()
+        context = await self._browser.new_context(
+            viewport={'width': params['viewport_width'], 'height': params['viewport_height']},
+            device_scale_factor=params.get('device_scale_factor', 1),
+            is_mobile=params.get('viewport_mobile', False),
+            has_touch=params.get('viewport_has_touch', False)
+        )
+        context.set_default_timeout(BROWSER_PAGE_TIMEOUT * 1000)
+        if params.get('block_ads'):
+            await context.route(self._ad_pattern, lambda route: route.abort())
+        if params.get('block_cookie_banners'):
+            await context.route(self._consent_pattern, lambda route: route.abort())
+            await context.add_init_script(BROWSER_COOKIE_BANNER_SCRIPT)
+        self.counts['contexts_created'] += 1
+        return context, 0
+
+    async def _checkin(self, key, context, pages, healthy):
+        """Return a context to the pool, or close it once it has served its pages (or failed)"""
+        if healthy and pages < self.recycle_pages and context.browser is self._browser:
+            # A context whose browser has crashed can't be cleared - it is closed below instead
+            with contextlib.suppress(self._error):
+                await context.clear_cookies()
+                self._idle.setdefault(key, []).append((context, pages))
+                return
+        with contextlib.suppress(self._error):
+            await context.close()
+        self.counts['contexts_recycled'] += 1
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'pool_size': self.pool_size,
+            'idle_contexts': sum(len(idle) for idle in list(self._idle.values())),
+            **self.counts
+        }
+
+    def close(self):
+        """Shut the browser down (the benchmark runs several backends in one process)"""
+        async def shutdown():
+            if self._browser is not None:
+                await self._browser.close()
+            if self._playwright is not None:
+                await self._playwright.stop()
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+SCREENSHOT_BACKENDS = {'screenshotone': ScreenshotOneBackend, 'browser': BrowserBackend}
+
+
+def take_screenshot(url, viewport='desktop'):
+    """Take a screenshot with the configured backend, served from the disk cache when possible. Returns JPEG bytes."""
+    capture_params = {**VIEWPORTS[viewport]['params'], **SCREENSHOT_PARAMS}
+    cache_key = f"{normalize_url(url)}|{json.dumps(capture_params, sort_keys=True)}"
+    if screenshot_backend.name != 'screenshotone':
+        # Backends render differently - keep their captures apart (ScreenshotOne keys predate backends)
+        cache_key += f"|{screenshot_backend.name}"
+    
+    cached = screenshot_cache.get(cache_key)
+    if cached is not None:
+        print(f"Screenshot cache hit for {url}")
+        return cached
+    
+    screenshot = screenshot_backend.capture(url, capture_params)
+    screenshot_cache.set(cache_key, screenshot)
+    return screenshot
+
+
+def capture_screenshots(url, viewports):
+    """Capture every viewport of a site at the same time, so this takes as long as the slowest capture.
+
+    Returns {viewport: JPEG bytes} in the order given.
+    """
+    # Extra viewports go to the capture pool (with this thread's trace context); the first runs here
+    futures = {viewport: _capture_executor.submit(contextvars.copy_context().run, take_screenshot, url, viewport)
+               for viewport in viewports[1:]}
+    screenshots = {viewports[0]: take_screenshot(url, viewports[0])}
+    for viewport, future in futures.items():
+        screenshots[viewport] = future.result()
+    return screenshots
+
+
+def pack_screenshots(screenshots):
+    """{viewport: JPEG bytes} as one job store value: a JSON index line, then the images back to back"""
+    index = json.dumps([[viewport, len(image)] for viewport, image in screenshots.items()]).encode('utf-8')
+    return b''.join([index, b'\n', *screenshots.values()])
+
+
+def unpack_screenshots(packed):
+    newline = packed.index(b'\n')
+    screenshots = {}
+    offset = newline + 1
+    for viewport, length in json.loads(packed[:newline]):
+        screenshots[viewport] = packed[offset:offset + length]
+        offset += length
+    return screenshots
+
+
+def preprocess_screenshot(image_bytes, max_pixels=None, max_bytes=None, quality=None, min_quality=None):
+    """Downscale a screenshot to the pixel budget and re-encode it as JPEG within the byte budget.
+
+    A capture that is already within both budgets is returned untouched, so it isn't recompressed
+    twice. Returns (jpeg bytes, details).
+    """
+    max_pixels = max_pixels or SCREENSHOT_MAX_PIXELS
+    max_bytes = max_bytes or SCREENSHOT_MAX_BYTES
+    quality = quality or SCREENSHOT_JPEG_QUALITY
+    min_quality = min_quality or SCREENSHOT_MIN_JPEG_QUALITY
+    
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        original_size = image.size
+        pixels = image.width * image.height
+        if pixels <= max_pixels and len(image_bytes) <= max_bytes and image.format == 'JPEG':
+            return image_bytes, {
+                'width': image.width,
+                'height': image.height,
+                'quality': None,
+                'bytes_in': len(image_bytes),
+                'bytes_out': len(image_bytes)
+            }
+        
+        size = image.size
+        if pixels > max_pixels:
+            scale = math.sqrt(max_pixels / pixels)
+            size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+            # Let the JPEG decoder do the coarse downscale (DCT scaling) before resampling
+            image.draft('RGB', size)
+        image = image.convert('RGB')
+        if image.size != size:
+            image = image.resize(size, Image.LANCZOS)
+    
+    while True:
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+        if output.tell() <= max_bytes or quality <= min_quality:
+            break
+        quality = max(min_quality, quality - 10)
+    
+    return output.getvalue(), {
+        'width': image.width,
+        'height': image.height,
+        'original_width': original_size[0],
+        'original_height': original_size[1],
+        'quality': quality,
+        'bytes_in': len(image_bytes),
+        'bytes_out': output.tell()
+    }
+
+
+def estimate_image_tokens(width, height):
+    """Approximate input tokens Claude charges for an image of this size (larger images are downscaled to ~1600)"""
+    return min(1600, math.ceil(width * height / 750))
+
+
+ANALYSIS_MODES = ('realtime', 'batch')
+
+
+def anthropic_headers():
+    return {
+        "Content-Type": "application/json",
+        "x-api-key": CLAUDE_API_KEY,
+        "anthropic-version": "2023-06-01"
+    }
+
+
+def build_analysis_request(images, firm_type=None):
+    """Messages API request body for grading screenshots ({viewport: base64 data}), shared by realtime
+    calls and Message Batches.
+
+    The rubric goes first, in the system prompt, marked for prompt caching: it is identical for every
+    audit of a firm type, so repeat requests read it from the cache instead of paying for it again.
+    """
+    viewports = tuple(images)
+    content = []
+    for viewport, data in images.items():
+        if viewports != ('desktop',):
+            params = VIEWPORTS[viewport]['params']
+            content.append({
+                "type": "text",
+                "text": f"{VIEWPORTS[viewport]['label']} viewport ({params['viewport_width']}x{params['viewport_height']}):"
+            })
+        content.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": "image/jpeg",
+                "data": data
+            }
+        })
+    content.append({
+        "type": "text",
+        "text": "Audit this website screenshot." if viewports == ('desktop',) else "Audit this website from these screenshots."
+    })
+    return {
+        "model": "claude-sonnet-4-20250514",
+        "max_tokens": 2048,
+        "system": [{
+            "type": "text",
+            "text": get_grading_prompt(firm_type, viewports),
+            "cache_control": {"type": "ephemeral"}
+        }],
+        "messages": [{
+            "role": "user",
+            "content": content
+        }]
+    }
+
+
+def screenshot_placeholders(screenshots):
+    """Stand-in image data for each viewport, swapped for the real base64 by json_with_screenshots()"""
+    return {viewport: f"__screenshot_{viewport}__" for viewport in screenshots}
+
+
+def json_with_screenshots(document, screenshots):
+    """Serialize a request whose image data are screenshot_placeholders(), as a list of byte chunks.
+
+    The screenshots are base64-encoded straight into the body instead of going through base64
+    strings and a JSON string first, so only the raw bytes and the finished body are held.
+    """
+    rest = json.dumps(document).encode('utf-8')
+    chunks = []
+    for viewport, placeholder in screenshot_placeholders(screenshots).items():
+        before, rest = rest.split(placeholder.encode('utf-8'), 1)
+        chunks += [before, base64.b64encode(screenshots[viewport])]
+    chunks.append(rest)
+    return chunks
+
+
+TOKEN_USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+token_usage = {'requests': 0, **{field: 0 for field in TOKEN_USAGE_FIELDS}}
+_token_usage_lock = threading.Lock()
+
+
+def record_token_usage(usage):
+    """Add a response's token usage to the process counters. Returns just the token counts."""
+    counts = {field: (usage or {}).get(field) or 0 for field in TOKEN_USAGE_FIELDS}
+    with _token_usage_lock:
+        token_usage['requests'] += 1
+        for field, count in counts.items():
+            token_usage[field] += count
+    return counts
+
+
+ANTHROPIC_ERROR_STATUS = {
+    'invalid_request_error': 400,
+    'rate_limit_error': 429,
+    'api_error': 500,
+    'overloaded_error': 529
+}
+
+
+def anthropic_error(error, context):
+    """UpstreamError for an error object returned inside an Anthropic response body"""
+    error = error.get('error', error)
+    return UpstreamError('anthropic', ANTHROPIC_ERROR_STATUS.get(error.get('type'), 500),
+                         f"{context}: {error.get('type')} - {error.get('message')}")
+
+
+AUDIT_GRADES = ('A', 'B', 'C', 'D', 'F')
+# Lowest score for each grade, from the bands in the grading prompt
+AUDIT_GRADE_BANDS = [(90, 'A'), (80, 'B'), (70, 'C'), (60, 'D'), (0, 'F')]
+AUDIT_CATEGORIES = ('credibility_trust', 'client_experience', 'differentiation', 'conversion_path')
+AUDIT_CATEGORY_MAX = 25
+AUDIT_TEXT_FIELDS = ('summary', 'bottom_line', 'competitive_insight')
+AUDIT_RECOMMENDATION_FIELDS = ('issue', 'impact', 'recommendation')
+AUDIT_PRIORITIES = ('HIGH', 'MEDIUM', 'LOW')
+audit_repairs = {'deterministic': 0, 'repair_calls': 0, 'failed': 0}
+_audit_repairs_lock = threading.Lock()
+
+
+def count_audit_repair(outcome):
+    """Add one to an audit repair counter; finalize_audit runs on several stage threads at once"""
+    with _audit_repairs_lock:
+        audit_repairs[outcome] += 1
+
+
+class AuditValidationError(ValueError):
+    """Model output that can't be turned into an audit the report template can render"""
+
+    def __init__(self, problems):
+        super().__init__('; '.join(problems))
+        self.problems = problems
+
+
+def grade_for_score(score):
+    """Letter grade for an overall score"""
+    for floor, grade in AUDIT_GRADE_BANDS:
+        if score >= floor:
+            return grade
+    return 'F'
+
+
+def coerce_score(value, maximum):
+    """A score as a whole number within 0..maximum, or None if it isn't a number at all"""
+    if isinstance(value, bool):
+        return None
+    try:
+        score = float(value)
+    except (TypeError, ValueError):
+        return None
+    # json.loads accepts Infinity and NaN (and "inf" parses as a float) - they are no score at all
+    if not math.isfinite(score):
+        return None
+    return min(max(round(score), 0), maximum)
+
+
+def strip_trailing_commas(text):
+    """Drop commas that directly precede a closing } or ] (outside of strings)"""
+    output = []
+    in_string = escaped = False
+    trailing = None
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+            trailing = None
+        elif char in '}]':
+            if trailing is not None:
+                del output[trailing]
+            trailing = None
+        elif char == ',':
+            trailing = len(output)
+        elif not char.isspace():
+            trailing = None
+        output.append(char)
+    return ''.join(output)
+
+
+def parse_json_object(candidate):
+    """Parse one {...} candidate, dropping trailing commas if it doesn't parse as it is. Returns (data, fixes)."""
+    try:
+        return json.loads(candidate), []
+    except ValueError as e:
+        try:
+            return json.loads(strip_trailing_commas(candidate)), ['removed trailing commas']
+        except ValueError:
+            raise AuditValidationError([f"invalid JSON: {str(e)}"])
+
+
+def looks_like_audit(data):
+    """Whether parsed JSON is the audit object, not some other braces the model wrote around it"""
+    return isinstance(data, dict) and any(key in data for key in ('overall_score', 'categories', *AUDIT_TEXT_FIELDS))
+
+
+def find_audit_object(text):
+    """The first balanced {...} in text that parses as the audit. Returns (start, end, data, fixes) or None.
+
+    A braced fragment in prose before the audit ("I'll return {...} as requested") is skipped.
+    """
+    start = text.find('{')
+    while start != -1:
+        depth = 0
+        in_string = escaped = False
+        for end in range(start, len(text)):
+            char = text[end]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in '{[':
+                depth += 1
+            elif char in '}]':
+                depth -= 1
+                if depth == 0:
+                    try:
+                        data, fixes = parse_json_object(text[start:end + 1])
+                    except AuditValidationError:
+                        break
+                    if looks_like_audit(data):
+                        return start, end, data, fixes
+                    break
+        start = text.find('{', start + 1)
+    return None
+
+
+def load_audit_json(text):
+    """Parse the audit JSON object out of model output. Returns (data, fixes).
+
+    Code fences or stray prose around the object are ignored, and trailing commas are dropped
+    if the object doesn't parse as it is.
+    """
+    found = find_audit_object(text)
+    if found is not None:
+        start, end, data, parse_fixes = found
+    else:
+        # Nothing parses as the audit - report why the outermost braces don't
+        start, end = text.find('{'), text.rfind('}')
+        if start == -1 or end < start:
+            raise AuditValidationError(['no JSON object in the output'])
+        data, parse_fixes = parse_json_object(text[start:end + 1])
+    fixes = []
+    before = text[:start].strip()
+    if before.startswith('```'):
+        before = before[3:].strip().removeprefix('json').strip()
+    if before or text[end + 1:].strip().strip('`').strip():
+        fixes.append('ignored text around the JSON')
+    fixes += parse_fixes
+    if not isinstance(data, dict):
+        raise AuditValidationError(['the JSON is not an object'])
+    return data, fixes
+
+
+def repair_audit(data):
+    """Apply the fixes that need no model: whole-number scores clamped to their range, the overall
+    score as the sum of the category scores, the grade from the score's band, and upper-case
+    priorities. Returns (audit, fixes).
+    """
+    audit = dict(data)
+    fixes = []
+    
+    categories = audit.get('categories')
+    category_scores = []
+    if isinstance(categories, dict):
+        categories = audit['categories'] = {
+            key: dict(value) if isinstance(value, dict) else value for key, value in categories.items()
+        }
+        for key in AUDIT_CATEGORIES:
+            category = categories.get(key)
+            if not isinstance(category, dict):
+                continue
+            score = coerce_score(category.get('score'), AUDIT_CATEGORY_MAX)
+            if score is None:
+                continue
+            if score != category.get('score') or not isinstance(category.get('score'), int):
+                fixes.append(f"{key} score {category.get('score')!r} -> {score}")
+                category['score'] = score
+            category_scores.append(score)
+    
+    overall = coerce_score(audit.get('overall_score'), 100)
+    if len(category_scores) == len(AUDIT_CATEGORIES) and overall != sum(category_scores):
+        overall = sum(category_scores)
+    if overall is not None and (overall != audit.get('overall_score') or not isinstance(audit.get('overall_score'), int)):
+        fixes.append(f"overall_score {audit.get('overall_score')!r} -> {overall}")
+        audit['overall_score'] = overall
+    if overall is not None and audit.get('grade') != grade_for_score(overall):
+        fixes.append(f"grade {audit.get('grade')!r} -> {grade_for_score(overall)} for a score of {overall}")
+        audit['grade'] = grade_for_score(overall)
+    
+    if isinstance(audit.get('recommendations'), list):
+        audit['recommendations'] = [dict(rec) if isinstance(rec, dict) else rec for rec in audit['recommendations']]
+        for rec in audit['recommendations']:
+            if isinstance(rec, dict) and isinstance(rec.get('priority'), str):
+                priority = rec['priority'].strip().upper()
+                if priority != rec['priority']:
+                    fixes.append(f"priority {rec['priority']!r} -> {priority}")
+                    rec['priority'] = priority
+    
+    # Per-viewport notes are optional - drop what the report can't show rather than repairing it
+    if 'viewports' in audit:
+        viewports = audit['viewports'] if isinstance(audit['viewports'], dict) else {}
+        kept = {name: view for name, view in viewports.items()
+                if isinstance(view, dict) and all(isinstance(view.get(field), str) and view[field].strip()
+                                                  for field in ('findings', 'opportunity'))}
+        if len(kept) != len(viewports) or not isinstance(audit['viewports'], dict):
+            fixes.append(f"dropped unusable viewports entries ({', '.join(sorted(set(viewports) - set(kept))) or 'all'})")
+        audit['viewports'] = kept
+    return audit, fixes
+
+
+def validate_audit(audit):
+    """Every problem that would stop the report template rendering this audit faithfully"""
+    problems = []
+    overall = audit.get('overall_score')
+    if not isinstance(overall, int) or not 0 <= overall <= 100:
+        problems.append('overall_score must be a whole number from 0 to 100')
+    elif audit.get('grade') != grade_for_score(overall):
+        problems.append(f"grade must be {grade_for_score(overall)} for a score of {overall}")
+    
+    categories = audit.get('categories')
+    if not isinstance(categories, dict):
+        problems.append('categories must be an object')
+        categories = {}
+    for key in AUDIT_CATEGORIES:
+        category = categories.get(key)
+        if not isinstance(category, dict):
+            problems.append(f"categories.{key} is missing")
+            continue
+        score = category.get('score')
+        if not isinstance(score, int) or not 0 <= score <= AUDIT_CATEGORY_MAX:
+            problems.append(f"categories.{key}.score must be a whole number from 0 to {AUDIT_CATEGORY_MAX}")
+        for field in ('findings', 'opportunity'):
+            if not isinstance(category.get(field), str) or not category[field].strip():
+                problems.append(f"categories.{key}.{field} must be a non-empty string")
+    
+    recommendations = audit.get('recommendations')
+    if not isinstance(recommendations, list) or not recommendations:
+        problems.append('recommendations must be a non-empty list')
+        recommendations = []
+    for index, rec in enumerate(recommendations):
+        if not isinstance(rec, dict):
+            problems.append(f"recommendations[{index}] must be an object")
+            continue
+        if rec.get('priority') not in AUDIT_PRIORITIES:
+            problems.append(f"recommendations[{index}].priority must be one of {', '.join(AUDIT_PRIORITIES)}")
+        for field in AUDIT_RECOMMENDATION_FIELDS:
+            if not isinstance(rec.get(field), str) or not rec[field].strip():
+                problems.append(f"recommendations[{index}].{field} must be a non-empty string")
+    
+    for field in AUDIT_TEXT_FIELDS:
+        if not isinstance(audit.get(field), str) or not audit[field].strip():
+            problems.append(f"{field} must be a non-empty string")
+    return problems
+
+
+def check_audit(text):
+    """Parse, fix and validate model output. Returns (audit or None, fixes, problems)."""
+    try:
+        data, fixes = load_audit_json(text)
+    except AuditValidationError as e:
+        return None, [], e.problems
+    audit, more_fixes = repair_audit(data)
+    return audit, fixes + more_fixes, validate_audit(audit)
+
+
+def finalize_audit(text):
+    """Turn model output into a validated audit without redoing the vision call.
+
+    Deterministic fixes are applied first; if problems remain, one text-only repair call (no image)
+    gets the output and the list of problems. Returns (audit, details) or raises AuditValidationError.
+    """
+    with JSON_PARSE_DURATION.time():
+        audit, fixes, problems = check_audit(text)
+    details = {'fixes': fixes} if fixes else {}
+    if fixes:
+        count_audit_repair('deterministic')
+    if not problems:
+        return audit, details
+    
+    if not ANALYSIS_REPAIR_CALLS:
+        count_audit_repair('failed')
+        raise AuditValidationError(problems)
+    print(f"Audit output needs repair: {'; '.join(problems)}")
+    repaired_text, usage = repair_with_claude(text, problems)
+    audit, fixes, remaining = check_audit(repaired_text)
+    details['repair'] = {'problems': problems, 'fixes_after': fixes, **usage}
+    if remaining:
+        count_audit_repair('failed')
+        raise AuditValidationError(remaining)
+    return audit, details
+
+
+# Only types repair_audit can't fix - a score like "N/A" is recomputed from the categories
+AUDIT_FIELD_CHECKS = {
+    'grade': lambda value: isinstance(value, str),
+    'categories': lambda value: isinstance(value, dict),
+    'recommendations': lambda value: isinstance(value, list)
+}
+
+
+class MalformedOutputError(Exception):
+    """The model's answer isn't the audit JSON we asked for.
+
+    text and usage are what the stream had produced when it was abandoned.
+    """
+    text = ''
+    usage = None
+
+
+class StreamingAuditParser:
+    """Follows streamed model output and checks the audit JSON while it is still being generated.
+
+    feed() returns True once a top-level object has closed and parses as the audit. Anything before
+    it (a code fence, a "Here is the audit" preamble, braces in that prose) is skipped, as
+    load_audit_json would: a closed object that isn't the audit is dropped and the scan goes on
+    from the next '{'. It raises
+    MalformedOutputError as soon as a required field has a type that repair_audit can't fix.
+    Anything fixable is left to finalize_audit.
+    """
+
+    def __init__(self):
+        self.preamble = ''
+        self.done = False
+        self.reset()
+
+    def reset(self):
+        self.chars = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.key = None
+        self.key_start = None
+        self.value_start = None
+
+    def feed(self, text):
+        for index, char in enumerate(text):
+            if self.done:
+                break
+            if not self.chars:
+                if char == '{':
+                    self.chars.append(char)
+                    self.depth = 1
+                    continue
+                self.preamble += char
+                continue
+            
+            position = len(self.chars)
+            self.chars.append(char)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.key_start is not None:
+                        self.key = json.loads(''.join(self.chars[self.key_start:position + 1]))
+                        self.key_start = None
+            elif char == '"':
+                self.in_string = True
+                if self.depth == 1 and self.value_start is None:
+                    self.key_start = position
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end_value(position)
+                    if self.is_audit():
+                        self.done = True
+                    else:
+                        # Braces in the preamble - rescan what followed its '{'
+                        rest = ''.join(self.chars[1:]) + text[index + 1:]
+                        self.preamble += '{'
+                        self.reset()
+                        return self.feed(rest)
+            elif char == ':' and self.depth == 1:
+                self.value_start = position + 1
+            elif char == ',' and self.depth == 1:
+                self.end_value(position)
+        return self.done
+
+    def is_audit(self):
+        try:
+            data, _ = parse_json_object(self.text())
+        except AuditValidationError:
+            return False
+        return looks_like_audit(data)
+
+    def end_value(self, position):
+        """Check a top-level value that has just been completed"""
+        if self.value_start is None:
+            return
+        key, text = self.key, ''.join(self.chars[self.value_start:position])
+        self.key = self.value_start = None
+        check = AUDIT_FIELD_CHECKS.get(key)
+        if check is None:
+            return
+        try:
+            value = json.loads(text)
+        except ValueError:
+            # Not a clear deviation yet - leave it to parsing the whole object
+            return
+        if not check(value):
+            raise MalformedOutputError(f"unexpected {key}: {text.strip()[:80]}")
+
+    def text(self):
+        return ''.join(self.chars)
+
+
+analysis_stream_aborts = 0
+_stream_aborts_lock = threading.Lock()
+# Threads start on first use, so this is safe to create at import
+_stream_drainer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="stream-drain")
+
+
+def stream_events(lines):
+    """Decode server-sent event lines into event dicts"""
+    for line in lines:
+        if line and line.startswith('data:'):
+            yield json.loads(line[5:])
+
+
+def drain_audit_stream(response, events):
+    """Read the tail of a stream after the audit JSON closed, to count its output tokens and
+    hand the connection back to the pool"""
+    try:
+        for event in events:
+            if event['type'] == 'message_delta':
+                with _token_usage_lock:
+                    token_usage['output_tokens'] += (event.get('usage') or {}).get('output_tokens') or 0
+    except Exception as e:
+        print(f"Failed to drain analysis stream: {str(e)}")
+    finally:
+        response.close()
+
+
+def read_audit_stream(response):
+    """Read a streamed Messages response until the audit JSON object closes. Returns (text, token usage).
+
+    The rest of the stream (a closing fence and the final usage event) is read in the background,
+    so output tokens reach the process counters but not the job's timings.
+    """
+    parser = StreamingAuditParser()
+    usage = {}
+    response.encoding = 'utf-8'
+    events = stream_events(response.iter_lines(decode_unicode=True))
+    try:
+        for event in events:
+            if event['type'] == 'message_start':
+                usage.update(event['message'].get('usage') or {}, output_tokens=0)
+            elif event['type'] == 'content_block_delta' and event['delta'].get('type') == 'text_delta':
+                if parser.feed(event['delta']['text']):
+                    break
+            elif event['type'] == 'error':
+                raise anthropic_error(event['error'], "Claude stream failed")
+        if not parser.done:
+            raise MalformedOutputError("the answer ended before the audit JSON was complete")
+    except MalformedOutputError as e:
+        response.close()
+        e.text, e.usage = parser.preamble + parser.text(), record_token_usage(usage)
+        raise
+    except Exception:
+        response.close()
+        raise
+    _stream_drainer.submit(drain_audit_stream, response, events)
+    return parser.text(), record_token_usage(usage)
+
+
+def analyze_with_claude(screenshots, firm_type=None):
+    """Analyze screenshots ({viewport: JPEG bytes}) with Claude Vision API in one request. Returns (text, token usage).
+
+    When streaming, output that is clearly not the audit JSON is abandoned and requested again
+    straight away, and the call returns as soon as the JSON object closes. Once the retries are used
+    up, the last output is returned as it is, for finalize_audit to repair.
+    """
+    global analysis_stream_aborts
+    url = f"{ANTHROPIC_API_URL}/v1/messages"
+    headers = anthropic_headers()
+    request_body = build_analysis_request(screenshot_placeholders(screenshots), firm_type)
+    if ANALYSIS_STREAMING:
+        request_body['stream'] = True
+    # Serialized once, so retries resend the same bytes
+    body = b''.join(json_with_screenshots(request_body, screenshots))
+    annotate_span(request_bytes=len(body))
+    
+    for attempt in range(ANALYSIS_FORMAT_RETRIES + 1):
+        with upstream_call('anthropic'):
+            response = send_rate_limited(
+                'anthropic', lambda: get_session('anthropic').post(
+                    url, data=body, headers=headers, timeout=90, stream=ANALYSIS_STREAMING
+                )
+            )
+            if response.status_code != 200:
+                # Reading the error body also releases the connection
+                raise UpstreamError('anthropic', response.status_code,
+                                    f"Claude failed: {response.status_code} - {response.text}")
+            if not ANALYSIS_STREAMING:
+                result = response.json()
+                return result['content'][0]['text'], record_token_usage(result.get('usage'))
+            try:
+                return read_audit_stream(response)
+            except MalformedOutputError as e:
+                if attempt == ANALYSIS_FORMAT_RETRIES:
+                    print(f"Analysis still malformed ({str(e)}), repairing it instead")
+                    return e.text, e.usage
+                with _stream_aborts_lock:
+                    analysis_stream_aborts += 1
+                print(f"Abandoning malformed analysis ({str(e)}), asking again")
+
+
+AUDIT_REPAIR_PROMPT = """You fix website audit JSON written by another model. You get the audit and a list of problems found in it.
+
+Return ONLY the corrected JSON object. Fix the listed problems and keep every other score and all wording exactly as it is. overall_score is the sum of the four category scores (each 0-25), and the grade must match it: 90-100 A, 80-89 B, 70-79 C, 60-69 D, below 60 F.
+
+The JSON must have exactly this format:
+""" + AUDIT_JSON_FORMAT
+
+
+def repair_with_claude(audit_text, problems):
+    """Ask a small model to fix audit JSON that failed validation. Text only - the screenshot isn't resent.
+
+    Returns (text, token usage).
+    """
+    payload = {
+        "model": ANALYSIS_REPAIR_MODEL,
+        "max_tokens": 2048,
+        "system": AUDIT_REPAIR_PROMPT,
+        "messages": [{
+            "role": "user",
+            "content": "Problems:\n" + '\n'.join(f"- {problem}" for problem in problems) + f"\n\nAudit:\n{audit_text}"
+        }]
+    }
+    
+    with upstream_call('anthropic'):
+        response = send_rate_limited(
+            'anthropic', lambda: get_session('anthropic').post(
+                f"{ANTHROPIC_API_URL}/v1/messages", json=payload, headers=anthropic_headers(), timeout=60
+            )
+        )
+        if response.status_code != 200:
+            raise UpstreamError('anthropic', response.status_code,
+                                f"Audit repair failed: {response.status_code} - {response.text}")
+    
+    count_audit_repair('repair_calls')
+    result = response.json()
+    return result['content'][0]['text'], record_token_usage(result.get('usage'))
+
+
+def create_message_batch(screenshots_by_id):
+    """Submit analyses as one Message Batch ({custom_id: (screenshots, firm_type)}). Returns the batch ID."""
+    chunks = [b'{"requests": [']
+    for index, (custom_id, (screenshots, firm_type)) in enumerate(screenshots_by_id.items()):
+        if index:
+            chunks.append(b', ')
+        chunks.extend(json_with_screenshots(
+            {"custom_id": custom_id,
+             "params": build_analysis_request(screenshot_placeholders(screenshots), firm_type)}, screenshots
+        ))
+    chunks.append(b']}')
+    body = b''.join(chunks)
+    del chunks
+    
+    with upstream_call('anthropic'):
+        response = send_rate_limited(
+            'anthropic', lambda: get_session('anthropic').post(
+                f"{ANTHROPIC_API_URL}/v1/messages/batches", data=body, headers=anthropic_headers(), timeout=120
+            )
+        )
+        if response.status_code != 200:
+            raise UpstreamError('anthropic', response.status_code,
+                                f"Message Batch submit failed: {response.status_code} - {response.text}")
+    return response.json()['id']
+
+
+def get_message_batch(message_batch_id):
+    """Current processing status of a Message Batch"""
+    with upstream_call('anthropic'):
+        response = send_rate_limited(
+            'anthropic', lambda: get_session('anthropic').get(
+                f"{ANTHROPIC_API_URL}/v1/messages/batches/{message_batch_id}", headers=anthropic_headers(), timeout=30
+            )
+        )
+        if response.status_code != 200:
+            raise UpstreamError('anthropic', response.status_code,
+                                f"Message Batch poll failed: {response.status_code} - {response.text}")
+    return response.json()
+
+
+def message_batch_results(results_url):
+    """Yield (custom_id, result) for every request in an ended Message Batch"""
+    with upstream_call('anthropic'):
+        response = send_rate_limited(
+            'anthropic', lambda: get_session('anthropic').get(
+                results_url, headers=anthropic_headers(), timeout=300, stream=True
+            )
+        )
+        if response.status_code != 200:
+            raise UpstreamError('anthropic', response.status_code,
+                                f"Message Batch results failed: {response.status_code} - {response.text}")
+    with response:
+        for line in response.iter_lines():
+            if line:
+                entry = json.loads(line)
+                yield entry['custom_id'], entry['result']
+
+
+_r2_client = None
+_r2_client_pid = None
+_r2_client_lock = threading.Lock()
+
+
+def get_r2_client():
+    """Shared R2 client, created on first use (boto3 clients are thread-safe once built)"""
+    global _r2_client, _r2_client_pid
+    with _r2_client_lock:
+        if _r2_client is None or _r2_client_pid != os.getpid():
+            _r2_client = boto3.client(
+                's3',
+                endpoint_url=R2_ENDPOINT,
+                aws_access_key_id=R2_ACCESS_KEY_ID,
+                aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+                config=Config(signature_version='s3v4', max_pool_connections=HTTP_POOL_MAXSIZE)
+            )
+            _r2_client_pid = os.getpid()
+        return _r2_client
+
+
+def upload_to_r2(html_content, filename):
+    """Upload gzipped HTML report to Cloudflare R2. Returns the public URL and a timing breakdown."""
+    started = time.perf_counter()
+    s3_client = get_r2_client()
+    client_done = time.perf_counter()
+    
+    raw = html_content.encode('utf-8')
+    body = gzip.compress(raw, compresslevel=9, mtime=0)
+    compress_done = time.perf_counter()
+    
+    with upstream_call('r2'):
+        response = s3_client.put_object(
+            Bucket=R2_BUCKET_NAME,
+            Key=filename,
+            Body=body,
+            ContentType='text/html; charset=utf-8',
+            ContentEncoding='gzip',
+            CacheControl=R2_CACHE_CONTROL
+        )
+    annotate_span(r2_status=response.get('ResponseMetadata', {}).get('HTTPStatusCode'))
+    put_done = time.perf_counter()
     
     public_url = f"{R2_PUBLIC_URL}/{filename}"
-    return public_url
+    timings = {
+        'client_ms': round((client_done - started) * 1000, 1),
+        'compress_ms': round((compress_done - client_done) * 1000, 1),
+        'put_ms': round((put_done - compress_done) * 1000, 1),
+        'raw_bytes': len(raw),
+        'gzip_bytes': len(body)
+    }
+    return public_url, timings
+
+
+def ghl_payload(job, success=True, error=None):
+    """The webhook body GHL gets for a finished (or failed) audit"""
+    return {
+        "contact_id": job['contact_id'],
+        "contact_email": job['contact_email'],
+        "contact_name": job['contact_name'],
+        "website_url": job['website_url'],
+        "success": success,
+        "report_url": job['report_url'] if success else None,
+        "audit_data": job['audit_data'] if success else None,
+        "error": error,
+        "processed_at": datetime.now().isoformat()
+    }
+
+
+def post_to_ghl(payloads):
+    """POST callbacks to the GHL webhook - one payload per request, or {"callbacks": [...]} when batching.
+
+    Raises UpstreamError for an error status; the response is returned otherwise.
+    """
+    body = payloads[0] if GHL_CALLBACK_BATCH_SIZE == 1 else {"callbacks": payloads}
+    with GHL_CALLBACK_DURATION.time():
+        response = get_session('ghl').post(GHL_WEBHOOK_URL, json=body, timeout=GHL_CALLBACK_TIMEOUT)
+    if response.status_code >= 400:
+        error = UpstreamError('ghl', response.status_code,
+                              f"GHL callback failed: {response.status_code} - {response.text[:200]}")
+        error.retry_after = parse_retry_after(response.headers.get('retry-after'))
+        raise error
+    return response
+
+
+# Tracing - the job ID travels with the work in a context variable, so every log line and span a
+# stage emits can be tied back to its job. Executor threads don't inherit the caller's context,
+# so execute_stage sets it on the stage's own thread.
+current_job_id = contextvars.ContextVar('current_job_id', default=None)
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def log_event(event, **fields):
+    """Print one structured JSON log line tagged with the current job ID"""
+    if not TRACE_LOGS:
+        return
+    record = {'ts': datetime.now(timezone.utc).isoformat(), 'event': event, 'job_id': current_job_id.get(), **fields}
+    print(json.dumps(record, default=str))
+
+
+@contextlib.contextmanager
+def job_context(job_id):
+    """Tag everything logged inside the block with a job ID"""
+    token = current_job_id.set(job_id)
+    try:
+        yield
+    finally:
+        current_job_id.reset(token)
+
+
+@contextlib.contextmanager
+def span(name, **fields):
+    """Log a span for the block: start and end time, duration, outcome and any annotations.
+
+    Yields the span's fields, which annotate_span() also adds to from deeper in the call stack.
+    Setting a 'status' field overrides the ok/error outcome.
+    """
+    fields = dict(fields)
+    token = current_span.set(fields)
+    started_at = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        yield fields
+    except Exception as e:
+        status = 'error'
+        fields['error'] = str(e)[:300]
+        fields['error_status'] = error_status(e)
+        raise
+    finally:
+        current_span.reset(token)
+        status = fields.pop('status', status)
+        log_event('span', span=name, start=started_at.isoformat(), end=datetime.now(timezone.utc).isoformat(),
+                  duration_ms=round((time.perf_counter() - started) * 1000, 1), status=status, **fields)
+
+
+def annotate_span(**fields):
+    """Add fields (upstream status, byte sizes...) to the innermost open span, if any"""
+    fields_ = current_span.get()
+    if fields_ is not None:
+        fields_.update(fields)
+
+
+def result_sizes(result):
+    """Byte sizes of the bytes and text values a stage produced, for its span"""
+    sizes = {}
+    for key, value in result.items():
+        if isinstance(value, bytes):
+            sizes[f'{key}_bytes'] = len(value)
+        elif isinstance(value, str):
+            sizes[f'{key}_bytes'] = len(value.encode('utf-8'))
+        elif isinstance(value, dict) and value and all(isinstance(item, bytes) for item in value.values()):
+            sizes[f'{key}_bytes'] = {name: len(item) for name, item in value.items()}
+    return sizes
+
+
+# Sampling profiler - a background thread reads the stacks of threads running a profiled job's
+# stage every PROFILE_INTERVAL_MS and counts them as folded stacks. Jobs that aren't sampled pay
+# nothing: the thread sleeps while no stage is registered.
+_profile_lock = threading.Lock()
+_profile_wakeup = threading.Event()
+_profiled_threads = {}
+_profile_samples = {}
+
+
+def profile_sample_rate():
+    """Share of jobs to profile - the runtime setting if one was made, else PROFILE_SAMPLE_RATE"""
+    if not _worker_home:
+        # A standalone queue worker has no job store to read settings from
+        return PROFILE_SAMPLE_RATE
+    return float(get_setting('profile_sample_rate', PROFILE_SAMPLE_RATE))
+
+
+def folded_stack(frame):
+    """A thread's stack as 'outer;...;inner' frames, the format flame graph tools read"""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+def profiler_loop():
+    """Sample the stacks of every thread registered by profile_stage()"""
+    while True:
+        with _profile_lock:
+            targets = dict(_profiled_threads)
+        if not targets:
+            _profile_wakeup.wait()
+            _profile_wakeup.clear()
+            continue
+        frames = sys._current_frames()
+        with _profile_lock:
+            for thread_id, key in targets.items():
+                frame = frames.get(thread_id)
+                samples = _profile_samples.get(key)
+                if frame is None or samples is None:
+                    continue
+                stack = folded_stack(frame)
+                samples[stack] = samples.get(stack, 0) + 1
+        del frames
+        time.sleep(PROFILE_INTERVAL_MS / 1000)
+
+
+def write_profile(job_id, stage, samples):
+    """Append a stage's samples to the job's folded-stack file, each stack rooted at the stage name"""
+    if not samples:
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{job_id}.folded")
+    with open(path, 'a') as f:
+        for stack, count in samples.items():
+            f.write(f"{stage};{stack} {count}\n")
+    log_event('profile', stage=stage, samples=sum(samples.values()), path=path)
+
+
+@contextlib.contextmanager
+def profile_stage(job, stage):
+    """Sample this thread's stack while a stage of a profiled job runs"""
+    if not job.get('profiled'):
+        yield
+        return
+    key = (job['id'], stage)
+    thread_id = threading.get_ident()
+    with _profile_lock:
+        _profile_samples[key] = {}
+        _profiled_threads[thread_id] = key
+    _profile_wakeup.set()
+    try:
+        yield
+    finally:
+        with _profile_lock:
+            _profiled_threads.pop(thread_id, None)
+            samples = _profile_samples.pop(key, None)
+        write_profile(job['id'], stage, samples)
+
+
+# Job store - every accepted audit is persisted so a restart can resume it
+JOB_STAGES = ['screenshot', 'preprocess', 'analysis', 'render', 'upload', 'callback']
+JOB_STORE_MIGRATIONS = [
+    ('dedupe_key', 'TEXT'),
+    ('parent_id', 'TEXT'),
+    ('timings', 'TEXT'),
+    ('batch_id', 'TEXT'),
+    ('park_count', 'INTEGER DEFAULT 0'),
+    ('park_until', 'REAL'),
+    ('analysis_mode', 'TEXT'),
+    ('message_batch_id', 'TEXT'),
+    ('screenshots', 'BLOB')
+]
+JOB_JSON_COLUMNS = ['stages', 'audit_data', 'timings']
+_db_local = threading.local()
+
+
+def get_db():
+    """Per-thread SQLite connection to the job store"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None or getattr(_db_local, 'pid', None) != os.getpid():
+        conn = sqlite3.connect(JOB_DB_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+    return conn
+
+
+def init_db():
+    """Create the job store tables if they don't exist"""
+    get_db().execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            contact_id TEXT,
+            contact_email TEXT,
+            contact_name TEXT,
+            website_url TEXT NOT NULL,
+            firm_type TEXT,
+            status TEXT NOT NULL,
+            stages TEXT NOT NULL,
+            screenshot TEXT,
+            audit_data TEXT,
+            html_report TEXT,
+            report_url TEXT,
+            error TEXT,
+            owner TEXT,
+            lease_until REAL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    # Columns added after the table was first created
+    existing = {row['name'] for row in get_db().execute('PRAGMA table_info(jobs)')}
+    for column, column_type in JOB_STORE_MIGRATIONS:
+        if column not in existing:
+            get_db().execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+    get_db().execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until)')
+    get_db().execute('CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key, status)')
+    get_db().execute('CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent_id)')
+    get_db().execute('CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch_id, status)')
+    get_db().execute("""
+        CREATE TABLE IF NOT EXISTS batches (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            concurrency INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    get_db().execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL,
+            owner TEXT,
+            lease_until REAL,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    get_db().execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt)')
+    get_db().execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """)
+
+
+_settings_cache = {}
+
+
+def get_setting(key, default=None):
+    """A runtime setting shared by every worker process, re-read at most every SETTINGS_CACHE_SECONDS"""
+    cached = _settings_cache.get(key)
+    if cached is not None and time.time() - cached[1] < SETTINGS_CACHE_SECONDS:
+        return cached[0]
+    row = get_db().execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+    value = json.loads(row['value']) if row else default
+    _settings_cache[key] = (value, time.time())
+    return value
+
+
+def set_setting(key, value):
+    """Change a runtime setting for every worker process"""
+    get_db().execute(
+        'INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+        (key, json.dumps(value))
+    )
+    _settings_cache.pop(key, None)
+
+
+def store_id():
+    """Identifier of this job store, the same for every process using it - workers send outcomes back to it"""
+    value = get_setting('store_id')
+    if value is None:
+        get_db().execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('store_id', ?)",
+                         (json.dumps(uuid.uuid4().hex),))
+        _settings_cache.pop('store_id', None)
+        value = get_setting('store_id')
+    return value
+
+
+def audit_dedupe_key(website_url, firm_type=None):
+    """Audits of the same site and firm type share one pipeline job"""
+    return f"{normalize_url(website_url)}|{firm_type or 'default'}"
+
+
+def running_audit(dedupe_key, conn=None):
+    """ID of the job already auditing this site and firm type, or None"""
+    leader = (conn or get_db()).execute(
+        """SELECT id FROM jobs WHERE dedupe_key = ? AND status IN ('queued', 'running', 'parked', 'analyzing')
+           AND parent_id IS NULL ORDER BY created_at LIMIT 1""",
+        (dedupe_key,)
+    ).fetchone()
+    return leader['id'] if leader else None
+
+
+def create_job(contact_id, contact_email, contact_name, website_url, firm_type=None):
+    """Persist a newly accepted audit.
+
+    If the same website (and firm type) is already being audited, the new job is attached to
+    that running job instead of being queued, and gets its own callback from the shared result.
+    Returns (job_id, parent_id) where parent_id is the running job it was attached to, if any.
+    """
+    job_id = uuid.uuid4().hex
+    dedupe_key = audit_dedupe_key(website_url, firm_type)
+    now = datetime.now().isoformat()
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        parent_id = running_audit(dedupe_key, conn)
+        conn.execute(
+            """INSERT INTO jobs (id, contact_id, contact_email, contact_name, website_url, firm_type,
+                                 status, stages, dedupe_key, parent_id, owner, lease_until, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (job_id, contact_id, contact_email, contact_name, website_url, firm_type,
+             'attached' if parent_id else 'queued',
+             json.dumps({stage: 'pending' for stage in JOB_STAGES}),
+             dedupe_key, parent_id, worker_id(), time.time() + JOB_LEASE_SECONDS, now, now)
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return job_id, parent_id
+
+
+def get_job(job_id):
+    """Load a job as a dict, or None if it doesn't exist"""
+    row = get_db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    for column in JOB_JSON_COLUMNS:
+        job[column] = json.loads(job[column]) if job[column] else None
+    job['timings'] = job['timings'] or {}
+    # Jobs stored by older versions hold one desktop screenshot, possibly base64-encoded
+    legacy_screenshot = job.pop('screenshot')
+    if job['screenshots']:
+        job['screenshots'] = unpack_screenshots(job['screenshots'])
+    elif legacy_screenshot:
+        if isinstance(legacy_screenshot, str):
+            legacy_screenshot = base64.b64decode(legacy_screenshot)
+        job['screenshots'] = {'desktop': legacy_screenshot}
+    # Stages added after a job was stored count as done if the job already got past them
+    for index, stage in enumerate(JOB_STAGES):
+        if stage not in job['stages']:
+            passed = any(job['stages'].get(later) == 'done' for later in JOB_STAGES[index + 1:])
+            job['stages'][stage] = 'done' if passed else 'pending'
+    return job
+
+
+def update_job(job_id, **fields):
+    """Update columns on a job record"""
+    for column in JOB_JSON_COLUMNS:
+        if isinstance(fields.get(column), (dict, list)):
+            fields[column] = json.dumps(fields[column])
+    if isinstance(fields.get('screenshots'), dict):
+        fields['screenshots'] = pack_screenshots(fields['screenshots'])
+    fields['updated_at'] = datetime.now().isoformat()
+    columns = ', '.join(f'{name} = ?' for name in fields)
+    get_db().execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+
+def finish_job(job, status, **fields):
+    """Mark a job finished and hand its outcome to any duplicate requests attached to it.
+
+    On success the attached jobs are re-queued with only their callback stage left to run;
+    otherwise they fail with the same error. Returns the IDs of the attached jobs.
+    """
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        update_job(job['id'], status=status, **fields)
+        followers = [row['id'] for row in conn.execute(
+            "SELECT id FROM jobs WHERE parent_id = ? AND status = 'attached'", (job['id'],)
+        )]
+        for follower_id in followers:
+            if status == 'complete':
+                stages = {stage: 'done' for stage in JOB_STAGES}
+                stages['callback'] = 'pending'
+                update_job(follower_id, status='queued', stages=stages, audit_data=job['audit_data'],
+                           report_url=job['report_url'], owner=worker_id(),
+                           lease_until=time.time() + JOB_LEASE_SECONDS)
+            else:
+                update_job(follower_id, status='failed', error=fields.get('error') or f"Audit {status}")
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return followers
+
+
+def renew_leases():
+    """Extend the lease on every unfinished job owned by this process"""
+    get_db().execute(
+        "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status IN ('queued', 'running')",
+        (time.time() + JOB_LEASE_SECONDS, worker_id())
+    )
+
+
+def claim_abandoned_jobs(limit):
+    """Take over unfinished jobs whose owner stopped renewing its lease (crash or restart)"""
+    if limit <= 0:
+        return []
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = conn.execute(
+            """SELECT id FROM jobs WHERE status IN ('queued', 'running') AND lease_until < ?
+               ORDER BY created_at LIMIT ?""",
+            (time.time(), limit)
+        ).fetchall()
+        job_ids = [row['id'] for row in rows]
+        for job_id in job_ids:
+            conn.execute(
+                "UPDATE jobs SET owner = ?, lease_until = ?, status = 'queued' WHERE id = ?",
+                (worker_id(), time.time() + JOB_LEASE_SECONDS, job_id)
+            )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return job_ids
+
+
+def replay_parked_jobs(limit):
+    """Take parked jobs whose wait is over and mark them queued again. Returns their IDs."""
+    if limit <= 0:
+        return []
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = conn.execute(
+            "SELECT id FROM jobs WHERE status = 'parked' AND park_until <= ? ORDER BY park_until LIMIT ?",
+            (time.time(), limit)
+        ).fetchall()
+        job_ids = [row['id'] for row in rows]
+        for job_id in job_ids:
+            update_job(job_id, status='queued', owner=worker_id(), lease_until=time.time() + JOB_LEASE_SECONDS)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return job_ids
+
+
+def count_parked_jobs():
+    return get_db().execute("SELECT COUNT(*) FROM jobs WHERE status = 'parked'").fetchone()[0]
+
+
+def queue_callback(job, success=True, error=None):
+    """Write a job's GHL callback to the outbox for the callback sender to deliver"""
+    if not GHL_WEBHOOK_URL:
+        print("Warning: GHL_WEBHOOK_URL not configured, skipping callback")
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    get_db().execute(
+        """INSERT INTO outbox (job_id, payload, status, next_attempt, created_at, updated_at)
+           VALUES (?, ?, 'pending', ?, ?, ?)""",
+        (job['id'], json.dumps(ghl_payload(job, success, error)), time.time(), now, now)
+    )
+    if callback_sender is not None:
+        callback_sender.notify()
+
+
+def claim_outbox_callbacks(limit):
+    """Lease up to `limit` due callbacks to this process, including ones a dead process was sending"""
+    conn = get_db()
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = conn.execute(
+            """SELECT * FROM outbox
+               WHERE (status = 'pending' AND next_attempt <= ?) OR (status = 'sending' AND lease_until < ?)
+               ORDER BY id LIMIT ?""",
+            (now, now, limit)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE outbox SET status = 'sending', owner = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+            [(worker_id(), now + GHL_CALLBACK_TIMEOUT * 2, datetime.now(timezone.utc).isoformat(), row['id'])
+             for row in rows]
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return rows
+
+
+def mark_callbacks_sent(rows):
+    get_db().executemany(
+        "UPDATE outbox SET status = 'sent', attempts = attempts + 1, lease_until = NULL, updated_at = ? WHERE id = ?",
+        [(datetime.now(timezone.utc).isoformat(), row['id']) for row in rows]
+    )
+
+
+def retry_callbacks(rows, error):
+    """Schedule failed callbacks for another attempt with jittered backoff, or give up on them.
+
+    Errors GHL won't get over (4xx other than 408/429) and callbacks out of attempts are marked dead.
+    Returns the number marked dead.
+    """
+    now = time.time()
+    updates = []
+    dead = 0
+    for row in rows:
+        attempts = row['attempts'] + 1
+        if not is_transient(error) or attempts >= GHL_CALLBACK_MAX_ATTEMPTS:
+            status, next_attempt = 'dead', now
+            dead += 1
+        else:
+            delay = random.uniform(0.5, 1) * min(GHL_CALLBACK_RETRY_MAX, GHL_CALLBACK_RETRY_BASE * 2 ** (attempts - 1))
+            status, next_attempt = 'pending', now + max(delay, getattr(error, 'retry_after', None) or 0)
+        updates.append((status, attempts, next_attempt, str(error)[:500], datetime.now(timezone.utc).isoformat(),
+                        row['id']))
+    get_db().executemany(
+        """UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, lease_until = NULL, last_error = ?,
+           updated_at = ? WHERE id = ?""",
+        updates
+    )
+    return dead
+
+
+def prune_outbox():
+    """Drop delivered callbacks older than GHL_OUTBOX_RETENTION (dead ones are kept for inspection)"""
+    cutoff = datetime.fromtimestamp(time.time() - GHL_OUTBOX_RETENTION, timezone.utc).isoformat()
+    get_db().execute("DELETE FROM outbox WHERE status = 'sent' AND updated_at < ?", (cutoff,))
+
+
+def outbox_stats():
+    """Callbacks in the outbox by status, and how long the oldest undelivered one has waited"""
+    counts = {row['status']: row['count'] for row in get_db().execute(
+        'SELECT status, COUNT(*) AS count FROM outbox GROUP BY status'
+    )}
+    oldest = get_db().execute(
+        "SELECT MIN(created_at) FROM outbox WHERE status IN ('pending', 'sending')"
+    ).fetchone()[0]
+    age = (datetime.now(timezone.utc) - datetime.fromisoformat(oldest)).total_seconds() if oldest else None
+    return {
+        'pending': counts.get('pending', 0),
+        'sending': counts.get('sending', 0),
+        'sent': counts.get('sent', 0),
+        'dead': counts.get('dead', 0),
+        'oldest_pending_seconds': round(age) if age is not None else None
+    }
+
+
+def mark_jobs_analyzing(job_ids, message_batch_id):
+    """Record that these jobs left the pipeline to wait for a submitted Message Batch"""
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for job_id in job_ids:
+            update_job(job_id, status='analyzing', message_batch_id=message_batch_id, owner=None, lease_until=None)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def claim_analyzing_job(job_id, message_batch_id):
+    """Take a job whose Message Batch has ended back into this process. False if another process got it."""
+    cursor = get_db().execute(
+        """UPDATE jobs SET status = 'running', owner = ?, lease_until = ?, updated_at = ?
+           WHERE id = ? AND status = 'analyzing' AND message_batch_id = ?""",
+        (worker_id(), time.time() + JOB_LEASE_SECONDS, datetime.now().isoformat(), job_id, message_batch_id)
+    )
+    return cursor.rowcount == 1
+
+
+def analyzing_jobs(message_batch_id):
+    """IDs of jobs still waiting on a Message Batch"""
+    return [row['id'] for row in get_db().execute(
+        "SELECT id FROM jobs WHERE status = 'analyzing' AND message_batch_id = ?", (message_batch_id,)
+    )]
+
+
+def pending_message_batches():
+    """IDs of submitted Message Batches that still have jobs waiting on them"""
+    return [row['message_batch_id'] for row in get_db().execute(
+        "SELECT DISTINCT message_batch_id FROM jobs WHERE status = 'analyzing'"
+    )]
+
+
+def count_analyzing_jobs():
+    return get_db().execute("SELECT COUNT(*) FROM jobs WHERE status = 'analyzing'").fetchone()[0]
+
+
+def create_batch(contacts, concurrency, analysis_mode='realtime'):
+    """Persist a batch and one waiting job per contact in a single transaction. Returns the batch ID."""
+    batch_id = uuid.uuid4().hex
+    now = datetime.now().isoformat()
+    stages = json.dumps({stage: 'pending' for stage in JOB_STAGES})
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(
+            "INSERT INTO batches (id, status, total, concurrency, created_at, updated_at) VALUES (?, 'running', ?, ?, ?, ?)",
+            (batch_id, len(contacts), concurrency, now, now)
+        )
+        conn.executemany(
+            """INSERT INTO jobs (id, contact_id, contact_email, contact_name, website_url, firm_type,
+                                 status, stages, dedupe_key, batch_id, analysis_mode, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, 'batched', ?, ?, ?, ?, ?, ?)""",
+            [(uuid.uuid4().hex, contact['contact_id'], contact['contact_email'], contact['contact_name'],
+              contact['website_url'], contact['firm_type'], stages,
+              audit_dedupe_key(contact['website_url'], contact['firm_type']),
+              batch_id, analysis_mode, now, now)
+             for contact in contacts]
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return batch_id
+
+
+def release_batched_jobs(limit):
+    """Move waiting batch jobs onto the queue, keeping each batch within its concurrency limit.
+
+    Jobs for a website that is already being audited are attached to that job instead.
+    Returns the IDs of the jobs to queue.
+    """
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    released = []
+    try:
+        batches = conn.execute(
+            """SELECT id, concurrency,
+                      (SELECT COUNT(*) FROM jobs WHERE batch_id = batches.id
+                       AND status IN ('queued', 'running', 'attached', 'parked')) AS in_flight,
+                      (SELECT COUNT(*) FROM jobs WHERE batch_id = batches.id AND status = 'batched') AS waiting,
+                      (SELECT COUNT(*) FROM jobs WHERE batch_id = batches.id AND status = 'analyzing') AS analyzing
+               FROM batches WHERE status = 'running' ORDER BY created_at"""
+        ).fetchall()
+        for batch in batches:
+            # Jobs waiting on a Message Batch hold no pipeline slot, so they don't count against concurrency
+            if batch['waiting'] == 0 and batch['in_flight'] == 0 and batch['analyzing'] == 0:
+                conn.execute("UPDATE batches SET status = 'complete', updated_at = ? WHERE id = ?",
+                             (datetime.now().isoformat(), batch['id']))
+                continue
+            slots = min(batch['concurrency'] - batch['in_flight'], limit - len(released))
+            if slots <= 0:
+                continue
+            rows = conn.execute(
+                "SELECT id, dedupe_key FROM jobs WHERE batch_id = ? AND status = 'batched' ORDER BY rowid LIMIT ?",
+                (batch['id'], slots)
+            ).fetchall()
+            for row in rows:
+                leader = conn.execute(
+                    """SELECT id FROM jobs WHERE dedupe_key = ? AND status IN ('queued', 'running', 'parked', 'analyzing')
+                       AND parent_id IS NULL ORDER BY created_at LIMIT 1""",
+                    (row['dedupe_key'],)
+                ).fetchone()
+                if leader:
+                    update_job(row['id'], status='attached', parent_id=leader['id'])
+                else:
+                    update_job(row['id'], status='queued', owner=worker_id(),
+                               lease_until=time.time() + JOB_LEASE_SECONDS)
+                    released.append(row['id'])
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return released
+
+
+def get_batch(batch_id):
+    """Batch record with per-status job counts, or None if it doesn't exist"""
+    row = get_db().execute('SELECT * FROM batches WHERE id = ?', (batch_id,)).fetchone()
+    if row is None:
+        return None
+    batch = dict(row)
+    batch['counts'] = {
+        count['status']: count['jobs'] for count in get_db().execute(
+            'SELECT status, COUNT(*) AS jobs FROM jobs WHERE batch_id = ? GROUP BY status', (batch_id,)
+        )
+    }
+    batch['finished'] = sum(batch['counts'].get(status, 0) for status in ('complete', 'failed', 'rejected'))
+    return batch
+
+
+def finished_batch_jobs(batch_id, since):
+    """Finished jobs in a batch updated at or after the given timestamp, oldest first"""
+    return [dict(row) for row in get_db().execute(
+        """SELECT id, contact_id, contact_email, website_url, status, report_url, error, updated_at,
+                  json_extract(audit_data, '$.overall_score') AS overall_score,
+                  json_extract(audit_data, '$.grade') AS grade
+           FROM jobs WHERE batch_id = ? AND status IN ('complete', 'failed', 'rejected') AND updated_at >= ?
+           ORDER BY updated_at""",
+        (batch_id, since)
+    )]
+
+
+def run_screenshot_stage(job):
+    """Capture the website in every viewport configured for its firm type"""
+    return {'screenshots': capture_screenshots(job['website_url'], viewports_for(job['firm_type']))}
+
+
+def run_preprocess_stage(job):
+    """Shrink each screenshot to the pixel and byte budget before it is graded"""
+    if not PREPROCESS_SCREENSHOTS:
+        return {}
+    screenshots = {}
+    timings = {}
+    for viewport, screenshot in job['screenshots'].items():
+        started = time.perf_counter()
+        screenshots[viewport], details = preprocess_screenshot(screenshot)
+        details['ms'] = round((time.perf_counter() - started) * 1000, 1)
+        details['image_tokens'] = estimate_image_tokens(details['width'], details['height'])
+        timings[viewport] = details
+    return {'screenshots': screenshots, 'timings': {**job['timings'], 'preprocess': timings}}
+
+
+def analysis_cache_key(screenshots, firm_type):
+    """Cache key for an analysis - editing the grading prompt changes the key, invalidating old entries"""
+    digest = hashlib.sha256()
+    for viewport, screenshot in screenshots.items():
+        # Desktop-only keys stay the same as before other viewports existed
+        if tuple(screenshots) != ('desktop',):
+            digest.update(viewport.encode('utf-8'))
+        digest.update(screenshot)
+    prompt_hash = hashlib.sha256(get_grading_prompt(firm_type, tuple(screenshots)).encode('utf-8')).hexdigest()
+    return f"{digest.hexdigest()}|{firm_type or 'default'}|{prompt_hash}"
+
+
+def cached_analysis(job):
+    """The cached audit for this job's screenshots, or None"""
+    cached = analysis_cache.get(analysis_cache_key(job['screenshots'], job['firm_type']))
+    if cached is None:
+        return None
+    print(f"Analysis cache hit for {job['website_url']}")
+    return json.loads(cached)
+
+
+def run_analysis_stage(job):
+    """Grade the screenshots and parse the audit JSON, reusing a cached result for an unchanged site"""
+    audit_data = cached_analysis(job)
+    if audit_data is not None:
+        return {'audit_data': audit_data}
+    
+    # The answer is kept on the job until it validates, so a retry after a failed repair call
+    # doesn't pay for the vision call again
+    if 'analysis_output' not in job:
+        started = time.perf_counter()
+        audit_json, usage = analyze_with_claude(job['screenshots'], job['firm_type'])
+        job['analysis_output'] = (audit_json, usage, round((time.perf_counter() - started) * 1000))
+    audit_json, usage, elapsed_ms = job['analysis_output']
+    audit_data, repairs = finalize_audit(audit_json)
+    del job['analysis_output']
+    analysis_cache.set(analysis_cache_key(job['screenshots'], job['firm_type']),
+                       json.dumps(audit_data).encode('utf-8'))
+    return {
+        'audit_data': audit_data,
+        'timings': {**job['timings'], 'analysis': {'claude_ms': elapsed_ms, **usage, **repairs}}
+    }
+
+
+def run_render_stage(job):
+    """Render the HTML report"""
+    # Generate HTML report using hardcoded template (NOT Claude)
+    assessment_date = datetime.now().strftime("%B %d, %Y")
+    html_report = generate_html_template(
+        audit_data=job['audit_data'],
+        website_url=job['website_url'],
+        business_name=job['contact_name'] or "Your Firm",
+        assessment_date=assessment_date
+    )
+    return {'html_report': html_report}
+
+
+def run_upload_stage(job):
+    """Publish the report to R2"""
+    if REPORT_SHARED_ASSETS:
+        publish_report_assets()
+    filename = f"audit-{uuid.uuid4().hex[:8]}-{datetime.now().strftime('%Y%m%d')}.html"
+    report_url, upload_timings = upload_to_r2(job['html_report'], filename)
+    return {'report_url': report_url, 'timings': {**job['timings'], 'upload': upload_timings}}
+
+
+def run_callback_stage(job):
+    """Queue the finished audit for delivery to GHL (the callback sender posts it)"""
+    queue_callback(job, success=True)
+    return {}
+
+
+STAGE_HANDLERS = {
+    'screenshot': run_screenshot_stage,
+    'preprocess': run_preprocess_stage,
+    'analysis': run_analysis_stage,
+    'render': run_render_stage,
+    'upload': run_upload_stage,
+    'callback': run_callback_stage
+}
+
+
+def send_failure_callback(job, error):
+    """Queue a callback telling GHL the audit for this job failed"""
+    queue_callback(job, success=False, error=error)
+
+
+def release_followers(followers, success, error=None):
+    """Deliver a finished job's outcome to the duplicate requests that were attached to it"""
+    for follower_id in followers:
+        if success:
+            print(f"Sharing result with attached audit {follower_id}")
+            requeue_or_release(follower_id)
+        else:
+            send_failure_callback(get_job(follower_id), error)
+
 
+def start_job(job_id):
+    """Load a job and mark it running. Returns None if it is not waiting to run."""
+    job = get_job(job_id)
+    if job is None or job['status'] not in ('queued', 'running'):
+        return None
+    print(f"Starting audit {job_id} for {job['website_url']} (firm type: {job['firm_type'] or 'default'})")
+    update_job(job_id, status='running')
+    job['profiled'] = random.random() < profile_sample_rate()
+    log_event('job_started', job_id=job_id, website_url=job['website_url'], firm_type=job['firm_type'],
+              stages=job['stages'], profiled=job['profiled'])
+    return job
 
-def send_to_ghl(contact_id, contact_email, contact_name, website_url, report_url, audit_data, success=True, error=None):
-    """Send results back to GHL via webhook"""
-    if not GHL_WEBHOOK_URL:
-        print("Warning: GHL_WEBHOOK_URL not configured, skipping callback")
+
+def execute_stage(stage, job):
+    """Run one stage handler and persist its output (called on the stage's own thread pool)"""
+    print(f"[{job['id']}] Running {stage} stage...")
+    started = time.perf_counter()
+    with job_context(job['id']), span(stage) as fields:
+        try:
+            with profile_stage(job, stage):
+                result = STAGE_HANDLERS[stage](job)
+        except Exception:
+            STAGE_ERRORS.labels(stage).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            STAGE_DURATION.labels(stage).observe(elapsed)
+        # Moving average of successful runs, for the drain time estimate used by admission control
+        stage_seconds[stage] = elapsed if stage not in stage_seconds else 0.8 * stage_seconds[stage] + 0.2 * elapsed
+        fields.update(result_sizes(result))
+        if stage in result.get('timings', {}):
+            fields['details'] = result['timings'][stage]
+    job.update(result)
+    job['stages'][stage] = 'done'
+    if 'queue_entry' in job:
+        # Pulled from the shared queue - the job store may be on another host
+        shared_queue.checkpoint(job, result)
+    else:
+        update_job(job['id'], stages=job['stages'], **result)
+
+
+def complete_job(job):
+    """Mark a job complete and share its result with attached duplicates"""
+    print(f"Audit complete! Report: {job['report_url']}")
+    JOBS_FINISHED.labels('complete').inc()
+    # The screenshots and rendered HTML are only needed to resume, drop them once done
+    followers = finish_job(job, 'complete', screenshot=None, screenshots=None, html_report=None)
+    release_followers(followers, success=True)
+
+
+def fail_job(job, stage, error):
+    """Mark a job failed and send failure callbacks for it and any attached duplicates"""
+    print(f"Audit {job['id']} failed at {stage} stage: {str(error)}")
+    JOBS_FINISHED.labels('failed').inc()
+    if stage:
+        job['stages'][stage] = 'failed'
+    followers = finish_job(job, 'failed', stages=job['stages'], error=str(error))
+    send_failure_callback(job, str(error))
+    release_followers(followers, success=False, error=str(error))
+
+
+def park_job(job, stage, error):
+    """Set a job aside after a transient failure so it is replayed later instead of failing.
+
+    Attached duplicates stay attached and get the result once the replay succeeds.
+    """
+    park_count = (job['park_count'] or 0) + 1
+    if park_count > JOB_MAX_PARKS:
+        fail_job(job, stage, error)
         return
+    delay = JOB_PARK_SECONDS * park_count
+    print(f"Audit {job['id']} parked at {stage} stage for {delay}s (attempt {park_count}): {str(error)}")
+    JOBS_FINISHED.labels('parked').inc()
+    update_job(job['id'], status='parked', park_count=park_count, park_until=time.time() + delay, error=str(error))
+
+
+def use_cached_analysis(job):
+    """Complete the analysis stage from the cache if this site was graded recently. Returns True on a hit."""
+    audit_data = cached_analysis(job)
+    if audit_data is None:
+        return False
+    job['audit_data'] = audit_data
+    job['stages']['analysis'] = 'done'
+    update_job(job['id'], stages=job['stages'], audit_data=audit_data)
+    return True
+
+
+def message_batch_error(result):
+    """UpstreamError for a Message Batch request that didn't succeed (expired and canceled ones are retried)"""
+    if result['type'] == 'errored':
+        return anthropic_error(result.get('error') or {}, "Message Batch request errored")
+    return UpstreamError('anthropic', 503, f"Message Batch request {result['type']}")
+
+
+def apply_message_batch_result(job_id, message_batch_id, result):
+    """Hand one Message Batch result back to its job: on to render on success, otherwise park or fail.
+
+    Returns False if the job was already taken by another process.
+    """
+    if not claim_analyzing_job(job_id, message_batch_id):
+        return False
+    with job_context(job_id):
+        log_event('message_batch_result', message_batch_id=message_batch_id, result=result['type'])
+    job = get_job(job_id)
+    if result['type'] != 'succeeded':
+        error = message_batch_error(result)
+        if is_transient(error):
+            park_job(job, 'analysis', error)
+        else:
+            fail_job(job, 'analysis', error)
+        return True
     
-    payload = {
-        "contact_id": contact_id,
-        "contact_email": contact_email,
-        "contact_name": contact_name,
-        "website_url": website_url,
-        "success": success,
-        "report_url": report_url,
-        "audit_data": audit_data,
-        "error": error,
-        "processed_at": datetime.now().isoformat()
-    }
-    
+    usage = record_token_usage(result['message'].get('usage'))
     try:
-        response = requests.post(GHL_WEBHOOK_URL, json=payload, timeout=30)
-        print(f"GHL callback response: {response.status_code}")
+        audit_data, repairs = finalize_audit(result['message']['content'][0]['text'])
     except Exception as e:
-        print(f"Failed to send to GHL: {str(e)}")
+        if is_transient(e):
+            park_job(job, 'analysis', e)
+        else:
+            fail_job(job, 'analysis', e)
+        return True
+    analysis_cache.set(analysis_cache_key(job['screenshots'], job['firm_type']),
+                       json.dumps(audit_data).encode('utf-8'))
+    job['stages']['analysis'] = 'done'
+    job['timings']['analysis'] = {'message_batch_id': message_batch_id, **usage, **repairs}
+    update_job(job_id, stages=job['stages'], audit_data=audit_data, timings=job['timings'])
+    requeue_or_release(job_id)
+    return True
 
 
-def process_audit_async(contact_id, contact_email, contact_name, website_url, firm_type=None):
-    """Background task to process the audit"""
-    report_url = None
-    audit_data = None
-    
-    try:
-        print(f"Starting audit for {website_url} (firm type: {firm_type or 'default'})")
-        
-        # Step 1: Screenshot
-        print("Taking screenshot...")
-        screenshot = take_screenshot(website_url)
-        
-        # Step 2: Claude analysis
-        print("Analyzing with Claude...")
-        audit_json = analyze_with_claude(screenshot, firm_type)
-        
-        # Clean up JSON
-        audit_json = audit_json.strip()
-        if audit_json.startswith('```json'):
-            audit_json = audit_json[7:]
-        elif audit_json.startswith('```'):
-            audit_json = audit_json.split('\n', 1)[1] if '\n' in audit_json else audit_json[3:]
-        if audit_json.endswith('```'):
-            audit_json = audit_json.rsplit('```', 1)[0]
-        audit_json = audit_json.strip()
-        
-        # Parse to validate JSON
-        audit_data = json.loads(audit_json)
-        
-        # Step 3: Generate HTML report using hardcoded template (NOT Claude)
-        print("Generating HTML report...")
-        assessment_date = datetime.now().strftime("%B %d, %Y")
-        html_report = generate_html_template(
-            audit_data=audit_data,
-            website_url=website_url,
-            business_name=contact_name or "Your Firm",
-            assessment_date=assessment_date
+class MessageBatchCollector:
+    """Groups batch-mode analyses into Message Batches, polls them and feeds results back to their jobs.
+
+    Lives on the pipeline loop. A job leaves the pipeline once its batch is submitted, so waiting
+    for results (which can take hours) holds no pipeline slot or thread.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.watching = set()
+        self.ended = set()
+        self.tasks = set()
+        self.flush_timer = None
+        self.batches_submitted = 0
+        self.results_applied = 0
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="message-batches")
+
+    async def submit(self, job):
+        """Add a job's analysis to the next Message Batch and wait until that batch has been submitted"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending[job['id']] = ((job['screenshots'], job['firm_type']), future)
+        if len(self.pending) >= MESSAGE_BATCH_MAX_REQUESTS:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.get_running_loop().call_later(MESSAGE_BATCH_WINDOW, self.flush)
+        await future
+
+    def flush(self):
+        """Submit everything collected so far as one Message Batch"""
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.pending:
+            pending, self.pending = self.pending, {}
+            self.spawn(self.send(pending))
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, pending):
+        loop = asyncio.get_running_loop()
+        try:
+            message_batch_id = await loop.run_in_executor(
+                self.executor, create_message_batch, {job_id: request for job_id, (request, _) in pending.items()}
+            )
+            await loop.run_in_executor(_store_executor, mark_jobs_analyzing, list(pending), message_batch_id)
+        except Exception as e:
+            for _, future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        print(f"Submitted Message Batch {message_batch_id} with {len(pending)} analyses")
+        self.batches_submitted += 1
+        for _, future in pending.values():
+            if not future.done():
+                future.set_result(message_batch_id)
+        self.watch(message_batch_id)
+
+    def watch(self, message_batch_id):
+        """Start polling a Message Batch, unless we already are or it has already been applied"""
+        if message_batch_id in self.watching or message_batch_id in self.ended:
+            return
+        self.watching.add(message_batch_id)
+        self.spawn(self.poll(message_batch_id))
+
+    async def poll(self, message_batch_id):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    batch = await loop.run_in_executor(self.executor, get_message_batch, message_batch_id)
+                    if batch['processing_status'] == 'ended':
+                        applied = await loop.run_in_executor(
+                            self.executor, self.apply_results, message_batch_id, batch['results_url']
+                        )
+                        print(f"Message Batch {message_batch_id} ended, {applied} results applied")
+                        self.ended.add(message_batch_id)
+                        return
+                except Exception as e:
+                    print(f"Message Batch {message_batch_id} poll failed: {str(e)}")
+                await asyncio.sleep(MESSAGE_BATCH_POLL_SECONDS)
+        finally:
+            self.watching.discard(message_batch_id)
+
+    def apply_results(self, message_batch_id, results_url):
+        applied = 0
+        returned = set()
+        for job_id, result in message_batch_results(results_url):
+            returned.add(job_id)
+            if apply_message_batch_result(job_id, message_batch_id, result):
+                applied += 1
+        # A request the ended batch has no result for would wait forever - grade it in realtime instead
+        for job_id in analyzing_jobs(message_batch_id):
+            if job_id in returned or not claim_analyzing_job(job_id, message_batch_id):
+                continue
+            print(f"Message Batch {message_batch_id} has no result for {job_id}, analyzing it in realtime")
+            with job_context(job_id):
+                log_event('message_batch_result', message_batch_id=message_batch_id, result='missing')
+            update_job(job_id, analysis_mode='realtime')
+            requeue_or_release(job_id)
+        self.results_applied += applied
+        return applied
+
+    def stats(self):
+        return {
+            'pending_requests': len(self.pending),
+            'batches_submitted': self.batches_submitted,
+            'batches_polling': len(self.watching),
+            'results_applied': self.results_applied
+        }
+
+
+class CallbackSender:
+    """Delivers GHL callbacks from the outbox on a background thread, so audit workers never wait on GHL.
+
+    Up to GHL_CALLBACK_CONCURRENCY requests are in flight at once over the shared GHL session,
+    each carrying up to GHL_CALLBACK_BATCH_SIZE callbacks. Failed deliveries are retried with
+    backoff; callbacks that run out of attempts stay in the outbox as dead.
+    """
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self.slots = threading.Semaphore(GHL_CALLBACK_CONCURRENCY)
+        self.executor = ThreadPoolExecutor(max_workers=GHL_CALLBACK_CONCURRENCY, thread_name_prefix="ghl-callbacks")
+        self.last_prune = 0
+
+    def notify(self):
+        """Deliver new callbacks now instead of at the next poll"""
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            try:
+                self.dispatch()
+                if time.time() - self.last_prune > 60 * 60:
+                    prune_outbox()
+                    self.last_prune = time.time()
+            except Exception as e:
+                print(f"Callback sender error: {str(e)}")
+            self.wakeup.wait(1)
+            self.wakeup.clear()
+
+    def dispatch(self):
+        """Claim due callbacks while delivery slots are free"""
+        while self.slots.acquire(blocking=False):
+            try:
+                rows = claim_outbox_callbacks(GHL_CALLBACK_BATCH_SIZE)
+            except Exception:
+                self.slots.release()
+                raise
+            if not rows:
+                self.slots.release()
+                return
+            self.executor.submit(self.deliver, rows)
+
+    def deliver(self, rows):
+        """Post one request's worth of callbacks and record the outcome"""
+        try:
+            job_ids = [row['job_id'] for row in rows]
+            try:
+                response = post_to_ghl([json.loads(row['payload']) for row in rows])
+            except Exception as e:
+                count_upstream_error('ghl', e)
+                dead = retry_callbacks(rows, e)
+                GHL_CALLBACKS.labels('dead').inc(dead)
+                GHL_CALLBACKS.labels('retried').inc(len(rows) - dead)
+                print(f"GHL callback failed for {', '.join(job_ids)} "
+                      f"({'gave up' if dead else 'will retry'}): {str(e)}")
+                log_event('callback', job_ids=job_ids, status='dead' if dead else 'retry',
+                          error_status=error_status(e), attempts=rows[0]['attempts'] + 1)
+                return
+            mark_callbacks_sent(rows)
+            GHL_CALLBACKS.labels('sent').inc(len(rows))
+            print(f"GHL callback response: {response.status_code}")
+            log_event('callback', job_ids=job_ids, status='sent', ghl_status=response.status_code,
+                      attempts=rows[0]['attempts'] + 1)
+        except Exception as e:
+            print(f"Callback sender error: {str(e)}")
+        finally:
+            self.slots.release()
+            self.wakeup.set()
+
+
+# Everything up to the report upload runs on whichever worker pulls the job; the callback writes to
+# the outbox, so it runs back in a process of the job's home store
+QUEUE_STAGES = [stage for stage in JOB_STAGES if stage != 'callback']
+
+# Keys a job dict carries while it is being worked on, not part of its saved state
+QUEUE_TRANSIENT_KEYS = ('screenshots', 'queue_entry', 'home', 'profiled', 'analysis_output')
+
+# Publish a job unless it is already on the stream. If its outcome is waiting (the process that was
+# to apply it died), announce the outcome again instead.
+QUEUE_PUBLISH_SCRIPT = """
+if redis.call('EXISTS', KEYS[4]) == 1 then
+    redis.call('LPUSH', KEYS[5], ARGV[1])
+    return 'reported'
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 'queued'
+end
+if redis.call('XLEN', KEYS[1]) >= tonumber(ARGV[6]) then
+    return 'full'
+end
+redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[5])
+if ARGV[4] ~= '' then
+    redis.call('SET', KEYS[3], ARGV[4], 'EX', ARGV[5])
+end
+redis.call('XADD', KEYS[1], '*', 'job_id', ARGV[1], 'home', ARGV[2])
+return 'published'
+"""
+
+# Save a job's progress - only if this worker still holds the lease
+QUEUE_CHECKPOINT_SCRIPT = """
+local pending = redis.call('XPENDING', KEYS[1], ARGV[1], ARGV[3], ARGV[3], 1)
+if #pending == 0 or pending[1][2] ~= ARGV[2] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[4], 'EX', ARGV[6])
+if ARGV[5] ~= '' then
+    redis.call('SET', KEYS[3], ARGV[5], 'EX', ARGV[6])
+end
+return 1
+"""
+
+# Leave the outcome and release the entry - only if this worker still holds the lease
+QUEUE_FINISH_SCRIPT = """
+local pending = redis.call('XPENDING', KEYS[1], ARGV[1], ARGV[3], ARGV[3], 1)
+if #pending == 0 or pending[1][2] ~= ARGV[2] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[4], 'EX', ARGV[6])
+redis.call('LPUSH', KEYS[3], ARGV[5])
+redis.call('XACK', KEYS[1], ARGV[1], ARGV[3])
+redis.call('XDEL', KEYS[1], ARGV[3])
+return 1
+"""
+
+# Reset the idle time of entries this worker still holds. Returns the ones another worker took over.
+QUEUE_HEARTBEAT_SCRIPT = """
+local lost = {}
+for i = 3, #ARGV do
+    local pending = redis.call('XPENDING', KEYS[1], ARGV[1], ARGV[i], ARGV[i], 1)
+    if #pending == 1 and pending[1][2] == ARGV[2] then
+        redis.call('XCLAIM', KEYS[1], ARGV[1], ARGV[2], 0, ARGV[i], 'JUSTID')
+    else
+        table.insert(lost, ARGV[i])
+    end
+end
+return lost
+"""
+
+
+class LeaseLostError(Exception):
+    """Another worker has taken over a job from the shared queue"""
+
+
+def job_state(job):
+    """A job as saved on the shared queue (JSON, without the screenshots)"""
+    return json.dumps({key: value for key, value in job.items() if key not in QUEUE_TRANSIENT_KEYS})
+
+
+class SharedQueue:
+    """Audits on a Redis stream that every worker process pulls from, on any host.
+
+    A job's state travels with it: its home (a process of the job store that accepted it) publishes
+    a snapshot, workers checkpoint it after each stage and leave the outcome on the home's results
+    list. A delivered, unacknowledged entry is a worker's lease - heartbeats keep it alive, and an
+    entry idle for longer than the visibility timeout is claimed by another worker.
+    """
+
+    def __init__(self, url):
+        # Longer than any blocking read below, so a quiet queue isn't a socket timeout
+        self.redis = redis.Redis.from_url(url, socket_timeout=30, socket_connect_timeout=10)
+        self.stream = f"{QUEUE_PREFIX}:jobs"
+        self.group = 'workers'
+        self.dead = f"{QUEUE_PREFIX}:dead"
+        self.workers = f"{QUEUE_PREFIX}:workers"
+        self.held = {}
+        self.lock = threading.Lock()
+        self.last_reclaim = 0
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._publish = self.redis.register_script(QUEUE_PUBLISH_SCRIPT)
+        self._checkpoint = self.redis.register_script(QUEUE_CHECKPOINT_SCRIPT)
+        self._finish = self.redis.register_script(QUEUE_FINISH_SCRIPT)
+        self._heartbeat = self.redis.register_script(QUEUE_HEARTBEAT_SCRIPT)
+
+    def key(self, kind, name):
+        return f"{QUEUE_PREFIX}:{kind}:{name}"
+
+    def publish(self, job):
+        """Put a job on the stream. Returns 'published', 'queued' (already on it), 'reported' or 'full'."""
+        screenshots = pack_screenshots(job['screenshots']) if job['screenshots'] else b''
+        home = store_id()
+        result = self._publish(
+            keys=[self.stream, self.key('state', job['id']), self.key('screenshots', job['id']),
+                  self.key('outcome', job['id']), self.key('results', home)],
+            args=[job['id'], home, job_state(job), screenshots, QUEUE_STATE_TTL, AUDIT_QUEUE_SIZE]
+        ).decode()
+        if result == 'published':
+            QUEUE_EVENTS.labels('published').inc()
+        return result
+
+    def pull(self, limit, block_ms=1000):
+        """Up to `limit` jobs for this worker: leases that expired elsewhere first, then new entries"""
+        entries = []
+        if time.time() - self.last_reclaim >= QUEUE_HEARTBEAT_SECONDS:
+            self.last_reclaim = time.time()
+            entries += self.reclaim(limit)
+        if len(entries) < limit:
+            response = self.redis.xreadgroup(self.group, worker_id(), {self.stream: '>'},
+                                             count=limit - len(entries), block=None if entries else block_ms)
+            for _, stream_entries in response or []:
+                entries += stream_entries
+        jobs = []
+        for entry_id, fields in entries:
+            job = self.load(entry_id.decode(), {name.decode(): value.decode() for name, value in fields.items()})
+            if job is not None:
+                jobs.append(job)
+        return jobs
+
+    def reclaim(self, limit):
+        """Claim entries whose worker stopped heartbeating, dead-lettering those delivered too often"""
+        _, claimed, *_ = self.redis.xautoclaim(self.stream, self.group, worker_id(),
+                                               min_idle_time=QUEUE_VISIBILITY_TIMEOUT * 1000, count=limit)
+        entries = []
+        for entry_id, fields in claimed:
+            pending = self.redis.xpending_range(self.stream, self.group, min=entry_id, max=entry_id, count=1)
+            deliveries = pending[0]['times_delivered'] if pending else 1
+            if deliveries > QUEUE_MAX_DELIVERIES:
+                self.dead_letter(entry_id.decode(), {name.decode(): value.decode() for name, value in fields.items()},
+                                 f"Audit abandoned by {deliveries - 1} workers without a result")
+            else:
+                QUEUE_EVENTS.labels('redelivered').inc()
+                entries.append((entry_id, fields))
+        return entries
+
+    def dead_letter(self, entry_id, fields, reason):
+        """Take an entry off the stream for good and fail its job at home"""
+        print(f"Dead-lettering audit {fields['job_id']}: {reason}")
+        with self.redis.pipeline() as pipe:
+            pipe.lpush(self.dead, json.dumps({**fields, 'reason': reason, 'dead_at': datetime.now().isoformat()}))
+            pipe.ltrim(self.dead, 0, 999)
+            pipe.set(self.key('outcome', fields['job_id']),
+                     json.dumps({'status': 'failed', 'stage': None, 'error': reason}), ex=QUEUE_STATE_TTL)
+            pipe.lpush(self.key('results', fields['home']), fields['job_id'])
+            pipe.xack(self.stream, self.group, entry_id)
+            pipe.xdel(self.stream, entry_id)
+            pipe.execute()
+        QUEUE_EVENTS.labels('dead_lettered').inc()
+
+    def load(self, entry_id, fields):
+        """The job for a delivered entry, from its last checkpoint (None if its state has expired)"""
+        state, screenshots = self.redis.mget(self.key('state', fields['job_id']),
+                                             self.key('screenshots', fields['job_id']))
+        if state is None:
+            self.dead_letter(entry_id, fields, f"Audit state expired after {QUEUE_STATE_TTL}s on the queue")
+            return None
+        job = json.loads(state)
+        job['screenshots'] = unpack_screenshots(screenshots) if screenshots else None
+        job['home'] = fields['home']
+        job['queue_entry'] = entry_id
+        with self.lock:
+            self.held[job['id']] = entry_id
+        QUEUE_EVENTS.labels('pulled').inc()
+        return job
+
+    def checkpoint(self, job, result):
+        """Save a worker's progress, so a redelivery resumes after the last finished stage.
+
+        Raises LeaseLostError if the job has been taken over, so a stale worker can't overwrite the
+        new holder's progress and stops working on it.
+        """
+        screenshots = pack_screenshots(job['screenshots']) if 'screenshots' in result else b''
+        saved = self._checkpoint(
+            keys=[self.stream, self.key('state', job['id']), self.key('screenshots', job['id'])],
+            args=[self.group, worker_id(), job['queue_entry'], job_state(job), screenshots, QUEUE_STATE_TTL]
         )
-        
-        # Step 4: Upload to R2
-        print("Uploading to R2...")
-        filename = f"audit-{uuid.uuid4().hex[:8]}-{datetime.now().strftime('%Y%m%d')}.html"
-        report_url = upload_to_r2(html_report, filename)
-        
-        print(f"Audit complete! Report: {report_url}")
-        
-        # Step 5: Send results back to GHL
-        send_to_ghl(
-            contact_id=contact_id,
-            contact_email=contact_email,
-            contact_name=contact_name,
-            website_url=website_url,
-            report_url=report_url,
-            audit_data=audit_data,
-            success=True
+        if not saved:
+            QUEUE_EVENTS.labels('lease_lost').inc()
+            raise LeaseLostError(f"Lease on audit {job['id']} was taken over by another worker")
+
+    def finish(self, job, status, stage=None, error=None):
+        """Leave a job's outcome for its home and release the lease. False if another worker took the job over."""
+        with self.lock:
+            entry_id = self.held.pop(job['id'], job['queue_entry'])
+        finished = self._finish(
+            keys=[self.stream, self.key('outcome', job['id']), self.key('results', job['home'])],
+            args=[self.group, worker_id(), entry_id, json.dumps({'status': status, 'stage': stage, 'error': error}),
+                  job['id'], QUEUE_STATE_TTL]
         )
+        if not finished:
+            print(f"Lease on audit {job['id']} was lost, discarding this worker's result")
+            QUEUE_EVENTS.labels('lease_lost').inc()
+        return bool(finished)
+
+    def release(self, job):
+        """Stop heartbeating a job another worker has taken over"""
+        with self.lock:
+            if self.held.get(job['id']) == job['queue_entry']:
+                del self.held[job['id']]
+
+    def heartbeat(self):
+        """Renew the leases on held jobs and report this worker's throughput for admission control"""
+        with self.lock:
+            held = dict(self.held)
+        if held:
+            lost = {entry_id.decode() for entry_id in self._heartbeat(keys=[self.stream],
+                                                                     args=[self.group, worker_id(), *held.values()])}
+            with self.lock:
+                for job_id, entry_id in held.items():
+                    if entry_id in lost and self.held.get(job_id) == entry_id:
+                        print(f"Lease on audit {job_id} expired and was taken over")
+                        QUEUE_EVENTS.labels('lease_lost').inc()
+                        del self.held[job_id]
+        self.redis.hset(self.workers, worker_id(), json.dumps({
+            'heartbeat': time.time(),
+            'throughput': local_throughput(),
+            'jobs': len(held)
+        }))
+
+    def live_workers(self):
+        """Heartbeat records of the workers seen within the visibility timeout (older ones are removed)"""
+        workers = {}
+        for name, record in self.redis.hgetall(self.workers).items():
+            record = json.loads(record)
+            if time.time() - record['heartbeat'] <= QUEUE_VISIBILITY_TIMEOUT:
+                workers[name.decode()] = record
+            else:
+                self.redis.hdel(self.workers, name)
+        return workers
+
+    def throughput(self):
+        """Jobs per second every live worker can finish together (None until one has run stages)"""
+        rates = [record['throughput'] for record in self.live_workers().values() if record['throughput']]
+        return sum(rates) if rates else None
+
+    def backlog(self):
+        """(jobs on the stream, jobs not yet delivered to a worker)"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            length, pending = pipe.xlen(self.stream).xpending(self.stream, self.group).execute()
+        return length, length - pending['pending']
+
+    def progress(self, job_id):
+        """Stages as of the job's last worker checkpoint, or None if it isn't on the queue"""
+        state = self.redis.get(self.key('state', job_id))
+        return json.loads(state)['stages'] if state else None
+
+    def next_result(self, timeout=5):
+        """ID of the next job whose outcome is waiting for this job store, or None"""
+        item = self.redis.brpop(self.key('results', store_id()), timeout=timeout)
+        return item[1].decode() if item else None
+
+    def read_result(self, job_id):
+        """(checkpointed job state, screenshots, outcome) a worker left for a job"""
+        state, screenshots, outcome = self.redis.mget(self.key('state', job_id), self.key('screenshots', job_id),
+                                                      self.key('outcome', job_id))
+        return (json.loads(state) if state else None, unpack_screenshots(screenshots) if screenshots else None,
+                json.loads(outcome) if outcome else None)
+
+    def forget(self, job_id):
+        self.redis.delete(self.key('state', job_id), self.key('screenshots', job_id), self.key('outcome', job_id))
+
+    def stats(self):
+        length, waiting = self.backlog()
+        return {
+            'waiting': waiting,
+            'leased': length - waiting,
+            'held_here': len(self.held),
+            'workers': len(self.live_workers()),
+            'dead_letters': self.redis.llen(self.dead)
+        }
+
+
+def runs_on_queue(job):
+    """Whether a job goes to the shared queue: worker stages left, and not graded through Message Batches"""
+    return (shared_queue is not None and job['analysis_mode'] != 'batch'
+            and any(job['stages'][stage] != 'done' for stage in QUEUE_STAGES))
+
+
+def apply_queue_result(job_id):
+    """Bring a worker's outcome into the job store, then run the callback, park or fail the job here"""
+    state, screenshots, outcome = shared_queue.read_result(job_id)
+    job = get_job(job_id)
+    if outcome is None or job is None or job['status'] not in ('queued', 'running'):
+        # Already applied by another process of this store
+        return
+    progress = {column: state[column] for column in ('stages', 'audit_data', 'html_report', 'report_url', 'timings')
+                } if state else {}
+    if screenshots:
+        progress['screenshots'] = screenshots
+    job.update(progress)
+    update_job(job_id, **progress)
+    with job_context(job_id):
+        log_event('queue_result', status=outcome['status'], stage=outcome['stage'], error=outcome['error'])
+    if outcome['status'] == 'done':
+        requeue_or_release(job_id)
+    elif outcome['status'] == 'parked':
+        park_job(job, outcome['stage'], outcome['error'])
+    else:
+        fail_job(job, outcome['stage'], outcome['error'])
+    shared_queue.forget(job_id)
+    QUEUE_EVENTS.labels('applied').inc()
+
+
+# Audit pipeline - an asyncio loop drives every job through the stages. Each stage has its own
+# thread pool and semaphore, so a job waiting for a stage holds no thread and a slow stage only
+# backs up its own queue.
+_worker_lock = threading.Lock()
+_worker_pid = None
+_worker_id = None
+# False in a standalone queue worker, which has no job store
+_worker_home = True
+_pipeline_loop = None
+_pipeline_lock = threading.Lock()
+_pipeline_jobs = set()
+_stage_semaphores = {}
+_stage_executors = {}
+_stage_waiting = {}
+_stage_active = {}
+_store_executor = None
+_capture_executor = None
+screenshot_backend = None
+shared_queue = None
+message_batches = None
+callback_sender = None
+stage_retries = {stage: 0 for stage in JOB_STAGES}
+_stage_retries_lock = threading.Lock()
+stage_seconds = {}
+
+
+def worker_id():
+    """Identifier for this process, used as the owner of the jobs it is running"""
+    global _worker_id
+    if _worker_id is None or not _worker_id.startswith(f"{socket.gethostname()}-{os.getpid()}-"):
+        _worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    return _worker_id
+
+
+def update_queue_gauges():
+    """Copy this process's pipeline counters into the Prometheus gauges"""
+    active = sum(_stage_active.values())
+    JOBS_IN_FLIGHT.set(len(_pipeline_jobs))
+    QUEUE_DEPTH.set(len(_pipeline_jobs) - active)
+    for stage in JOB_STAGES:
+        STAGE_JOBS.labels(stage, 'waiting').set(_stage_waiting.get(stage, 0))
+        STAGE_JOBS.labels(stage, 'active').set(_stage_active.get(stage, 0))
+
+
+async def run_stage_once(stage, job):
+    """Wait for a free slot in a stage, then run it on that stage's thread pool"""
+    _stage_waiting[stage] += 1
+    update_queue_gauges()
+    try:
+        await _stage_semaphores[stage].acquire()
+    finally:
+        _stage_waiting[stage] -= 1
+    _stage_active[stage] += 1
+    update_queue_gauges()
+    try:
+        await asyncio.get_running_loop().run_in_executor(_stage_executors[stage], execute_stage, stage, job)
+    finally:
+        _stage_active[stage] -= 1
+        _stage_semaphores[stage].release()
+        update_queue_gauges()
+
+
+async def run_stage(stage, job):
+    """Run a stage, retrying transient errors with jittered exponential backoff.
+
+    The stage's slot is given up while backing off, so the wait holds no thread.
+    """
+    for attempt in range(STAGE_MAX_RETRIES + 1):
+        try:
+            return await run_stage_once(stage, job)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            if not is_transient(e) or attempt == STAGE_MAX_RETRIES:
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            with _stage_retries_lock:
+                stage_retries[stage] += 1
+            print(f"[{job['id']}] {stage} stage failed ({str(e)}), retry {attempt + 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def process_audit_async(job_id):
+    """Drive one audit through the pipeline stages, resuming after the last completed stage"""
+    loop = asyncio.get_running_loop()
+    # Each task runs in its own copy of the context, so this only tags this job's lines
+    current_job_id.set(job_id)
+    try:
+        job = await loop.run_in_executor(_store_executor, start_job, job_id)
+        if job is None:
+            return
         
+        stage = None
+        with span('job') as fields:
+            try:
+                for stage in JOB_STAGES:
+                    if job['stages'][stage] == 'done':
+                        continue
+                    if stage == 'analysis' and job['analysis_mode'] == 'batch':
+                        if await loop.run_in_executor(_store_executor, use_cached_analysis, job):
+                            continue
+                        # The job leaves the pipeline here and is re-queued once its Message Batch ends
+                        await message_batches.submit(job)
+                        JOBS_FINISHED.labels('analyzing').inc()
+                        fields['status'] = 'analyzing'
+                        return
+                    await run_stage(stage, job)
+                await loop.run_in_executor(_store_executor, complete_job, job)
+                fields['status'] = 'complete'
+            except Exception as e:
+                fields.update(stage=stage, error=str(e)[:300], error_status=error_status(e))
+                if isinstance(e, CircuitOpenError) or is_transient(e):
+                    fields['status'] = 'parked'
+                    await loop.run_in_executor(_store_executor, park_job, job, stage, e)
+                else:
+                    fields['status'] = 'failed'
+                    await loop.run_in_executor(_stage_executors['callback'], fail_job, job, stage, e)
     except Exception as e:
-        print(f"Audit failed: {str(e)}")
-        send_to_ghl(
-            contact_id=contact_id,
-            contact_email=contact_email,
-            contact_name=contact_name,
-            website_url=website_url,
-            report_url=None,
-            audit_data=None,
-            success=False,
-            error=str(e)
-        )
+        print(f"Pipeline error for audit {job_id}: {str(e)}")
+    finally:
+        with _pipeline_lock:
+            _pipeline_jobs.discard(job_id)
+        update_queue_gauges()
+
+
+async def process_queued_audit(job):
+    """Drive a job pulled from the shared queue through the worker stages, then leave the outcome for its home"""
+    loop = asyncio.get_running_loop()
+    current_job_id.set(job['id'])
+    status, stage, error = 'done', None, None
+    try:
+        with span('job') as fields:
+            try:
+                for stage in QUEUE_STAGES:
+                    if job['stages'][stage] != 'done':
+                        await run_stage(stage, job)
+                stage = None
+                fields['status'] = 'done'
+            except LeaseLostError as e:
+                # The worker that took the job over reports its outcome
+                print(str(e))
+                status = None
+                fields.update(status='lease_lost', stage=stage)
+            except Exception as e:
+                status = 'parked' if isinstance(e, CircuitOpenError) or is_transient(e) else 'failed'
+                error = str(e)
+                fields.update(status=status, stage=stage, error=error[:300], error_status=error_status(e))
+    finally:
+        # Free the slot before the outcome goes out - if this process is also the job's home, it
+        # queues the callback stage as soon as the outcome arrives
+        with _pipeline_lock:
+            _pipeline_jobs.discard(job['id'])
+        update_queue_gauges()
+    if status is None:
+        shared_queue.release(job)
+        return
+    try:
+        await loop.run_in_executor(_store_executor, shared_queue.finish, job, status, stage, error)
+    except Exception as e:
+        print(f"Pipeline error for queued audit {job['id']}: {str(e)}")
+
+
+def queue_consumer():
+    """Pull jobs from the shared queue while this process's pipeline has room, heartbeating the leases it holds"""
+    last_heartbeat = 0
+    while True:
+        try:
+            if time.time() - last_heartbeat >= QUEUE_HEARTBEAT_SECONDS:
+                shared_queue.heartbeat()
+                last_heartbeat = time.time()
+            with _pipeline_lock:
+                room = QUEUE_PREFETCH - len(_pipeline_jobs)
+            if room <= 0:
+                time.sleep(0.5)
+                continue
+            for job in shared_queue.pull(room):
+                with _pipeline_lock:
+                    # Our own expired lease can come back to us while we are still on the job
+                    if job['id'] in _pipeline_jobs:
+                        continue
+                    _pipeline_jobs.add(job['id'])
+                update_queue_gauges()
+                job['profiled'] = random.random() < profile_sample_rate()
+                log_event('job_pulled', job_id=job['id'], website_url=job['website_url'], home=job['home'],
+                          stages=job['stages'], profiled=job['profiled'])
+                asyncio.run_coroutine_threadsafe(process_queued_audit(job), _pipeline_loop)
+        except Exception as e:
+            print(f"Queue consumer error: {str(e)}")
+            time.sleep(1)
+
+
+def queue_result_applier():
+    """Apply the outcomes workers leave for this job store"""
+    while True:
+        try:
+            job_id = shared_queue.next_result()
+            if job_id:
+                apply_queue_result(job_id)
+        except Exception as e:
+            print(f"Queue result error: {str(e)}")
+            time.sleep(1)
+
+
+def lease_keeper():
+    """Keep our job leases alive and pick up jobs abandoned by dead processes"""
+    while True:
+        try:
+            renew_leases()
+            for job_id in claim_abandoned_jobs(pipeline_capacity()):
+                print(f"Resuming audit {job_id}")
+                requeue_or_release(job_id)
+            for job_id in replay_parked_jobs(pipeline_capacity()):
+                print(f"Replaying parked audit {job_id}")
+                requeue_or_release(job_id)
+            for message_batch_id in pending_message_batches():
+                _pipeline_loop.call_soon_threadsafe(message_batches.watch, message_batch_id)
+        except Exception as e:
+            print(f"Lease keeper error: {str(e)}")
+        time.sleep(JOB_LEASE_SECONDS / 3)
+
+
+def batch_feeder():
+    """Feed waiting batch jobs into the pipeline as capacity and batch concurrency allow"""
+    while True:
+        try:
+            for job_id in release_batched_jobs(pipeline_capacity()):
+                requeue_or_release(job_id)
+        except Exception as e:
+            print(f"Batch feeder error: {str(e)}")
+        time.sleep(1)
+
+
+def start_workers(home=True):
+    """Start the pipeline loop and background threads once per process (threads don't survive a fork).
+
+    A standalone queue worker (home=False) only runs jobs from the shared queue - it doesn't resume,
+    feed or call back jobs from its own job store.
+    """
+    global _worker_pid, _worker_home, _pipeline_loop, _pipeline_jobs, _store_executor, _capture_executor, \
+        screenshot_backend, shared_queue, message_batches, _stream_drainer, callback_sender
+    with _worker_lock:
+        if _worker_pid == os.getpid():
+            return
+        _worker_home = home
+        if home:
+            init_db()
+            message_batches = MessageBatchCollector()
+        _pipeline_jobs = set()
+        for stage in JOB_STAGES:
+            _stage_semaphores[stage] = asyncio.Semaphore(STAGE_CONCURRENCY[stage])
+            _stage_executors[stage] = ThreadPoolExecutor(max_workers=STAGE_CONCURRENCY[stage],
+                                                         thread_name_prefix=f"{stage}-stage")
+            _stage_waiting[stage] = 0
+            _stage_active[stage] = 0
+        _store_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="job-store")
+        _capture_executor = ThreadPoolExecutor(max_workers=STAGE_CONCURRENCY['screenshot'] * max(1, MAX_VIEWPORTS - 1),
+                                               thread_name_prefix="capture")
+        screenshot_backend = SCREENSHOT_BACKENDS[SCREENSHOT_BACKEND]()
+        _stream_drainer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="stream-drain")
+        _pipeline_loop = asyncio.new_event_loop()
+        threading.Thread(target=_pipeline_loop.run_forever, name="audit-pipeline", daemon=True).start()
+        threading.Thread(target=profiler_loop, name="profiler", daemon=True).start()
+        if REDIS_URL:
+            shared_queue = SharedQueue(REDIS_URL)
+            for limiter in rate_limiters.values():
+                limiter.share(shared_queue.redis)
+            if QUEUE_CONSUME or not home:
+                threading.Thread(target=queue_consumer, name="queue-consumer", daemon=True).start()
+            if home:
+                threading.Thread(target=queue_result_applier, name="queue-results", daemon=True).start()
+        if home:
+            threading.Thread(target=lease_keeper, name="lease-keeper", daemon=True).start()
+            threading.Thread(target=batch_feeder, name="batch-feeder", daemon=True).start()
+            callback_sender = CallbackSender()
+            threading.Thread(target=callback_sender.run, name="callback-sender", daemon=True).start()
+        _worker_pid = os.getpid()
+
+
+def enqueue_audit(job_id):
+    """Submit an audit to the pipeline, or to the shared queue if it has worker stages left. Returns False if full."""
+    start_workers()
+    if shared_queue is not None:
+        job = get_job(job_id)
+        if job is not None and runs_on_queue(job):
+            return shared_queue.publish(job) != 'full'
+    with _pipeline_lock:
+        if job_id in _pipeline_jobs:
+            return True
+        if len(_pipeline_jobs) >= AUDIT_QUEUE_SIZE:
+            return False
+        _pipeline_jobs.add(job_id)
+    update_queue_gauges()
+    asyncio.run_coroutine_threadsafe(process_audit_async(job_id), _pipeline_loop)
+    return True
+
+
+def pipeline_load():
+    """(jobs in flight, jobs waiting for a stage or a worker) - across every worker when the shared queue is on"""
+    if shared_queue is not None:
+        return shared_queue.backlog()
+    with _pipeline_lock:
+        in_flight = len(_pipeline_jobs)
+    return in_flight, in_flight - sum(_stage_active.values())
+
+
+def pipeline_capacity():
+    """How many more jobs the pipeline will take from batches and resumes, leaving the priority reserve free"""
+    in_flight, _ = pipeline_load()
+    return max(0, AUDIT_QUEUE_SIZE - ADMISSION_RESERVED_SLOTS - in_flight)
+
+
+def requeue_or_release(job_id):
+    """Queue a job we own, or drop our lease so the lease keeper retries it once the pipeline drains"""
+    if not enqueue_audit(job_id):
+        update_job(job_id, lease_until=0)
+
+
+def queue_stats():
+    """Queue depth and active job gauges, overall and per stage"""
+    stages = {
+        stage: {
+            'limit': STAGE_CONCURRENCY[stage],
+            'waiting': _stage_waiting.get(stage, 0),
+            'active': _stage_active.get(stage, 0)
+        }
+        for stage in JOB_STAGES
+    }
+    active = sum(stage['active'] for stage in stages.values())
+    throughput = pipeline_throughput()
+    drain_seconds = estimate_drain_seconds()
+    return {
+        'jobs_in_flight': len(_pipeline_jobs),
+        'queue_depth': len(_pipeline_jobs) - active,
+        'queue_capacity': AUDIT_QUEUE_SIZE,
+        'reserved_slots': ADMISSION_RESERVED_SLOTS,
+        'active_jobs': active,
+        'throughput_per_second': round(throughput, 3) if throughput else None,
+        'estimated_drain_seconds': round(drain_seconds) if drain_seconds is not None else None,
+        'stages': stages
+    }
+
+
+def local_throughput():
+    """Jobs per second this process's pipeline can finish, limited by its slowest stage (None until stages have run)"""
+    rates = [STAGE_CONCURRENCY[stage] / seconds for stage, seconds in stage_seconds.items() if seconds > 0]
+    return min(rates) if rates else None
+
+
+def pipeline_throughput():
+    """Jobs per second the pipeline can finish - every live worker's together when the shared queue is on"""
+    if shared_queue is not None:
+        return shared_queue.throughput()
+    return local_throughput()
+
+
+def estimate_drain_seconds(in_flight=None, throughput=None):
+    """Roughly how long a job admitted now would take: the backlog ahead of it plus its own trip through the stages"""
+    throughput = throughput or pipeline_throughput()
+    if throughput is None:
+        return None
+    if in_flight is None:
+        in_flight, _ = pipeline_load()
+    return in_flight / throughput + sum(stage_seconds.values())
+
+
+def admission_check(priority=False):
+    """Decide whether /audit should take another job. Returns (reason, retry_after) when it shouldn't, else None.
+
+    Normal contacts are turned away when the queue is too deep, the backlog would take too long
+    to drain or only the reserved slots are left. Priority contacts only need a free slot.
+    """
+    in_flight, queue_depth = pipeline_load()
+    throughput = pipeline_throughput()
+    drain_seconds = estimate_drain_seconds(in_flight, throughput)
+    
+    if in_flight >= AUDIT_QUEUE_SIZE:
+        reason, excess_jobs = 'pipeline_full', in_flight - AUDIT_QUEUE_SIZE + 1
+    elif priority:
+        return None
+    elif in_flight >= AUDIT_QUEUE_SIZE - ADMISSION_RESERVED_SLOTS:
+        reason, excess_jobs = 'reserved_for_priority', in_flight - (AUDIT_QUEUE_SIZE - ADMISSION_RESERVED_SLOTS) + 1
+    elif queue_depth >= ADMISSION_MAX_QUEUE_DEPTH:
+        reason, excess_jobs = 'queue_depth', queue_depth - ADMISSION_MAX_QUEUE_DEPTH + 1
+    elif drain_seconds is not None and drain_seconds > ADMISSION_MAX_DRAIN_SECONDS:
+        reason, excess_jobs = 'drain_time', (drain_seconds - ADMISSION_MAX_DRAIN_SECONDS) * throughput
+    else:
+        return None
+    
+    # Time for the excess to drain, jittered so retries from many senders don't arrive together
+    wait = excess_jobs / throughput if throughput else 30
+    retry_after = min(ADMISSION_MAX_RETRY_AFTER, max(5, math.ceil(wait * random.uniform(1, 1.25))))
+    AUDIT_REJECTIONS.labels(reason).inc()
+    return reason, retry_after
+
+
+def busy_response(reason, retry_after):
+    """429 telling the sender to retry after a pause"""
+    response = jsonify({
+        'success': False,
+        'error': 'Audit service is busy - retry later',
+        'reason': reason,
+        'retry_after': retry_after
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def is_priority(data):
+    """Whether a webhook is for a priority contact: a truthy "priority" field or a priority tag"""
+    priority = data.get('priority')
+    if isinstance(priority, str):
+        if priority.strip().lower() in ('high', 'true', 'yes', '1'):
+            return True
+    elif priority:
+        return True
+    tags = data.get('tags') or []
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    return any(str(tag).strip().lower() in ADMISSION_PRIORITY_TAGS for tag in tags)
+
+
+def parse_contact(data):
+    """Extract contact fields from a webhook body or CSV row (handle various field names)"""
+    return {
+        'contact_id': data.get('id') or data.get('contact_id') or data.get('contactId'),
+        'contact_email': data.get('email') or data.get('contact_email'),
+        'contact_name': data.get('name') or data.get('contact_name') or data.get('firstName') or data.get('first_name'),
+        'website_url': data.get('website_url') or data.get('websiteUrl') or data.get('website') or data.get('url'),
+        'firm_type': data.get('firm_type') or data.get('firmType')
+    }
+
+
+def read_contacts_csv(text):
+    """Parse a CSV export into contact dicts (headers like 'Website URL' become 'website_url')"""
+    reader = csv.DictReader(io.StringIO(text))
+    return [
+        parse_contact({(key or '').strip().lower().replace(' ', '_'): (value or '').strip() or None
+                       for key, value in row.items()})
+        for row in reader
+    ]
+
+
+def start_batch(contacts, concurrency=None, firm_type=None, analysis_mode=None):
+    """Validate contacts and persist them as a batch. Returns (batch_id, skipped row numbers)."""
+    valid = []
+    skipped = []
+    for row_number, contact in enumerate(contacts, start=1):
+        if not contact['website_url']:
+            skipped.append(row_number)
+            continue
+        contact['firm_type'] = contact['firm_type'] or firm_type
+        valid.append(contact)
+    
+    start_workers()
+    batch_id = create_batch(valid, concurrency or BATCH_CONCURRENCY, analysis_mode or BATCH_ANALYSIS_MODE) if valid else None
+    return batch_id, skipped
+
+
+def stream_batch_results(batch_id, follow=True):
+    """Yield one JSON line per finished job as it completes, until the whole batch is done"""
+    seen = set()
+    since = ''
+    while True:
+        batch = get_batch(batch_id)
+        for job in finished_batch_jobs(batch_id, since):
+            since = job['updated_at']
+            if job['id'] in seen:
+                continue
+            seen.add(job['id'])
+            yield json.dumps({
+                'job_id': job['id'],
+                'contact_id': job['contact_id'],
+                'contact_email': job['contact_email'],
+                'website_url': job['website_url'],
+                'status': job['status'],
+                'overall_score': job['overall_score'],
+                'grade': job['grade'],
+                'report_url': job['report_url'],
+                'error': job['error']
+            }) + '\n'
+        if not follow or len(seen) >= batch['total']:
+            return
+        time.sleep(1)
 
 
 @app.route('/audit', methods=['POST'])
@@ -835,12 +4552,12 @@ def audit_website():
         # Log incoming data for debugging
         print(f"Received data: {json.dumps(data, indent=2)}")
         
-        # Extract fields (handle various field names)
-        contact_id = data.get('id') or data.get('contact_id') or data.get('contactId')
-        contact_email = data.get('email') or data.get('contact_email')
-        contact_name = data.get('name') or data.get('contact_name') or data.get('firstName')
-        website_url = data.get('website_url') or data.get('websiteUrl') or data.get('website') or data.get('url')
-        firm_type = data.get('firm_type') or data.get('firmType')
+        contact = parse_contact(data)
+        contact_id = contact['contact_id']
+        contact_email = contact['contact_email']
+        contact_name = contact['contact_name']
+        website_url = contact['website_url']
+        firm_type = contact['firm_type']
         
         print(f"Parsed - Name: {contact_name}, Email: {contact_email}, URL: {website_url}, Firm Type: {firm_type}")
         
@@ -850,17 +4567,43 @@ def audit_website():
                 'error': 'No website URL provided'
             }), 400
         
-        # Start background processing
-        thread = threading.Thread(
-            target=process_audit_async,
-            args=(contact_id, contact_email, contact_name, website_url, firm_type)
-        )
-        thread.start()
+        # Turn the webhook away before creating a job if the pipeline can't take it in time. A duplicate
+        # of an audit already running only attaches to it, costs the pipeline nothing and is let through.
+        priority = is_priority(data)
+        rejection = None
+        if running_audit(audit_dedupe_key(website_url, firm_type)) is None:
+            rejection = admission_check(priority)
+        if rejection:
+            reason, retry_after = rejection
+            print(f"Busy ({reason}), asking sender to retry {website_url} in {retry_after}s")
+            return busy_response(reason, retry_after)
+        
+        # Persist the job, then hand it to the worker pool
+        job_id, parent_id = create_job(contact_id, contact_email, contact_name, website_url, firm_type)
+        log_event('job_accepted', job_id=job_id, parent_id=parent_id, website_url=website_url, firm_type=firm_type)
+        if parent_id:
+            print(f"Audit for {website_url} already running as {parent_id}, attaching {job_id}")
+            return jsonify({
+                'success': True,
+                'contact_id': contact_id,
+                'job_id': job_id,
+                'message': 'Audit already in progress for this website - results will be sent to webhook when complete',
+                'website_url': website_url
+            })
+        
+        if not enqueue_audit(job_id):
+            # Filled up between the admission check and here
+            print(f"Audit queue full, rejecting {website_url}")
+            followers = finish_job(get_job(job_id), 'rejected', error='Audit queue is full')
+            release_followers(followers, success=False, error='Audit queue is full')
+            AUDIT_REJECTIONS.labels('pipeline_full').inc()
+            return busy_response('pipeline_full', 30)
         
         # Immediately return success
         return jsonify({
             'success': True,
             'contact_id': contact_id,
+            'job_id': job_id,
             'message': 'Audit started - results will be sent to webhook when complete',
             'website_url': website_url
         })
@@ -872,6 +4615,180 @@ def audit_website():
         }), 500
 
 
+@app.route('/audit/<job_id>', methods=['GET'])
+def audit_status(job_id):
+    """Return the stored status, audit JSON and report URL for a job"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': 'Job not found'
+        }), 404
+    if job['status'] == 'queued' and shared_queue is not None:
+        # A worker elsewhere may be on it - show its progress
+        job['stages'] = shared_queue.progress(job_id) or job['stages']
+    
+    return jsonify({
+        'success': True,
+        'job_id': job['id'],
+        'status': job['status'],
+        'stages': job['stages'],
+        'attached_to': job['parent_id'],
+        'batch_id': job['batch_id'],
+        'contact_id': job['contact_id'],
+        'website_url': job['website_url'],
+        'firm_type': job['firm_type'],
+        'report_url': job['report_url'],
+        'audit_data': job['audit_data'],
+        'timings': job['timings'],
+        'error': job['error'],
+        'analysis_mode': job['analysis_mode'] or 'realtime',
+        'message_batch_id': job['message_batch_id'],
+        'park_count': job['park_count'],
+        'parked_until': datetime.fromtimestamp(job['park_until']).isoformat() if job['status'] == 'parked' else None,
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at']
+    })
+
+
+@app.route('/audit/batch', methods=['POST'])
+def audit_batch():
+    """
+    Accept a list of contacts (JSON {"contacts": [...]} or a CSV body) and audit them
+    through the worker pool with at most `concurrency` in flight at once.
+    With "analysis_mode": "batch" the screenshots are graded through Message Batches.
+    """
+    try:
+        if request.mimetype == 'text/csv':
+            contacts = read_contacts_csv(request.get_data(as_text=True))
+            options = request.args
+        else:
+            data = request.json or {}
+            contacts = [parse_contact(item) for item in data.get('contacts', [])]
+            options = data
+        
+        if not contacts:
+            return jsonify({
+                'success': False,
+                'error': 'No contacts provided'
+            }), 400
+        if len(contacts) > BATCH_MAX_CONTACTS:
+            return jsonify({
+                'success': False,
+                'error': f'Too many contacts - the limit is {BATCH_MAX_CONTACTS} per batch'
+            }), 400
+        
+        analysis_mode = options.get('analysis_mode')
+        if analysis_mode and analysis_mode not in ANALYSIS_MODES:
+            return jsonify({
+                'success': False,
+                'error': f"analysis_mode must be one of: {', '.join(ANALYSIS_MODES)}"
+            }), 400
+        
+        concurrency = int(options['concurrency']) if options.get('concurrency') else None
+        batch_id, skipped = start_batch(contacts, concurrency, options.get('firm_type'), analysis_mode)
+        if batch_id is None:
+            return jsonify({
+                'success': False,
+                'error': 'No contacts with a website URL'
+            }), 400
+        
+        print(f"Batch {batch_id} accepted: {len(contacts) - len(skipped)} contacts, {len(skipped)} skipped")
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'total': len(contacts) - len(skipped),
+            'skipped_rows': skipped,
+            'status_url': f"/audit/batch/{batch_id}",
+            'results_url': f"/audit/batch/{batch_id}/results"
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/audit/batch/<batch_id>', methods=['GET'])
+def audit_batch_status(batch_id):
+    """Aggregate progress for a batch"""
+    batch = get_batch(batch_id)
+    if batch is None:
+        return jsonify({
+            'success': False,
+            'error': 'Batch not found'
+        }), 404
+    
+    return jsonify({
+        'success': True,
+        'batch_id': batch['id'],
+        'status': batch['status'],
+        'total': batch['total'],
+        'finished': batch['finished'],
+        'progress': round(batch['finished'] / batch['total'], 3) if batch['total'] else 1.0,
+        'counts': batch['counts'],
+        'concurrency': batch['concurrency'],
+        'created_at': batch['created_at'],
+        'updated_at': batch['updated_at']
+    })
+
+
+@app.route('/audit/batch/<batch_id>/results', methods=['GET'])
+def audit_batch_results(batch_id):
+    """Stream per-contact results as newline-delimited JSON as they finish (?follow=false for a snapshot)"""
+    if get_batch(batch_id) is None:
+        return jsonify({
+            'success': False,
+            'error': 'Batch not found'
+        }), 404
+    
+    follow = request.args.get('follow', 'true').lower() != 'false'
+    return Response(stream_with_context(stream_batch_results(batch_id, follow)), mimetype='application/x-ndjson')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, aggregated across all worker processes when running under gunicorn"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+@app.route('/debug/profiler', methods=['GET', 'POST'])
+def debug_profiler():
+    """Show or change the share of jobs profiled (POST {"sample_rate": 0.05}) and list the profiles written.
+
+    Disabled unless DEBUG_TOKEN is set; requests must send it in the X-Debug-Token header.
+    """
+    if not DEBUG_TOKEN or not hmac.compare_digest(request.headers.get('X-Debug-Token', ''), DEBUG_TOKEN):
+        return jsonify({'success': False, 'error': 'Not found'}), 404
+    
+    if request.method == 'POST':
+        try:
+            sample_rate = float((request.get_json(silent=True) or {}).get('sample_rate'))
+        except (TypeError, ValueError):
+            sample_rate = None
+        if sample_rate is None or not 0 <= sample_rate <= 1:
+            return jsonify({
+                'success': False,
+                'error': 'sample_rate must be a number between 0 and 1'
+            }), 400
+        set_setting('profile_sample_rate', sample_rate)
+        print(f"Profiler sample rate set to {sample_rate}")
+    
+    profiles = sorted(os.listdir(PROFILE_DIR)) if os.path.isdir(PROFILE_DIR) else []
+    return jsonify({
+        'success': True,
+        'sample_rate': profile_sample_rate(),
+        'profile_dir': PROFILE_DIR,
+        'profiles': profiles
+    })
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({
@@ -879,10 +4796,86 @@ def health_check():
         'screenshot_key': bool(SCREENSHOT_API_KEY),
         'claude_key': bool(CLAUDE_API_KEY),
         'r2_configured': bool(R2_ACCESS_KEY_ID and R2_SECRET_ACCESS_KEY),
-        'ghl_webhook': bool(GHL_WEBHOOK_URL)
+        'ghl_webhook': bool(GHL_WEBHOOK_URL),
+        'queue': queue_stats(),
+        'screenshot_cache': screenshot_cache.stats(),
+        'analysis_cache': analysis_cache.stats(),
+        'http_pools': http_pool_stats(),
+        'rate_limits': {name: limiter.stats() for name, limiter in rate_limiters.items()},
+        'circuit_breakers': {name: breaker.stats() for name, breaker in circuit_breakers.items()},
+        'stage_retries': stage_retries,
+        'token_usage': token_usage,
+        'analysis_stream_aborts': analysis_stream_aborts,
+        'audit_repairs': audit_repairs,
+        'parked_jobs': count_parked_jobs(),
+        'callback_outbox': outbox_stats(),
+        'screenshot_backend': screenshot_backend.stats() if screenshot_backend else None,
+        'shared_queue': shared_queue.stats() if shared_queue else None,
+        'message_batches': dict(message_batches.stats(), analyzing_jobs=count_analyzing_jobs())
     })
 
 
+@app.before_request
+def ensure_workers():
+    """Start the pipeline in this process before its first request, wherever the app is served from.
+
+    Importing this module starts nothing - gunicorn starts each worker's pipeline as it boots
+    (post_worker_init in gunicorn.conf.py), so unfinished audits resume without waiting for a request.
+    """
+    start_workers()
+
+
+def run_batch_cli(args):
+    """Audit every contact in a CSV file in this process, printing results as JSON lines"""
+    with open(args.csv_file, newline='', encoding='utf-8-sig') as f:
+        contacts = read_contacts_csv(f.read())
+    
+    batch_id, skipped = start_batch(contacts, args.concurrency, args.firm_type, args.analysis_mode)
+    if skipped:
+        print(f"Skipping rows without a website URL: {skipped}", file=sys.stderr)
+    if batch_id is None:
+        sys.exit("No contacts with a website URL")
+    
+    print(f"Batch {batch_id}: {len(contacts) - len(skipped)} contacts", file=sys.stderr)
+    # Worker log lines go to stderr so stdout stays valid JSON lines
+    results = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        for line in stream_batch_results(batch_id):
+            results.write(line)
+            results.flush()
+
+
+def run_worker():
+    """Run audits from the shared queue in this process until interrupted"""
+    if not REDIS_URL:
+        sys.exit("REDIS_URL is not set - there is no shared queue to work from")
+    start_workers(home=False)
+    print(f"Worker {worker_id()} pulling audits from the shared queue")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
 if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
+    parser = argparse.ArgumentParser(description='Nexli brand audit API')
+    subparsers = parser.add_subparsers(dest='command')
+    batch_parser = subparsers.add_parser('batch', help='audit every contact in a CSV export')
+    batch_parser.add_argument('csv_file')
+    batch_parser.add_argument('--concurrency', type=int, default=BATCH_CONCURRENCY)
+    batch_parser.add_argument('--firm-type', help='firm type for rows that do not have one')
+    batch_parser.add_argument('--analysis-mode', choices=ANALYSIS_MODES, default=BATCH_ANALYSIS_MODE,
+                              help='batch grades through Message Batches (cheaper, results can take hours)')
+    subparsers.add_parser('worker', help='run audits from the shared queue (needs REDIS_URL)')
+    args = parser.parse_args()
+    
+    if args.command == 'batch':
+        run_batch_cli(args)
+    elif args.command == 'worker':
+        run_worker()
+    else:
+        # Resume any audits left unfinished by a previous process
+        start_workers()
+        port = int(os.environ.get('PORT', 5000))
+        app.run(host='0.0.0.0', port=port)
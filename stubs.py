@@ -0,0 +1,514 @@
+"""Local stand-ins for the upstream APIs, for running the audit pipeline offline.
+
+Usage:
+    python stubs.py anthropic [--port 8901] [--batch-seconds 5] [--faults 6:0.3]
+    python stubs.py screenshotone [--port 8902] [--faults 3:0.4:0.02]
+    python stubs.py r2 [--port 8903]
+    python stubs.py ghl [--port 8904]
+    python stubs.py pages [--port 8905] [--faults 0.2]   # websites to capture with the browser backend
+    python stubs.py all [--anthropic 6:0.3] [--screenshotone 3:0.4] [--r2 0.08] [--ghl 0.15]
+
+--faults (and the per-upstream options of `all`) take latency[:jitter[:error_rate[:throttle_rate]]]:
+the median response time in seconds, the lognormal spread around it (0 = fixed), the share of
+requests answered with a 5xx and the share answered with a 429.
+
+Then point the app at the stubs (`all` prints these):
+    ANTHROPIC_API_URL=http://127.0.0.1:8901 python main.py
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from flask import Flask, request, jsonify, Response
+from PIL import Image, ImageDraw
+from werkzeug.serving import make_server
+
+
+STUB_PORTS = {'anthropic': 8901, 'screenshotone': 8902, 'r2': 8903, 'ghl': 8904, 'pages': 8905}
+
+# Latency and failure injection for one upstream - see parse_faults()
+Faults = namedtuple('Faults', ['latency', 'jitter', 'error_rate', 'throttle_rate'], defaults=[0, 0, 0, 0])
+
+
+SAMPLE_AUDIT = {
+    "overall_score": 58,
+    "grade": "F",
+    "categories": {
+        "credibility_trust": {
+            "score": 15,
+            "findings": "Credentials appear in the footer only & there are no client testimonials above the fold.",
+            "opportunity": "Move CFP/CPA credentials and two short testimonials into the hero section."
+        },
+        "client_experience": {
+            "score": 16,
+            "findings": "Clean layout but small body text and a crowded navigation bar with 9 items.",
+            "opportunity": "Cut the navigation to 5 items and raise body text to 16px."
+        },
+        "differentiation": {
+            "score": 12,
+            "findings": "Headline reads \"Helping you reach your financial goals\" - generic for the industry.",
+            "opportunity": "Name the client you serve best, e.g. <physicians nearing retirement>."
+        },
+        "conversion_path": {
+            "score": 15,
+            "findings": "Contact form exists but the only CTA above the fold is a phone number.",
+            "opportunity": "Add a 'Book a 15-minute call' button with online scheduling."
+        }
+    },
+    "recommendations": [
+        {
+            "priority": "HIGH",
+            "issue": "No clear value proposition",
+            "impact": "Visitors can't tell why to choose this firm over the next search result.",
+            "recommendation": "Rewrite the headline around one target client and one outcome."
+        },
+        {
+            "priority": "HIGH",
+            "issue": "Weak primary call to action",
+            "impact": "High-intent visitors leave without booking.",
+            "recommendation": "Add online booking to the hero and repeat it after each section."
+        },
+        {
+            "priority": "MEDIUM",
+            "issue": "Trust signals buried",
+            "impact": "Credentials and reviews are never seen by most visitors.",
+            "recommendation": "Surface credentials, reviews and compliance badges above the fold."
+        }
+    ],
+    "competitive_insight": "Firms that consistently attract high-value clients tend to lead with a specific niche, show social proof immediately and make booking a call a one-click decision.",
+    "summary": "A clean but generic site that doesn't tell visitors who it's for or what to do next.",
+    "bottom_line": "The site looks professional but isn't converting its traffic. A sharper headline and a booking CTA would change that quickly."
+}
+
+
+def parse_faults(spec):
+    """Faults from 'latency[:jitter[:error_rate[:throttle_rate]]]', e.g. '3:0.4:0.02'"""
+    return Faults(*(float(part) for part in spec.split(':')))
+
+
+def plain_error(status):
+    return Response(f"Injected {status}", status=status, mimetype='text/plain')
+
+
+def simulate(faults, error_response=plain_error):
+    """Wait out the upstream's latency, then maybe fail. Returns the error response to send instead, or None."""
+    if faults.latency > 0:
+        time.sleep(faults.latency * random.lognormvariate(0, faults.jitter) if faults.jitter else faults.latency)
+    roll = random.random()
+    if roll < faults.throttle_rate:
+        response = error_response(429)
+        response.headers['Retry-After'] = '1'
+        return response
+    if roll < faults.throttle_rate + faults.error_rate:
+        return error_response(503)
+    return None
+
+
+def synthetic_screenshot(width=1920, height=1200):
+    """A busy page-like capture (JPEG bytes)"""
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([0, 0, width, 90], fill=(12, 35, 64))
+    draw.rectangle([0, 90, width, 520], fill=(230, 238, 246))
+    for row in range(560, height, 28):
+        draw.text((80, row), "Fee-only financial planning for physicians and business owners. " * 3, fill=(40, 40, 40))
+    for column in range(80, width - 300, 440):
+        draw.rectangle([column, 180, column + 380, 460], fill=(59, 130, 246), outline=(30, 64, 175), width=4)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def sample_audit(params):
+    """SAMPLE_AUDIT, with notes for each labelled viewport when the request has more than one screenshot"""
+    content = params['messages'][0]['content']
+    labels = [block['text'].split(' viewport', 1)[0] for block in content
+              if block.get('type') == 'text' and ' viewport (' in block['text']]
+    if len(labels) < 2:
+        return SAMPLE_AUDIT
+    return {**SAMPLE_AUDIT, "viewports": {label.lower(): {
+        "findings": f"The {label.lower()} layout shows the headline and phone number but no booking button.",
+        "opportunity": f"Keep a 'Book a call' button in view on {label.lower()} screens."
+    } for label in labels}}
+
+
+def stub_message(params, prompt_cache):
+    """A Messages API response grading the screenshots with the sample audit.
+
+    A system prompt marked with cache_control is reported as a cache write the first time it is
+    seen and as a cache read after that, like the real API.
+    """
+    cached_tokens = sum(len(block['text']) // 4 for block in params.get('system') or []
+                        if isinstance(block, dict) and block.get('cache_control'))
+    prefix = json.dumps(params.get('system'), sort_keys=True)
+    cache_read = bool(cached_tokens) and prefix in prompt_cache
+    prompt_cache.add(prefix)
+    return {
+        "id": f"msg_{uuid.uuid4().hex}",
+        "type": "message",
+        "role": "assistant",
+        "model": params.get('model'),
+        "content": [{"type": "text", "text": json.dumps(sample_audit(params))}],
+        "stop_reason": "end_turn",
+        "usage": {
+            "input_tokens": 1600,
+            "output_tokens": 700,
+            "cache_creation_input_tokens": 0 if cache_read else cached_tokens,
+            "cache_read_input_tokens": cached_tokens if cache_read else 0
+        }
+    }
+
+
+def stream_events(message, chunk_size=40):
+    """The message as Messages API server-sent events, with the text in small deltas"""
+    text = message['content'][0]['text']
+    events = [
+        ('message_start', {"type": "message_start", "message": {
+            **message, "content": [], "stop_reason": None,
+            "usage": {**message['usage'], "output_tokens": 1}
+        }}),
+        ('content_block_start', {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+    ]
+    for start in range(0, len(text), chunk_size):
+        events.append(('content_block_delta', {
+            "type": "content_block_delta", "index": 0,
+            "delta": {"type": "text_delta", "text": text[start:start + chunk_size]}
+        }))
+    events += [
+        ('content_block_stop', {"type": "content_block_stop", "index": 0}),
+        ('message_delta', {"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                           "usage": {"output_tokens": message['usage']['output_tokens']}}),
+        ('message_stop', {"type": "message_stop"})
+    ]
+    for name, data in events:
+        yield f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+def anthropic_error(status):
+    error_type = 'rate_limit_error' if status == 429 else 'overloaded_error'
+    return Response(json.dumps({"type": "error", "error": {"type": error_type, "message": f"Injected {status}"}}),
+                    status=status, mimetype='application/json')
+
+
+def create_anthropic_stub(batch_seconds=5, faults=Faults()):
+    """Flask app answering the Messages and Message Batches endpoints the audit pipeline uses.
+
+    Message Batches stay in_progress for batch_seconds after they are created, then end with
+    every request succeeded. Faults apply to Messages calls and batch submissions.
+    """
+    stub = Flask('anthropic_stub')
+    batches = {}
+    prompt_cache = set()
+    lock = threading.Lock()
+
+    def batch_object(batch):
+        ended = time.time() - batch['created'] >= batch_seconds
+        count = len(batch['requests'])
+        return {
+            "id": batch['id'],
+            "type": "message_batch",
+            "processing_status": 'ended' if ended else 'in_progress',
+            "request_counts": {
+                "processing": 0 if ended else count,
+                "succeeded": count if ended else 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0
+            },
+            "created_at": datetime.fromtimestamp(batch['created'], timezone.utc).isoformat(),
+            "ended_at": datetime.fromtimestamp(batch['created'] + batch_seconds, timezone.utc).isoformat() if ended else None,
+            "results_url": f"{request.host_url}v1/messages/batches/{batch['id']}/results" if ended else None
+        }
+
+    @stub.route('/v1/messages', methods=['POST'])
+    def messages():
+        error = simulate(faults, anthropic_error)
+        if error is not None:
+            return error
+        with lock:
+            message = stub_message(request.json, prompt_cache)
+        if request.json.get('stream'):
+            return Response(stream_events(message), mimetype='text/event-stream')
+        return jsonify(message)
+
+    @stub.route('/v1/messages/batches', methods=['POST'])
+    def create_batch():
+        error = simulate(faults, anthropic_error)
+        if error is not None:
+            return error
+        batch = {
+            'id': f"msgbatch_{uuid.uuid4().hex}",
+            'created': time.time(),
+            'requests': request.json['requests']
+        }
+        with lock:
+            batches[batch['id']] = batch
+        print(f"Message Batch {batch['id']} created with {len(batch['requests'])} requests")
+        return jsonify(batch_object(batch))
+
+    @stub.route('/v1/messages/batches/<batch_id>', methods=['GET'])
+    def get_batch(batch_id):
+        with lock:
+            batch = batches.get(batch_id)
+        if batch is None:
+            return jsonify({"type": "error", "error": {"type": "not_found_error", "message": "Batch not found"}}), 404
+        return jsonify(batch_object(batch))
+
+    @stub.route('/v1/messages/batches/<batch_id>/results', methods=['GET'])
+    def batch_results(batch_id):
+        with lock:
+            batch = batches.get(batch_id)
+        if batch is None or time.time() - batch['created'] < batch_seconds:
+            return jsonify({"type": "error", "error": {"type": "not_found_error", "message": "Results not ready"}}), 404
+        with lock:
+            lines = [
+                json.dumps({
+                    "custom_id": item['custom_id'],
+                    "result": {"type": "succeeded", "message": stub_message(item['params'], prompt_cache)}
+                }) + '\n'
+                for item in batch['requests']
+            ]
+        return Response(lines, mimetype='application/x-jsonl')
+
+    return stub
+
+
+def create_screenshot_stub(faults=Faults()):
+    """Flask app answering ScreenshotOne's /take with a page-like JPEG (a tall narrow one for mobile viewports).
+
+    The requested URL is written into a JPEG comment, so every site gets different bytes (and its
+    own analysis cache entry) without encoding an image per request.
+    """
+    stub = Flask('screenshotone_stub')
+    desktop_capture = synthetic_screenshot()
+    mobile_capture = synthetic_screenshot(780, 1688)
+
+    @stub.route('/take', methods=['GET'])
+    def take():
+        error = simulate(faults)
+        if error is not None:
+            return error
+        capture = mobile_capture if request.args.get('viewport_mobile') == 'True' else desktop_capture
+        comment = request.args.get('url', '').encode('utf-8')[:60000]
+        segment = b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment
+        return Response(capture[:2] + segment + capture[2:], mimetype='image/jpeg')
+
+    return stub
+
+
+def s3_error(status):
+    code = 'SlowDown' if status == 429 else 'ServiceUnavailable'
+    body = f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>{code}</Code><Message>Injected {status}</Message></Error>"
+    # S3 throttles with 503 SlowDown rather than 429
+    return Response(body, status=503, mimetype='application/xml')
+
+
+def create_r2_stub(faults=Faults()):
+    """Flask app accepting S3 PutObject calls (path-style, as boto3 sends them to an IP endpoint).
+
+    Bodies are discarded; only the object count and bytes are kept.
+    """
+    stub = Flask('r2_stub')
+    stats = {'objects': 0, 'bytes': 0}
+    lock = threading.Lock()
+
+    @stub.route('/<path:key>', methods=['PUT'])
+    def put_object(key):
+        body = request.get_data()
+        error = simulate(faults, s3_error)
+        if error is not None:
+            return error
+        with lock:
+            stats['objects'] += 1
+            stats['bytes'] += len(body)
+        return Response(status=200, headers={'ETag': f'"{hashlib.md5(body).hexdigest()}"'})
+
+    @stub.route('/', methods=['GET'])
+    def get_stats():
+        with lock:
+            return jsonify(stats)
+
+    return stub
+
+
+def create_ghl_stub(faults=Faults()):
+    """Flask app taking the GHL webhook at /webhook, one callback per request or batched as {"callbacks": [...]}.
+
+    Every delivery attempt is recorded with the time it arrived and the status it was answered
+    with; GET /callbacks?since=N returns them from the Nth on, for the load benchmark.
+    """
+    stub = Flask('ghl_stub')
+    callbacks = []
+    lock = threading.Lock()
+
+    @stub.route('/webhook', methods=['POST'])
+    def webhook():
+        received = time.time()
+        payload = request.get_json(silent=True) or {}
+        error = simulate(faults)
+        with lock:
+            # Batched deliveries carry {"callbacks": [...]}
+            for callback in payload.get('callbacks', [payload]):
+                callbacks.append({
+                    'contact_id': callback.get('contact_id'),
+                    'success': callback.get('success'),
+                    'error': callback.get('error'),
+                    'received': received,
+                    'status': error.status_code if error is not None else 200
+                })
+        return error if error is not None else jsonify({'status': 'ok'})
+
+    @stub.route('/callbacks', methods=['GET'])
+    def list_callbacks():
+        since = request.args.get('since', 0, type=int)
+        with lock:
+            return jsonify({'callbacks': callbacks[since:], 'total': len(callbacks)})
+
+    return stub
+
+
+TEST_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{name}</title>
+    <script async src="https://securepubads.g.doubleclick.net/tag/js/gpt.js"></script>
+    <style>
+        body {{ margin: 0; font-family: Georgia, serif; color: #222; }}
+        nav {{ background: {color}; color: #fff; padding: 24px 5%; font-size: 20px; }}
+        .hero {{ display: flex; flex-wrap: wrap; gap: 32px; padding: 48px 5%; background: #eef2f7; }}
+        .hero div {{ flex: 1 1 320px; }}
+        .hero img {{ flex: 1 1 320px; max-width: 100%; }}
+        h1 {{ font-size: 44px; margin: 0 0 16px; }}
+        .cta {{ display: inline-block; background: {color}; color: #fff; padding: 14px 28px; border-radius: 6px; }}
+        section {{ display: grid; grid-template-columns: repeat(auto-fit, minmax(240px, 1fr)); gap: 24px; padding: 48px 5%; }}
+        #cookie-law-info-bar {{ position: fixed; bottom: 0; left: 0; right: 0; padding: 32px; background: #333; color: #fff; }}
+    </style>
+</head>
+<body>
+    <nav>{name} &nbsp; Services &nbsp; About &nbsp; Insights &nbsp; Contact</nav>
+    <div class="hero">
+        <div>
+            <h1>Fee-only planning for {audience}</h1>
+            <p>We help {audience} make confident decisions about retirement, taxes and the business they built.</p>
+            <a class="cta" href="#book">Book a call</a>
+        </div>
+        <img src="/page/{index}/hero.jpg" alt="">
+    </div>
+    <section>{cards}</section>
+    <div id="cookie-law-info-bar">This website uses cookies. <button>Accept</button></div>
+</body>
+</html>"""
+
+TEST_PAGE_AUDIENCES = ['physicians', 'business owners', 'tech executives', 'retirees', 'young families']
+TEST_PAGE_COLORS = ['#0c2340', '#1f4e3d', '#5b2333', '#2d3a8c', '#3f3f46']
+
+
+def create_pages_stub(faults=Faults()):
+    """Flask app serving small advisor-style websites at /page/<n>, for benchmarking local capture.
+
+    Each page has a hero image, an ad tag and a cookie banner, so ad and cookie-banner blocking
+    are exercised too. Faults apply to the page itself, not its image.
+    """
+    stub = Flask('pages_stub')
+    hero = synthetic_screenshot(960, 540)
+
+    @stub.route('/page/<int:index>', methods=['GET'])
+    def page(index):
+        error = simulate(faults)
+        if error is not None:
+            return error
+        audience = TEST_PAGE_AUDIENCES[index % len(TEST_PAGE_AUDIENCES)]
+        cards = ''.join(f"<div><h3>Service {card + 1}</h3><p>{'Planning that fits the way you work. ' * 6}</p></div>"
+                        for card in range(3 + index % 4))
+        return Response(TEST_PAGE.format(
+            index=index, name=f"Example Wealth {index}", audience=audience, cards=cards,
+            color=TEST_PAGE_COLORS[index % len(TEST_PAGE_COLORS)]
+        ), mimetype='text/html')
+
+    @stub.route('/page/<int:index>/hero.jpg', methods=['GET'])
+    def hero_image(index):
+        return Response(hero, mimetype='image/jpeg')
+
+    return stub
+
+
+def stub_environment(host='127.0.0.1', ports=STUB_PORTS):
+    """Environment variables pointing the app at the stubs"""
+    return {
+        'ANTHROPIC_API_URL': f"http://{host}:{ports['anthropic']}",
+        'CLAUDE_API_KEY': 'stub',
+        'SCREENSHOT_API_URL': f"http://{host}:{ports['screenshotone']}/take",
+        'SCREENSHOT_API_KEY': 'stub',
+        'R2_ENDPOINT': f"http://{host}:{ports['r2']}",
+        'R2_ACCESS_KEY_ID': 'stub',
+        'R2_SECRET_ACCESS_KEY': 'stub',
+        'R2_BUCKET_NAME': 'reports',
+        'R2_PUBLIC_URL': f"http://{host}:{ports['r2']}/reports",
+        'GHL_WEBHOOK_URL': f"http://{host}:{ports['ghl']}/webhook"
+    }
+
+
+def serve(stub, port, host='127.0.0.1'):
+    """Serve a stub on a background thread. Returns the server (call shutdown() to stop it)."""
+    server = make_server(host, port, stub, threaded=True)
+    threading.Thread(target=server.serve_forever, name=f"{stub.name}-server", daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-ins for the upstream APIs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    anthropic_parser = subparsers.add_parser('anthropic', help='Messages and Message Batches API')
+    anthropic_parser.add_argument('--port', type=int, default=STUB_PORTS['anthropic'])
+    anthropic_parser.add_argument('--batch-seconds', type=float, default=5,
+                                  help='how long a Message Batch stays in progress')
+    anthropic_parser.add_argument('--faults', type=parse_faults, default=Faults())
+    for name, help_text in [('screenshotone', 'ScreenshotOne captures'), ('r2', 'R2 (S3 PutObject)'),
+                            ('ghl', 'GHL webhook'), ('pages', 'test websites to capture')]:
+        stub_parser = subparsers.add_parser(name, help=help_text)
+        stub_parser.add_argument('--port', type=int, default=STUB_PORTS[name])
+        stub_parser.add_argument('--faults', type=parse_faults, default=Faults())
+    all_parser = subparsers.add_parser('all', help='every upstream, on ports 8901-8904')
+    all_parser.add_argument('--batch-seconds', type=float, default=5)
+    all_parser.add_argument('--anthropic', type=parse_faults, default=Faults(6, 0.3))
+    all_parser.add_argument('--screenshotone', type=parse_faults, default=Faults(3, 0.4))
+    all_parser.add_argument('--r2', type=parse_faults, default=Faults(0.08, 0.5))
+    all_parser.add_argument('--ghl', type=parse_faults, default=Faults(0.15, 0.5))
+    args = parser.parse_args()
+
+    if args.command == 'all':
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        servers = [
+            serve(create_anthropic_stub(args.batch_seconds, args.anthropic), STUB_PORTS['anthropic']),
+            serve(create_screenshot_stub(args.screenshotone), STUB_PORTS['screenshotone']),
+            serve(create_r2_stub(args.r2), STUB_PORTS['r2']),
+            serve(create_ghl_stub(args.ghl), STUB_PORTS['ghl'])
+        ]
+        print("Stubs running. Point the app at them with:")
+        for key, value in stub_environment().items():
+            print(f"    export {key}={value}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            for server in servers:
+                server.shutdown()
+    else:
+        stub = {
+            'anthropic': lambda: create_anthropic_stub(args.batch_seconds, args.faults),
+            'screenshotone': lambda: create_screenshot_stub(args.faults),
+            'r2': lambda: create_r2_stub(args.faults),
+            'ghl': lambda: create_ghl_stub(args.faults),
+            'pages': lambda: create_pages_stub(args.faults)
+        }[args.command]()
+        stub.run(host='127.0.0.1', port=args.port, threaded=True)
@@ -0,0 +1,69 @@
+"""Tests for pulling the audit JSON out of model output, whole and while it streams"""
+import json
+
+import pytest
+
+from main import MalformedOutputError, StreamingAuditParser, load_audit_json
+from stubs import SAMPLE_AUDIT
+
+AUDIT_TEXT = json.dumps(SAMPLE_AUDIT, indent=2)
+
+
+def feed_in_chunks(parser, text, size=7):
+    """Feed text the way a stream delivers it; returns what the last feed() call returned"""
+    done = False
+    for start in range(0, len(text), size):
+        done = parser.feed(text[start:start + size])
+        if done:
+            break
+    return done
+
+
+def test_parser_skips_code_fence():
+    parser = StreamingAuditParser()
+    assert feed_in_chunks(parser, f"```json\n{AUDIT_TEXT}\n```")
+    assert json.loads(parser.text()) == SAMPLE_AUDIT
+    assert parser.preamble == '```json\n'
+
+
+def test_parser_skips_braces_in_preamble():
+    parser = StreamingAuditParser()
+    text = f'I will return {{the audit}} as {{"format": "json"}} requested.\n{AUDIT_TEXT}'
+    assert feed_in_chunks(parser, text)
+    assert json.loads(parser.text()) == SAMPLE_AUDIT
+
+
+@pytest.mark.parametrize('size', [1, 5, 64, 100000])
+def test_parser_finds_audit_whatever_the_chunk_size(size):
+    parser = StreamingAuditParser()
+    assert feed_in_chunks(parser, f"Here you go: {{x}}\n{AUDIT_TEXT}\nThanks!", size)
+    assert json.loads(parser.text()) == SAMPLE_AUDIT
+
+
+def test_parser_not_done_until_object_closes():
+    parser = StreamingAuditParser()
+    assert not parser.feed(AUDIT_TEXT[:-1])
+    assert parser.feed(AUDIT_TEXT[-1])
+
+
+def test_parser_aborts_early_on_unfixable_grade():
+    parser = StreamingAuditParser()
+    with pytest.raises(MalformedOutputError, match='grade'):
+        feed_in_chunks(parser, '{"overall_score": 58, "grade": 5, "categories": {')
+
+
+def test_parser_leaves_fixable_score_alone():
+    parser = StreamingAuditParser()
+    assert not parser.feed('{"overall_score": "58", "grade": "F",')
+
+
+def test_load_skips_braced_fragment_before_audit():
+    data, fixes = load_audit_json(f"Scores use {{0-100}}.\n{AUDIT_TEXT}")
+    assert data == SAMPLE_AUDIT
+    assert fixes == ['ignored text around the JSON']
+
+
+def test_load_code_fence_is_not_a_fix():
+    data, fixes = load_audit_json(f"```json\n{AUDIT_TEXT}\n```")
+    assert data == SAMPLE_AUDIT
+    assert fixes == []
@@ -0,0 +1,85 @@
+"""Tests for the deterministic fixes and checks applied to the audit before it is rendered"""
+import copy
+import json
+
+import pytest
+
+from main import check_audit, coerce_score, repair_audit, strip_trailing_commas, validate_audit
+from stubs import SAMPLE_AUDIT
+
+
+def sample_audit():
+    return copy.deepcopy(SAMPLE_AUDIT)
+
+
+def test_strip_trailing_commas():
+    assert strip_trailing_commas('{"a": [1, 2,], "b": 3,\n}') == '{"a": [1, 2], "b": 3\n}'
+
+
+def test_strip_trailing_commas_keeps_commas_in_strings():
+    text = '{"a": "x,}", "b": "y,]", "c": "say \\",}\\" twice",}'
+    assert json.loads(strip_trailing_commas(text)) == {'a': 'x,}', 'b': 'y,]', 'c': 'say ",}" twice'}
+
+
+def test_strip_trailing_commas_leaves_valid_json_alone():
+    text = json.dumps(SAMPLE_AUDIT)
+    assert strip_trailing_commas(text) == text
+
+
+@pytest.mark.parametrize('value, expected', [
+    (12, 12), (12.6, 13), ('18', 18), (-3, 0), (40, 25),
+    (float('inf'), None), (float('-inf'), None), (float('nan'), None), ('Infinity', None),
+    (True, None), (None, None), ('N/A', None)
+])
+def test_coerce_score(value, expected):
+    assert coerce_score(value, 25) == expected
+
+
+def test_sample_audit_needs_no_fixes():
+    audit, fixes = repair_audit(sample_audit())
+    assert fixes == []
+    assert validate_audit(audit) == []
+
+
+def test_repair_clamps_out_of_range_scores_and_regrades():
+    data = sample_audit()
+    data['categories']['credibility_trust']['score'] = 40
+    data['categories']['differentiation']['score'] = -2
+    audit, fixes = repair_audit(data)
+    assert audit['categories']['credibility_trust']['score'] == 25
+    assert audit['categories']['differentiation']['score'] == 0
+    assert audit['overall_score'] == 25 + 16 + 0 + 15
+    assert audit['grade'] == 'F'
+    assert len(fixes) == 3
+    assert validate_audit(audit) == []
+    # The input is not changed in place
+    assert data['categories']['credibility_trust']['score'] == 40
+
+
+def test_repair_recomputes_overall_score_and_grade():
+    data = sample_audit()
+    data['overall_score'] = 95
+    data['grade'] = 'a'
+    audit, fixes = repair_audit(data)
+    assert (audit['overall_score'], audit['grade']) == (58, 'F')
+    assert validate_audit(audit) == []
+
+
+def test_non_finite_scores_are_missing_not_a_crash():
+    audit, fixes, problems = check_audit(
+        '{"overall_score": Infinity, "grade": "A", "categories": {"credibility_trust": {"score": NaN}}}'
+    )
+    assert audit['overall_score'] == float('inf')
+    assert 'overall_score must be a whole number from 0 to 100' in problems
+    assert 'categories.credibility_trust.score must be a whole number from 0 to 25' in problems
+
+
+def test_validate_reports_out_of_range_scores():
+    audit = sample_audit()
+    audit['overall_score'] = 120
+    audit['categories']['client_experience']['score'] = 30
+    audit['recommendations'][0]['priority'] = 'urgent'
+    problems = validate_audit(audit)
+    assert 'overall_score must be a whole number from 0 to 100' in problems
+    assert 'categories.client_experience.score must be a whole number from 0 to 25' in problems
+    assert 'recommendations[0].priority must be one of HIGH, MEDIUM, LOW' in problems
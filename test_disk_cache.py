@@ -0,0 +1,73 @@
+"""Tests for the on-disk screenshot and analysis cache"""
+import os
+import time
+
+from main import DiskCache
+
+
+def make_cache(tmp_path, ttl=60, max_bytes=1000):
+    return DiskCache(str(tmp_path / 'cache'), ttl, max_bytes)
+
+
+def age(cache, key, seconds, used=None):
+    """Backdate an entry's write time and, separately, its last use"""
+    now = time.time()
+    os.utime(cache._path(key), (now - (seconds if used is None else used), now - seconds))
+
+
+def test_hit_and_miss(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.get('a') is None
+    cache.set('a', b'x' * 10)
+    assert cache.get('a') == b'x' * 10
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_rate'], stats['bytes']) == (1, 1, 0.5, 10)
+
+
+def test_expired_entry_is_a_miss_and_removed(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.set('a', b'x' * 300)
+    cache.set('b', b'y' * 300)
+    age(cache, 'a', 120)
+    assert cache.get('a') is None
+    assert not os.path.exists(cache._path('a'))
+    assert cache.stats()['bytes'] == 300
+    assert cache.get('b') == b'y' * 300
+
+
+def test_overwrite_counts_new_size_only(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.set('a', b'x' * 100)
+    cache.set('b', b'y' * 100)
+    cache.set('a', b'z' * 400)
+    assert cache.stats()['bytes'] == 500
+    cache.set('a', b'z' * 50)
+    assert cache.stats()['bytes'] == 150
+    assert cache.stats()['evictions'] == 0
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=1000)
+    for key in 'abc':
+        cache.set(key, key.encode() * 300)
+    # a was written first but read most recently
+    age(cache, 'a', 30, used=1)
+    age(cache, 'b', 20)
+    age(cache, 'c', 10)
+    cache.set('d', b'd' * 300)
+    assert cache.get('b') is None
+    assert [cache.get(key) is not None for key in 'acd'] == [True, True, True]
+    stats = cache.stats()
+    assert (stats['evictions'], stats['bytes']) == (1, 900)
+
+
+def test_size_matches_disk_after_expiry_and_overwrite(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=1000)
+    cache.set('a', b'x' * 400)
+    cache.set('b', b'y' * 400)
+    age(cache, 'a', 120)
+    cache.get('a')
+    cache.set('b', b'y' * 500)
+    cache.set('c', b'z' * 100)
+    on_disk = sum(entry.stat().st_size for entry in os.scandir(cache.directory))
+    assert cache.stats()['bytes'] == on_disk == 600